@@ -4,3 +4,10 @@ from django.apps import AppConfig
 class MailServiceConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'mail_service'
+
+    def ready(self):
+        # Connect the anymail tracking signal receiver and register the system checks.
+        from . import checks, webhooks  # noqa: F401
+        # Time every database query from the first connection on, and
+        # connect the Celery signals that carry trace ids to tasks.
+        from . import metrics, tracing  # noqa: F401
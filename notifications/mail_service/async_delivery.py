@@ -0,0 +1,133 @@
+# async_delivery.py
+
+import asyncio
+from collections import defaultdict
+from asgiref.sync import sync_to_async
+from django.utils import timezone
+from .concurrency import get_semaphore, run_in_executor
+from .delivery import (FIREBASE_BREAKER, _start_attempt, aggregate_status, apply_push_results, deferred_results,
+                       mail_chunks, push_batch_results, push_batches, push_failed, push_targets, screen_deliveries,
+                       send_mail_chunks, summarize_push_results)
+from .firebase_service import acquire_firebase_app, release_firebase_app
+from .metrics import timed_send
+from .tracing import resume
+from .ratelimit import RateLimited, acquire
+from .rendering import push_groups
+from .retry import acall_with_breaker
+
+
+async def asend_push(subject, message, tokens, topics, condition, firebase_credential):
+    """
+    send_push on the event loop. The FCM calls from push_batches() go out
+    concurrently through firebase_admin's async API, each taking its rate
+    limit tokens and then holding a slot of the send semaphore. Returns one
+    result dict per target, deferred_results() for calls over the limit.
+    """
+    # Imported on the first push, as in delivery.py.
+    from firebase_admin import messaging
+
+    notification = messaging.Notification(title=subject, body=message)
+    semaphore = get_semaphore()
+
+    async def send(targets, payload):
+        try:
+            # acquire() may sleep for a token, so it stays off the event loop.
+            await run_in_executor(acquire, FIREBASE_BREAKER, firebase_credential, len(targets))
+        except RateLimited as e:
+            return deferred_results(targets, e)
+        async with semaphore:
+            if isinstance(payload, messaging.MulticastMessage):
+                batch_response = await messaging.send_each_for_multicast_async(payload, app=app)
+            else:
+                batch_response = await messaging.send_each_async(payload, app=app)
+        return push_batch_results(targets, batch_response)
+
+    # The App is held until every call is done, so an eviction meanwhile cannot delete it.
+    app = await run_in_executor(acquire_firebase_app, firebase_credential)
+    try:
+        batches = await asyncio.gather(*(send(targets, payload) for targets, payload
+                                         in push_batches(notification, tokens, topics, condition)))
+    finally:
+        release_firebase_app(app)
+    return [result for batch_results in batches for result in batch_results]
+
+
+async def _asend_mail(email_record, deliveries, now):
+    # anymail has no async API: the chunks are sent on the shared executor,
+    # holding one slot of the send semaphore per record.
+    routes, chunks = await sync_to_async(mail_chunks)(email_record, deliveries)
+    async with get_semaphore():
+        await run_in_executor(send_mail_chunks, email_record, routes, chunks, now)
+
+
+async def _asend_push(email_record, deliveries, now):
+    results = []
+    errors = []
+    groups = await sync_to_async(push_groups)(email_record, deliveries)
+    for (title, body), group in groups:
+        tokens, topics, condition = push_targets(group)
+        try:
+            with timed_send('push', FIREBASE_BREAKER):
+                group_results = await acall_with_breaker(FIREBASE_BREAKER, asend_push, title, body, tokens,
+                                                         topics, condition, email_record.firebase_credential)
+        except Exception as e:
+            errors.append(str(e))
+            push_failed(email_record, group, e, now)
+            continue
+        apply_push_results(group, group_results, now)
+        results.extend(group_results)
+    return summarize_push_results(results) if results else '; '.join(errors)
+
+
+async def adeliver_email(email_record, deliveries=None):
+    """
+    deliver_email on the event loop, with the same outcomes.
+
+    Queries run through sync_to_async, mail goes out on the shared executor
+    and push through firebase_admin's async API, so many records can be
+    delivered concurrently by one process. Everything is updated in memory
+    only; save it as for deliver_email.
+    """
+    if deliveries is None:
+        deliveries = [delivery async for delivery in email_record.deliveries.filter(status='pending')]
+    if not deliveries:
+        if not await email_record.deliveries.aexists():
+            email_record.sent_mail_status = 'failed'
+            return ['sent_mail_status']
+        return []
+
+    now = timezone.now()
+    email_deliveries, push_deliveries = await sync_to_async(screen_deliveries)(email_record, deliveries, now)
+    updated_fields = ['sent_mail_status']
+
+    sends = []
+    if email_deliveries:
+        _start_attempt(email_deliveries, now)
+        sends.append(_asend_mail(email_record, email_deliveries, now))
+    if push_deliveries:
+        _start_attempt(push_deliveries, now)
+        sends.append(_asend_push(email_record, push_deliveries, now))
+    # Mail and push go out concurrently, each with its own outcome.
+    results = await asyncio.gather(*sends)
+    if push_deliveries:
+        email_record.firebase_response = results[-1]
+        updated_fields.append('firebase_response')
+
+    email_record.sent_mail_status = aggregate_status({delivery.status for delivery in deliveries})
+    return updated_fields
+
+
+async def adeliver_emails(email_records, deliveries):
+    """
+    Deliver the records concurrently, each with its deliveries from the given
+    list and under the trace of the request that created it.
+    """
+    deliveries_by_email = defaultdict(list)
+    for delivery in deliveries:
+        deliveries_by_email[delivery.email_id].append(delivery)
+
+    async def deliver(email_record):
+        with resume(email_record.trace_id, email_id=email_record.id):
+            await adeliver_email(email_record, deliveries_by_email[email_record.id])
+
+    await asyncio.gather(*(deliver(email_record) for email_record in email_records))
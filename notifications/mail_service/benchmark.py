@@ -0,0 +1,127 @@
+# benchmark.py
+
+import json
+import random
+import threading
+import time
+import uuid
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from anymail.backends.base import AnymailBaseBackend
+from anymail.backends.test import TestPayload
+from anymail.exceptions import AnymailAPIError
+from anymail.message import AnymailRecipientStatus
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+
+class EmailBackend(AnymailBaseBackend):
+    """
+    Offline stand-in for a provider's anymail backend, used by bench_send.
+
+    Builds the payload as a real backend does, then instead of the API call
+    waits `latency` seconds and fails `error_rate` of the calls with an
+    HTTP 503. Both are class attributes, so they hold for every instance
+    the backend cache builds.
+    """
+
+    esp_name = 'Benchmark'
+    latency = 0.0
+    error_rate = 0.0
+
+    def __init__(self, api_key=None, **kwargs):
+        super().__init__(**kwargs)
+
+    def build_message_payload(self, message, defaults):
+        return TestPayload(backend=self, message=message, defaults=defaults)
+
+    def post_to_esp(self, payload, message):
+        time.sleep(self.latency)
+        if random.random() < self.error_rate:
+            # A response object, as the real backends attach, which AnymailAPIError's message is built from.
+            response = requests.Response()
+            response.status_code = 503
+            response.reason = 'Service Unavailable'
+            response._content = b'{"error": "Benchmark provider error"}'
+            raise AnymailAPIError("Benchmark provider error", status_code=503, response=response, backend=self)
+        return {address: AnymailRecipientStatus(message_id=uuid.uuid4().hex, status='queued')
+                for address in payload.recipient_emails}
+
+    def parse_recipient_status(self, response, payload, message):
+        return response
+
+
+class FakeFCMServer:
+    """
+    Local HTTP stand-in for the FCM v1 send API and Google's OAuth token
+    endpoint, used by bench_send.
+
+    Every send waits `latency` seconds, and `error_rate` of them get a 429
+    QUOTA_EXCEEDED, which firebase-admin does not retry on its own. Point
+    firebase-admin at fcm_url, with a credential from service_account_json().
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0):
+        self.latency = latency
+        self.error_rate = error_rate
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                if self.path == '/token':
+                    self.reply(200, {'access_token': 'benchmark', 'token_type': 'Bearer', 'expires_in': 3600})
+                    return
+                time.sleep(fake.latency)
+                if random.random() < fake.error_rate:
+                    self.reply(429, {'error': {
+                        'code': 429, 'message': 'Quota exceeded.', 'status': 'RESOURCE_EXHAUSTED',
+                        'details': [{'@type': 'type.googleapis.com/google.firebase.fcm.v1.FcmError',
+                                     'errorCode': 'QUOTA_EXCEEDED'}],
+                    }})
+                    return
+                project_id = self.path.split('/')[3]
+                self.reply(200, {'name': f'projects/{project_id}/messages/{uuid.uuid4().hex}'})
+
+            def reply(self, status, body):
+                content = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self.httpd.server_port}'
+        # Format string for firebase-admin's _MessagingService.FCM_URL.
+        self.fcm_url = self.url + '/v1/projects/{0}/messages:send'
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def service_account_json(self, project_id='benchmark'):
+        """A service-account file with a throwaway key whose OAuth tokens come from this server."""
+        key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                                serialization.NoEncryption()).decode()
+        return json.dumps({
+            'type': 'service_account',
+            'project_id': project_id,
+            'private_key_id': 'benchmark',
+            'private_key': pem,
+            'client_email': f'firebase@{project_id}.iam.gserviceaccount.com',
+            'client_id': '1',
+            'token_uri': f'{self.url}/token',
+        }).encode()
@@ -0,0 +1,205 @@
+# cache.py
+
+import threading
+import time
+from collections import OrderedDict
+
+
+# Marks a held value that is still in the cache, so its last release() leaves it open.
+_CACHED = object()
+
+
+class LRUCache:
+    """
+    Thread-safe, size-bounded LRU cache with optional idle expiry.
+
+    on_evict(key, value) is called for every entry that leaves the cache,
+    whether it was pushed out by size, expired or cleared, so owners can
+    release resources such as HTTP sessions. A value taken with acquire()
+    is only passed to on_evict once every holder has released it, so it is
+    never closed while another thread is still sending through it.
+    on_lookup(hit) is called for every lookup, e.g. to export the hit rate.
+
+    A missing value is built by factory() outside the cache-wide lock, with
+    one build per key at a time, so a slow build only holds up lookups of
+    its own key.
+    """
+
+    def __init__(self, max_size, idle_timeout=None, on_evict=None, on_lookup=None):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.on_evict = on_evict
+        self.on_lookup = on_lookup
+        self._entries = OrderedDict()  # key -> (value, last_used)
+        self._building = {}  # key -> lock held while factory() builds its value
+        self._leases = {}  # id(value) -> [value, holders, _CACHED or the key it was evicted under]
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        """Whether key is cached, without counting a lookup or refreshing the entry."""
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key):
+        return self.get_or_create(key, None)
+
+    def get_or_create(self, key, factory):
+        """Return the cached value for key, building it with factory() on a miss."""
+        return self._get_or_create(key, factory, pin=False)
+
+    def acquire(self, key, factory):
+        """get_or_create() that also holds the value open until release(value)."""
+        return self._get_or_create(key, factory, pin=True)
+
+    def release(self, value):
+        """Give back a value from acquire(); closes it if it was evicted while held."""
+        with self._lock:
+            lease = self._leases[id(value)]
+            lease[1] -= 1
+            if lease[1]:
+                return
+            del self._leases[id(value)]
+        if lease[2] is not _CACHED:
+            self._release([(lease[2], value)])
+
+    def set(self, key, value):
+        """Insert or replace the value for key."""
+        with self._lock:
+            now = time.monotonic()
+            evicted = self._pop_idle(now)
+            previous = self._entries.pop(key, None)
+            if previous is not None and previous[0] is not value:
+                evicted.append((key, previous[0]))
+            self._entries[key] = (value, now)
+            if id(value) in self._leases:
+                self._leases[id(value)][2] = _CACHED
+            evicted.extend(self._pop_oldest())
+            closing = self._retire(evicted)
+        self._release(closing)
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            closing = self._retire([(key, entry[0])] if entry is not None else [])
+        self._release(closing)
+
+    def evict_idle(self):
+        """Drop entries that have not been used within idle_timeout."""
+        with self._lock:
+            evicted = self._pop_idle(time.monotonic())
+            closing = self._retire(evicted)
+        self._release(closing)
+        return len(evicted)
+
+    def clear(self):
+        with self._lock:
+            evicted = [(key, value) for key, (value, _) in self._entries.items()]
+            self._entries.clear()
+            closing = self._retire(evicted)
+        self._release(closing)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def _get_or_create(self, key, factory, pin):
+        with self._lock:
+            now = time.monotonic()
+            closing = self._retire(self._pop_idle(now))
+            value = self._touch(key, now, pin)
+            if self.on_lookup is not None:
+                self.on_lookup(value is not None)
+            if value is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+                building = self._building.setdefault(key, threading.Lock())
+        # Release resources outside the lock so a slow close never blocks lookups.
+        self._release(closing)
+        if value is not None or factory is None:
+            return value
+
+        with building:
+            with self._lock:
+                # Another thread may have built it while this one waited.
+                value = self._touch(key, time.monotonic(), pin)
+            if value is not None:
+                return value
+            try:
+                value = factory()
+            except BaseException:
+                with self._lock:
+                    if self._building.get(key) is building:
+                        del self._building[key]
+                raise
+            with self._lock:
+                self._entries[key] = (value, time.monotonic())
+                if pin:
+                    self._pin(value)
+                if self._building.get(key) is building:
+                    del self._building[key]
+                closing = self._retire(self._pop_oldest())
+        self._release(closing)
+        return value
+
+    def _touch(self, key, now, pin):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        self._entries[key] = (entry[0], now)
+        self._entries.move_to_end(key)
+        if pin:
+            self._pin(entry[0])
+        return entry[0]
+
+    def _pin(self, value):
+        lease = self._leases.setdefault(id(value), [value, 0, _CACHED])
+        lease[1] += 1
+
+    def _retire(self, evicted):
+        """The evicted entries to close now; held ones are closed by their last release()."""
+        closing = []
+        for key, value in evicted:
+            lease = self._leases.get(id(value))
+            if lease is None:
+                closing.append((key, value))
+            else:
+                lease[2] = key
+        return closing
+
+    def _pop_idle(self, now):
+        if not self.idle_timeout:
+            return []
+        evicted = []
+        # Entries are kept in least-recently-used order, so stop at the first fresh one.
+        while self._entries:
+            key, (value, last_used) = next(iter(self._entries.items()))
+            if now - last_used < self.idle_timeout:
+                break
+            del self._entries[key]
+            self.evictions += 1
+            evicted.append((key, value))
+        return evicted
+
+    def _pop_oldest(self):
+        evicted = []
+        while len(self._entries) > self.max_size:
+            old_key, (old_value, _) = self._entries.popitem(last=False)
+            self.evictions += 1
+            evicted.append((old_key, old_value))
+        return evicted
+
+    def _release(self, evicted):
+        if self.on_evict is None:
+            return
+        for key, value in evicted:
+            self.on_evict(key, value)
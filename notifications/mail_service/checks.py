@@ -0,0 +1,48 @@
+# checks.py
+
+import os
+from django.conf import settings
+from django.core import checks
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+
+
+@checks.register()
+def check_fair_share(app_configs, **kwargs):
+    """The fair-share quantum and tenant weights must be positive, or a tenant would never be given a slot."""
+    errors = []
+    if settings.MAIL_SERVICE_FAIR_SHARE_QUANTUM <= 0:
+        errors.append(checks.Error("MAIL_SERVICE_FAIR_SHARE_QUANTUM must be positive.", id='mail_service.E001'))
+    for tenant, weight in settings.MAIL_SERVICE_TENANT_WEIGHTS.items():
+        if not isinstance(weight, (int, float)) or weight <= 0:
+            errors.append(checks.Error(f"MAIL_SERVICE_TENANT_WEIGHTS[{tenant!r}] must be a positive number.",
+                                       id='mail_service.E002'))
+    return errors
+
+
+@checks.register(checks.Tags.security)
+def check_webhook_secret(app_configs, **kwargs):
+    """Without ANYMAIL_WEBHOOK_SECRET, the tracking webhooks answer 403 (see webhooks.require_webhook_secret)."""
+    if settings.ANYMAIL.get('WEBHOOK_SECRET'):
+        return []
+    return [checks.Warning("ANYMAIL_WEBHOOK_SECRET is not set, so the tracking webhooks reject every request.",
+                           hint="Set it to the user:password in the provider's webhook URL.",
+                           id='mail_service.W001')]
+
+
+@checks.register()
+def check_metrics_cache(app_configs, **kwargs):
+    """
+    The queue depths on /metrics are counted by the scheduler and read by
+    the web processes, so MAIL_SERVICE_METRICS_CACHE must be shared between
+    them. A local-memory cache only works with everything in one process.
+    """
+    if not isinstance(caches[settings.MAIL_SERVICE_METRICS_CACHE], (LocMemCache, DummyCache)):
+        return []
+    message = "MAIL_SERVICE_METRICS_CACHE is per process, so /metrics only sees the queue depths counted in it."
+    hint = "Point it at a cache shared by the scheduler and web processes, such as Redis."
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        # Metrics are explicitly summed over several processes, so per-process depths are wrong for certain.
+        return [checks.Error(message, hint=hint, id='mail_service.E003')]
+    return [checks.Warning(message, hint=hint, id='mail_service.W002')]
@@ -0,0 +1,59 @@
+# concurrency.py
+
+import asyncio
+import contextvars
+import threading
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.db import connections
+
+_executor = None
+_executor_lock = threading.Lock()
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def get_executor():
+    """The process-wide pool of MAIL_SERVICE_SEND_THREADS threads for blocking provider calls."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.MAIL_SERVICE_SEND_THREADS,
+                                           thread_name_prefix='mail-send')
+        return _executor
+
+
+def get_semaphore():
+    """
+    The running event loop's send semaphore, which caps its in-flight
+    provider calls at MAIL_SERVICE_ASYNC_CONCURRENCY. An asyncio semaphore
+    belongs to one loop, and async_to_sync may start a new loop per call.
+    """
+    loop = asyncio.get_running_loop()
+    semaphore = _semaphores.get(loop)
+    if semaphore is None:
+        semaphore = _semaphores[loop] = asyncio.Semaphore(settings.MAIL_SERVICE_ASYNC_CONCURRENCY)
+    return semaphore
+
+
+def _run(func, *args):
+    """
+    Call func on an executor thread, then close the database connections it
+    opened there, e.g. acquire() on a database-backed rate limit store, as
+    no request or task ever closes them on this thread.
+    """
+    try:
+        return func(*args)
+    finally:
+        connections.close_all()
+
+
+def submit(func, *args):
+    """Run func on the shared executor in a copy of the caller's context, so it stays in the request trace."""
+    return get_executor().submit(contextvars.copy_context().run, _run, func, *args)
+
+
+async def run_in_executor(func, *args):
+    """Await a blocking call on the shared executor without holding up the event loop."""
+    return await asyncio.get_running_loop().run_in_executor(get_executor(), contextvars.copy_context().run,
+                                                            _run, func, *args)
@@ -0,0 +1,482 @@
+# delivery.py
+
+import datetime
+import json
+import logging
+from anymail.message import AnymailMessage
+from django.conf import settings
+from django.db.models import Exists, OuterRef
+from django.utils import timezone
+from .models import Delivery, Email
+from .concurrency import submit
+from .email_backends import BATCH_SEND_LIMITS
+from .email_service import credentials_fingerprint, email_backend
+from .firebase_service import firebase_app
+from .metrics import SEND_ERRORS, timed_send
+from .ratelimit import RateLimited, acquire
+from .rendering import mail_groups, push_groups
+from .suppression import suppressed_targets
+from .retry import TRANSIENT, call_with_breaker, classify_error, backoff_delay
+from .router import email_routes, send_with_failover
+
+logger = logging.getLogger(__name__)
+
+# Largest number of messages FCM accepts in one send_each call.
+FCM_BATCH_SIZE = 500
+
+# anymail recipient statuses that mean the provider will not deliver the message.
+ANYMAIL_FAILED_STATUSES = {'invalid', 'rejected', 'failed', 'bounced'}
+# Of those, the ones that will fail the same way on every later send.
+ANYMAIL_SUPPRESS_STATUSES = {'invalid', 'rejected', 'bounced'}
+
+# Delivery.channel -> the target type reported by send_push.
+PUSH_RESULT_TYPES = {'push': 'token', 'topic': 'topic', 'condition': 'condition'}
+
+DELIVERY_UPDATE_FIELDS = ['status', 'provider_message_id', 'error', 'attempts', 'updated_at', 'sent_at',
+                          'next_attempt_at', 'provider']
+
+# Circuit breaker name used for all Firebase calls.
+FIREBASE_BREAKER = 'Firebase'
+
+
+def send_email_message(subject, message, recipient_list, email_backend, html_message='', batch=False):
+    """
+    Send one message through an anymail backend and return its anymail_status.
+
+    With batch, every to address gets its own individually addressed copy
+    from a single API call, and the status has a message id per recipient.
+    """
+    # Create the email message
+    email = AnymailMessage(
+        subject=subject,
+        body=message,
+        from_email=settings.DEFAULT_FROM_EMAIL,
+        to=recipient_list,
+        connection=email_backend
+    )
+    if html_message:
+        email.attach_alternative(html_message, 'text/html')
+    if batch and len(recipient_list) > 1:
+        # An empty merge_data turns on the provider's batch sending without merge fields.
+        email.merge_data = {}
+    # Send the email
+    email.send()
+    return email.anymail_status
+
+
+def _push_result(target_type, target, send_response):
+    from firebase_admin import messaging
+
+    result = {'type': target_type, 'target': target, 'success': send_response.success}
+    if send_response.success:
+        result['message_id'] = send_response.message_id
+    else:
+        result['error'] = str(send_response.exception)
+        SEND_ERRORS.labels('push', FIREBASE_BREAKER, type(send_response.exception).__name__).inc()
+        result['transient'] = classify_error(send_response.exception) == TRANSIENT
+        # Unregistered tokens will never succeed again and should be pruned.
+        result['unregistered'] = isinstance(send_response.exception, messaging.UnregisteredError)
+    return result
+
+
+def push_batches(notification, tokens, topics, condition):
+    """
+    The FCM calls for one push, FCM_BATCH_SIZE targets each, as (targets, payload)
+    pairs: tokens go out as a MulticastMessage for send_each_for_multicast and
+    topic/condition targets as a list of Messages for send_each.
+    """
+    # firebase_admin is imported on the first push, so processes that only send mail never load it.
+    from firebase_admin import messaging
+
+    batches = []
+    for start in range(0, len(tokens), FCM_BATCH_SIZE):
+        chunk = tokens[start:start + FCM_BATCH_SIZE]
+        batches.append(([('token', token) for token in chunk],
+                        messaging.MulticastMessage(notification=notification, tokens=chunk)))
+
+    targets = [('topic', topic) for topic in topics]
+    if condition:
+        targets.append(('condition', condition))
+    for start in range(0, len(targets), FCM_BATCH_SIZE):
+        chunk = targets[start:start + FCM_BATCH_SIZE]
+        batches.append((chunk, [messaging.Message(notification=notification, **{target_type: target})
+                                for target_type, target in chunk]))
+    return batches
+
+
+def push_batch_results(targets, batch_response):
+    return [_push_result(target_type, target, send_response)
+            for (target_type, target), send_response in zip(targets, batch_response.responses)]
+
+
+def deferred_results(targets, error):
+    """send_push results for targets a RateLimited error held back, which apply_push_results() defers."""
+    return [{'type': target_type, 'target': target, 'success': False, 'error': str(error), 'transient': True,
+             'retry_in': error.wait} for target_type, target in targets]
+
+
+def send_push(subject, message, tokens, topics, condition, firebase_credential):
+    """
+    Send a push notification to device tokens, topics and/or a condition.
+
+    Makes the FCM calls from push_batches() one after the other, each taking
+    one token per target from the credential's rate limit, and returns one
+    result dict per target. Once the limit is reached, the remaining targets
+    get deferred_results() while those already sent keep theirs.
+    """
+    from firebase_admin import messaging
+
+    notification = messaging.Notification(title=subject, body=message)
+    results = []
+    batches = push_batches(notification, tokens, topics, condition)
+    with firebase_app(firebase_credential) as app:
+        for index, (targets, payload) in enumerate(batches):
+            try:
+                acquire(FIREBASE_BREAKER, firebase_credential, len(targets))
+            except RateLimited as e:
+                for rest, _ in batches[index:]:
+                    results.extend(deferred_results(rest, e))
+                break
+            if isinstance(payload, messaging.MulticastMessage):
+                batch_response = messaging.send_each_for_multicast(payload, app=app)
+            else:
+                batch_response = messaging.send_each(payload, app=app)
+            results.extend(push_batch_results(targets, batch_response))
+    return results
+
+
+def summarize_push_results(results):
+    """
+    JSON summary of send_push results, stored in Email.firebase_response:
+    the counts, the targets that failed and the unregistered tokens to prune.
+    Successes are only counted, so a fan-out to many thousands of targets
+    does not store a result per target; each delivery keeps its own.
+    """
+    success_count = sum(1 for result in results if result['success'])
+    deferred_count = sum(1 for result in results if 'retry_in' in result)
+    failures = [result for result in results if not result['success'] and 'retry_in' not in result]
+    return json.dumps({
+        'success_count': success_count,
+        'failure_count': len(failures),
+        'deferred_count': deferred_count,
+        'unregistered_tokens': [result['target'] for result in failures if result.get('unregistered')],
+        'failures': [{'type': result['type'], 'target': result['target'], 'error': result['error']}
+                     for result in failures],
+    })
+
+
+def split_targets(value):
+    return [target for target in (value or '').split(',') if target]
+
+
+def build_deliveries(email_record, recipient_contexts=None):
+    """
+    Unsaved Delivery rows for every recipient of a new Email record, for bulk_create.
+
+    recipient_contexts maps (channel, address) to that recipient's template context.
+    """
+    recipient_contexts = recipient_contexts or {}
+    deliveries = []
+    if email_record.mail_action:
+        deliveries.extend(Delivery(email=email_record, channel='email', address=address,
+                                   context=recipient_contexts.get(('email', address), {}))
+                          for address in split_targets(email_record.recipient_list))
+    if email_record.firebase_action:
+        deliveries.extend(Delivery(email=email_record, channel='push', address=token,
+                                   context=recipient_contexts.get(('push', token), {}))
+                          for token in split_targets(email_record.token))
+        deliveries.extend(Delivery(email=email_record, channel='topic', address=topic)
+                          for topic in split_targets(email_record.topics))
+        if email_record.condition:
+            deliveries.append(Delivery(email=email_record, channel='condition', address=email_record.condition))
+    return deliveries
+
+
+def _mark_sent(delivery, now, provider_message_id=''):
+    delivery.status = 'sent'
+    delivery.provider_message_id = provider_message_id or ''
+    delivery.error = ''
+    delivery.sent_at = now
+    delivery.next_attempt_at = None
+
+
+def _mark_failed(delivery, error, now, transient=False):
+    """Fail a delivery, or park it for a retry if the error is transient and attempts remain."""
+    delivery.error = error
+    if transient and delivery.attempts < settings.MAIL_SERVICE_RETRY_MAX_ATTEMPTS:
+        delivery.status = 'retrying'
+        delivery.next_attempt_at = now + datetime.timedelta(seconds=backoff_delay(delivery.attempts))
+    else:
+        delivery.status = 'failed'
+        delivery.next_attempt_at = None
+
+
+def _start_attempt(deliveries, now):
+    for delivery in deliveries:
+        delivery.attempts += 1
+        delivery.updated_at = now
+
+
+def _defer(deliveries, error, now, started=True, wait=None):
+    """
+    Hold deliveries back until the rate limit allows them, error.wait seconds
+    unless wait is given; a deferred send does not use up an attempt.
+    """
+    wait = error.wait if wait is None else wait
+    for delivery in deliveries:
+        if started:
+            delivery.attempts -= 1
+        delivery.updated_at = now
+        delivery.status = 'retrying'
+        delivery.error = str(error)
+        delivery.next_attempt_at = now + datetime.timedelta(seconds=wait)
+
+
+def apply_email_status(deliveries, anymail_status, now):
+    """Copy anymail's per-recipient status onto the email deliveries."""
+    recipients = anymail_status.recipients if anymail_status is not None else {}
+    for delivery in deliveries:
+        recipient_status = recipients.get(delivery.address)
+        if recipient_status is not None and recipient_status.status in ANYMAIL_FAILED_STATUSES:
+            _mark_failed(delivery, f"Rejected by provider: {recipient_status.status}", now)
+            if recipient_status.status in ANYMAIL_SUPPRESS_STATUSES:
+                delivery.suppression_reason = recipient_status.status
+        else:
+            _mark_sent(delivery, now, recipient_status.message_id if recipient_status is not None else '')
+
+
+def apply_push_results(deliveries, results, now):
+    """Copy send_push results onto the push deliveries they belong to."""
+    results_by_target = {(result['type'], result['target']): result for result in results}
+    for delivery in deliveries:
+        result = results_by_target.get((PUSH_RESULT_TYPES[delivery.channel], delivery.address))
+        if result is None:
+            _mark_failed(delivery, "No result returned by Firebase.", now)
+        elif result['success']:
+            _mark_sent(delivery, now, result['message_id'])
+        elif 'retry_in' in result:
+            _defer([delivery], result['error'], now, wait=result['retry_in'])
+        else:
+            _mark_failed(delivery, result['error'], now, transient=result['transient'])
+            if result.get('unregistered'):
+                delivery.suppression_reason = 'unregistered'
+
+
+def batch_size(routes):
+    """
+    Recipients per provider call that every route can take as one batch send.
+
+    Chunks are cut before failover, so a chunk that fails over is sent again
+    whole and never partly twice.
+    """
+    limits = [BATCH_SEND_LIMITS[route.service_name] for route in routes if route.service_name in BATCH_SEND_LIMITS]
+    return min(limits + [settings.MAIL_SERVICE_BATCH_SEND_SIZE])
+
+
+def aggregate_status(statuses):
+    """Email.sent_mail_status for a record whose deliveries have the given statuses."""
+    if 'sent' in statuses:
+        return 'sent'
+    if 'retrying' in statuses or 'pending' in statuses:
+        return 'pending'
+    return 'failed'
+
+
+def stored_statuses(email_ids):
+    """
+    {email id: sent_mail_status} from all of each record's saved deliveries.
+
+    A pass may have sent only some of a record's deliveries (a retry, or one
+    chunk of an import), so its status comes from the database, with two
+    EXISTS subqueries per record rather than by reading every delivery.
+    """
+    deliveries = Delivery.objects.filter(email_id=OuterRef('pk'))
+    rows = (Email.objects.filter(id__in=email_ids)
+            .annotate(any_sent=Exists(deliveries.filter(status='sent')),
+                      any_waiting=Exists(deliveries.filter(status__in=['pending', 'retrying'])))
+            .values_list('id', 'any_sent', 'any_waiting'))
+    return {email_id: 'sent' if any_sent else 'pending' if any_waiting else 'failed'
+            for email_id, any_sent, any_waiting in rows}
+
+
+def refresh_sent_status(email_records, deliveries):
+    """
+    Set sent_mail_status on the records that had deliveries in this pass from
+    stored_statuses(). Call it once the deliveries are saved.
+    """
+    statuses = stored_statuses({delivery.email_id for delivery in deliveries})
+    for email_record in email_records:
+        if email_record.id in statuses:
+            email_record.sent_mail_status = statuses[email_record.id]
+
+
+def mail_chunks(email_record, deliveries):
+    """
+    The routes and the ((subject, text, html), deliveries) chunks to send the
+    email deliveries as: one per distinct rendering and batch_size() recipients.
+
+    This is the part of sending that reads the database.
+    """
+    routes = email_routes(email_record)
+    size = batch_size(routes)
+    chunks = [
+        (content, group[start:start + size])
+        for content, group in mail_groups(email_record, deliveries)
+        for start in range(0, len(group), size)
+    ]
+    return routes, chunks
+
+
+def send_mail_chunks(email_record, routes, chunks, now):
+    """
+    Send the chunks from mail_chunks() as batch sends, one provider call each.
+
+    Once the rate limit is hit, the remaining chunks are deferred instead
+    of being tried. It reads no records, so it can run on any thread; only
+    acquire() may query, with a database-backed rate limit store, and the
+    executor closes such connections after each call.
+    """
+    for index, ((subject, text, html), group) in enumerate(chunks):
+        addresses = [delivery.address for delivery in group]
+
+        def send_via(route):
+            acquire(route.service_name, credentials_fingerprint(route.credentials))
+            with email_backend(route.service_name, route.credentials) as backend:
+                # Providers without batch sending get the chunk as one shared To list, as before.
+                with timed_send('email', route.service_name):
+                    return call_with_breaker(route.service_name, send_email_message, subject, text, addresses,
+                                             backend, html_message=html,
+                                             batch=route.service_name in BATCH_SEND_LIMITS)
+
+        try:
+            route, anymail_status = send_with_failover(routes, send_via)
+        except RateLimited as e:
+            logger.info("Email %s deferred: %s", email_record.id, e)
+            for _, rest in chunks[index:]:
+                _defer(rest, e, now)
+            break
+        except Exception as e:
+            logger.warning("Email %s failed to send: %s", email_record.id, e)
+            transient = classify_error(e) == TRANSIENT
+            for delivery in group:
+                _mark_failed(delivery, str(e), now, transient=transient)
+            continue
+        for delivery in group:
+            delivery.provider = route.service_name
+        apply_email_status(group, anymail_status, now)
+
+
+def push_targets(group):
+    """The send_push tokens, topics and condition for a group of push deliveries."""
+    for delivery in group:
+        delivery.provider = FIREBASE_BREAKER
+    tokens = [delivery.address for delivery in group if delivery.channel == 'push']
+    topics = [delivery.address for delivery in group if delivery.channel == 'topic']
+    conditions = [delivery.address for delivery in group if delivery.channel == 'condition']
+    return tokens, topics, conditions[0] if conditions else ''
+
+
+def push_failed(email_record, group, error, now):
+    """Record the failure of the push for a push_groups() group."""
+    logger.warning("Push for email %s failed: %s", email_record.id, error)
+    transient = classify_error(error) == TRANSIENT
+    for delivery in group:
+        _mark_failed(delivery, str(error), now, transient=transient)
+
+
+def _send_push(email_record, groups, now):
+    """
+    Send the push_groups() groups, one send_push call each, which takes the
+    rate limit per FCM call. Returns the firebase_response.
+    """
+    results = []
+    errors = []
+    for (title, body), group in groups:
+        tokens, topics, condition = push_targets(group)
+        try:
+            with timed_send('push', FIREBASE_BREAKER):
+                group_results = call_with_breaker(FIREBASE_BREAKER, send_push, title, body, tokens, topics,
+                                                  condition, email_record.firebase_credential)
+        except Exception as e:
+            errors.append(str(e))
+            push_failed(email_record, group, e, now)
+            continue
+        apply_push_results(group, group_results, now)
+        results.extend(group_results)
+    return summarize_push_results(results) if results else '; '.join(errors)
+
+
+def screen_deliveries(email_record, deliveries, now):
+    """
+    Mark the deliveries to suppressed addresses and split the rest by channel.
+    Returns (email_deliveries, push_deliveries).
+    """
+    suppressed = suppressed_targets(email_record.tenant, {(delivery.channel, delivery.address)
+                                                          for delivery in deliveries})
+    for delivery in deliveries:
+        if (delivery.channel, delivery.address) in suppressed:
+            delivery.status = 'suppressed'
+            delivery.error = "Address is on the suppression list."
+            delivery.updated_at = now
+            delivery.next_attempt_at = None
+    sendable = [delivery for delivery in deliveries if delivery.status != 'suppressed']
+    return ([delivery for delivery in sendable if delivery.channel == 'email'],
+            [delivery for delivery in sendable if delivery.channel != 'email'])
+
+
+def deliver_email(email_record, deliveries=None):
+    """
+    Send the mail and/or push notification for an Email record and record
+    each recipient's outcome on its delivery.
+
+    Works through the given pending deliveries (by default all of the
+    record's pending ones): suppressed addresses are skipped, template
+    records are rendered per delivery, mail fails over across the
+    email_routes() and push goes through FCM, both channels in parallel and
+    each with its own outcome. Every provider call is rate limited and goes
+    through its circuit breaker; sends over the limit are deferred, and
+    transient errors are parked as 'retrying' for the scheduler to try again.
+
+    Everything is updated in memory only: the caller saves the deliveries
+    with bulk_update(DELIVERY_UPDATE_FIELDS), passes those flagged with a
+    suppression_reason to suppress_deliveries(), and saves the record with
+    the returned list of changed fields.
+    """
+    if deliveries is None:
+        deliveries = list(email_record.deliveries.filter(status='pending'))
+    if not deliveries:
+        if not email_record.deliveries.exists():
+            # Nothing to send to, so the record would otherwise stay 'pending' for good.
+            email_record.sent_mail_status = 'failed'
+            return ['sent_mail_status']
+        return []
+
+    now = timezone.now()
+    email_deliveries, push_deliveries = screen_deliveries(email_record, deliveries, now)
+    updated_fields = ['sent_mail_status']
+
+    # The records are read on this thread; only the provider calls run on the executor.
+    mail = None
+    if email_deliveries:
+        _start_attempt(email_deliveries, now)
+        routes, chunks = mail_chunks(email_record, email_deliveries)
+        if push_deliveries:
+            # The mail goes out on the shared executor while this thread sends the push,
+            # so the record takes as long as the slower channel.
+            mail = submit(send_mail_chunks, email_record, routes, chunks, now)
+        else:
+            send_mail_chunks(email_record, routes, chunks, now)
+
+    if push_deliveries:
+        _start_attempt(push_deliveries, now)
+        email_record.firebase_response = _send_push(email_record, push_groups(email_record, push_deliveries), now)
+        updated_fields.append('firebase_response')
+
+    if mail is not None:
+        mail.result()
+
+    # One failed recipient no longer fails the whole message; the per-recipient
+    # outcome lives on the deliveries. This covers only the given deliveries: callers that
+    # sent part of a record correct it with refresh_sent_status() once the deliveries are saved.
+    email_record.sent_mail_status = aggregate_status({delivery.status for delivery in deliveries})
+    return updated_fields
@@ -10,4 +10,19 @@ EMAIL_BACKEND_MAPPING = {
     'SendGrid': 'anymail.backends.sendgrid',
     'SparkPost': 'anymail.backends.sparkpost',
     'Unisender Go': 'anymail.backends.unisender_go',
-}
\ No newline at end of file
+}
+
+# Most recipients one batch send (anymail merge_data) can address in a single API call,
+# per the providers' API limits. Postal has no batch sending.
+BATCH_SEND_LIMITS = {
+    'Brevo': 1000,
+    'MailerSend': 500,
+    'Mailgun': 1000,
+    'Mailjet': 50,
+    'Mandrill': 1000,
+    'Postmark': 500,
+    'Resend': 100,
+    'SendGrid': 1000,
+    'SparkPost': 10000,
+    'Unisender Go': 500,
+}
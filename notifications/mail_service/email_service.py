@@ -1,10 +1,44 @@
 # email_service.py
 
+import hashlib
+import json
+import logging
+from contextlib import contextmanager
 from importlib import import_module
+from django.conf import settings
+from .cache import LRUCache
 from .email_backends import EMAIL_BACKEND_MAPPING
+from .metrics import CLIENT_INIT_SECONDS, cache_lookup
+from .tracing import phase
 
+logger = logging.getLogger(__name__)
 
-def get_dynamic_email_backend(service_name, credentials):
+
+def _close_backend(key, backend):
+    try:
+        backend.close()
+    except Exception as e:
+        logger.warning("Error closing email backend %s: %s", key[0], e)
+
+
+# Open backends keyed on (service name, credentials hash). Each backend keeps
+# its requests session, so repeat sends reuse pooled keep-alive connections.
+backend_cache = LRUCache(
+    max_size=settings.MAIL_SERVICE_BACKEND_CACHE_SIZE,
+    idle_timeout=settings.MAIL_SERVICE_BACKEND_IDLE_TIMEOUT,
+    on_evict=_close_backend,
+    on_lookup=cache_lookup('email_backend'),
+)
+
+
+def credentials_fingerprint(credentials):
+    """Stable hash of a credentials dict, so raw keys are never used as cache keys."""
+    payload = json.dumps(credentials, sort_keys=True).encode()
+    return hashlib.sha256(payload).hexdigest()
+
+
+def build_email_backend(service_name, credentials):
+    """Build a new, unopened anymail backend for the given service."""
     if service_name not in EMAIL_BACKEND_MAPPING:
         raise ValueError(f"Unsupported email service: {service_name}")
 
@@ -21,3 +55,37 @@ def get_dynamic_email_backend(service_name, credentials):
             return backend_class.EmailBackend(server_token=credentials.get('api_key'))
         case _:
             return backend_class.EmailBackend(api_key=credentials.get('api_key'))
+
+
+def _open_email_backend(service_name, credentials):
+    with CLIENT_INIT_SECONDS.labels('email_backend').time(), phase('backend_build'):
+        backend = build_email_backend(service_name, credentials)
+        # An open backend keeps its session between sends instead of closing it after each one.
+        backend.open()
+    return backend
+
+
+def get_dynamic_email_backend(service_name, credentials):
+    """Return a cached, open backend for the service and credentials."""
+    if service_name not in EMAIL_BACKEND_MAPPING:
+        raise ValueError(f"Unsupported email service: {service_name}")
+
+    key = (service_name, credentials_fingerprint(credentials))
+    return backend_cache.get_or_create(key, lambda: _open_email_backend(service_name, credentials))
+
+
+@contextmanager
+def email_backend(service_name, credentials):
+    """
+    get_dynamic_email_backend() for the length of a send: if the cache drops
+    the backend meanwhile, it is only closed once the block exits.
+    """
+    if service_name not in EMAIL_BACKEND_MAPPING:
+        raise ValueError(f"Unsupported email service: {service_name}")
+
+    key = (service_name, credentials_fingerprint(credentials))
+    backend = backend_cache.acquire(key, lambda: _open_email_backend(service_name, credentials))
+    try:
+        yield backend
+    finally:
+        backend_cache.release(backend)
@@ -0,0 +1,107 @@
+# firebase_service.py
+
+import hashlib
+import json
+import logging
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from .cache import LRUCache
+from .metrics import CLIENT_INIT_SECONDS, cache_lookup
+from .tracing import phase
+
+logger = logging.getLogger(__name__)
+
+# Credentials live in default_storage, so workers on other hosts read the same files as the web process.
+CREDENTIALS_DIR = 'firebase'
+
+
+def _delete_app(fingerprint, app):
+    import firebase_admin
+
+    try:
+        firebase_admin.delete_app(app)
+    except ValueError as e:
+        logger.warning("Error deleting Firebase app %s: %s", fingerprint, e)
+
+
+# One named firebase_admin App per credential fingerprint. The App keeps its
+# OAuth token and HTTP transport, so repeat pushes skip both.
+firebase_app_cache = LRUCache(
+    max_size=settings.MAIL_SERVICE_FIREBASE_APP_CACHE_SIZE,
+    idle_timeout=settings.MAIL_SERVICE_FIREBASE_APP_IDLE_TIMEOUT,
+    on_evict=_delete_app,
+    on_lookup=cache_lookup('firebase_app'),
+)
+
+
+def credential_name(fingerprint):
+    return f"{CREDENTIALS_DIR}/{fingerprint}.json"
+
+
+def save_credential_file(file):
+    """
+    Store an uploaded service-account JSON under its sha256 fingerprint.
+
+    The same credentials always map to the same file, which is only written
+    the first time it is seen. Returns the fingerprint.
+    """
+    content = b''.join(file.chunks())
+    fingerprint = hashlib.sha256(content).hexdigest()
+
+    # An App for this fingerprint is already running, so the file exists. `in` is not counted as a cache lookup.
+    if fingerprint in firebase_app_cache:
+        return fingerprint
+
+    name = credential_name(fingerprint)
+    if not default_storage.exists(name):
+        saved = default_storage.save(name, ContentFile(content))
+        if saved != name:
+            # A concurrent upload stored the same content first; keep that one.
+            default_storage.delete(saved)
+    return fingerprint
+
+
+def load_credential(fingerprint):
+    """The stored service-account JSON for a fingerprint, as a dict."""
+    with default_storage.open(credential_name(fingerprint), 'rb') as stored:
+        return json.load(stored)
+
+
+def _initialize_app(fingerprint):
+    # firebase_admin and google-auth are imported with the first App, not when the module loads.
+    import firebase_admin
+    from firebase_admin import credentials
+
+    with CLIENT_INIT_SECONDS.labels('firebase_app').time(), phase('firebase_init'):
+        cred = credentials.Certificate(load_credential(fingerprint))
+        try:
+            return firebase_admin.initialize_app(cred, name=fingerprint)
+        except ValueError:
+            # Another cache entry for this name was dropped without deleting the App.
+            return firebase_admin.get_app(fingerprint)
+
+
+def get_firebase_app(fingerprint):
+    """Return the named Firebase App for a stored credential, initializing it once."""
+    return firebase_app_cache.get_or_create(fingerprint, lambda: _initialize_app(fingerprint))
+
+
+def acquire_firebase_app(fingerprint):
+    """get_firebase_app(), holding the App so it is not deleted until release_firebase_app()."""
+    return firebase_app_cache.acquire(fingerprint, lambda: _initialize_app(fingerprint))
+
+
+def release_firebase_app(app):
+    firebase_app_cache.release(app)
+
+
+@contextmanager
+def firebase_app(fingerprint):
+    """The Firebase App for a stored credential, held for the length of the block."""
+    app = acquire_firebase_app(fingerprint)
+    try:
+        yield app
+    finally:
+        release_firebase_app(app)
@@ -0,0 +1,77 @@
+# idempotency.py
+
+import datetime
+import hashlib
+import json
+from django.conf import settings
+from django.utils import timezone
+from .models import IdempotencyKey
+
+
+def request_hash(data):
+    """sha256 over the parts of a validated send request that decide what gets delivered."""
+    template = data.get('template')
+    content = {
+        'subject': data.get('subject'),
+        'message': data.get('message'),
+        'recipient_list': data.get('recipient_list'),
+        'tokens': data.get('tokens'),
+        'topics': data.get('topics'),
+        'condition': data.get('condition'),
+        'mail_action': data.get('mail_action'),
+        'firebase_action': data.get('firebase_action'),
+        'delivery_time': data.get('delivery_time'),
+        'template': template.id if template is not None else None,
+        'context': data.get('context'),
+        'recipient_contexts': sorted(
+            [channel, address, context] for (channel, address), context in data.get('recipient_contexts', {}).items()),
+    }
+    payload = json.dumps(content, sort_keys=True, default=str).encode()
+    return hashlib.sha256(payload).hexdigest()
+
+
+def get_key(request, data):
+    """
+    The request's Idempotency-Key header, or with MAIL_SERVICE_IDEMPOTENCY_CONTENT_HASH
+    a key derived from its content. Returns None when the request is not deduplicated.
+    """
+    key = request.headers.get('Idempotency-Key')
+    if key:
+        return key[:255]
+    if settings.MAIL_SERVICE_IDEMPOTENCY_CONTENT_HASH:
+        return 'content:' + request_hash(data)
+    return None
+
+
+def find_key(tenant, endpoint, key):
+    """The unexpired IdempotencyKey row for a key, or None."""
+    return IdempotencyKey.objects.filter(tenant=tenant, endpoint=endpoint, key=key,
+                                         expires_at__gt=timezone.now()).first()
+
+
+def record_key(tenant, endpoint, key, data, email_record):
+    """
+    Store a key for the Email record created for a request.
+
+    Call it in the transaction that creates the record: if a concurrent
+    request stored the same key first, the unique constraint raises
+    IntegrityError and rolling back discards the duplicate record.
+    """
+    now = timezone.now()
+    # An expired key that the purge has not removed yet would still hit the unique constraint.
+    IdempotencyKey.objects.filter(tenant=tenant, endpoint=endpoint, key=key, expires_at__lte=now).delete()
+    return IdempotencyKey.objects.create(
+        tenant=tenant, endpoint=endpoint, key=key, request_hash=request_hash(data), email=email_record,
+        expires_at=now + datetime.timedelta(seconds=settings.MAIL_SERVICE_IDEMPOTENCY_TTL),
+    )
+
+
+def purge_expired_keys(batch_size=1000):
+    """Delete expired keys in batches, keeping each delete short. Returns how many were deleted."""
+    deleted = 0
+    while True:
+        ids = list(IdempotencyKey.objects.filter(expires_at__lte=timezone.now())
+                   .values_list('id', flat=True)[:batch_size])
+        if not ids:
+            return deleted
+        deleted += IdempotencyKey.objects.filter(id__in=ids).delete()[0]
@@ -0,0 +1,180 @@
+# imports.py
+
+import csv
+import io
+import itertools
+import json
+import logging
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.utils import timezone
+from rest_framework import serializers
+from .lanes import enqueue
+from .models import Delivery, Email
+from .serializers import TemplateRecipientSerializer
+
+logger = logging.getLogger(__name__)
+
+# Import files live in default_storage, so the worker that streams one need not share a disk with the web process.
+IMPORTS_DIR = 'imports'
+
+IMPORT_PROGRESS_FIELDS = ['bytes_read', 'rows_read', 'rows_imported', 'rows_rejected', 'errors', 'updated_at']
+
+
+def import_name(recipient_import):
+    return f"{IMPORTS_DIR}/{recipient_import.id}.{recipient_import.format}"
+
+
+def save_import_file(file, recipient_import):
+    """
+    Store an uploaded recipient file where import_recipients_task reads it.
+
+    Django's upload handlers have already spooled a large upload to disk, and
+    the storage copies it chunk by chunk, so the file is never held in memory.
+    """
+    name = import_name(recipient_import)
+    # Left over from an earlier database whose ids were reused; the storage would otherwise rename the upload.
+    default_storage.delete(name)
+    default_storage.save(name, file)
+
+
+def _csv_rows(text):
+    reader = csv.DictReader(text)
+    for row in reader:
+        # Empty cells are left out, so a row can carry an email, a token or both.
+        yield reader.line_num, {key.strip(): value.strip() for key, value in row.items() if key and value}
+
+
+def _ndjson_rows(text):
+    for line_number, line in enumerate(text, 1):
+        if not line.strip():
+            continue
+        try:
+            yield line_number, json.loads(line)
+        except ValueError:
+            # Left for validation to reject as "Expected a dictionary".
+            yield line_number, line.strip()
+
+
+def _recipient(row):
+    """A TemplateRecipientSerializer row: the email and token, with every other field as merge context."""
+    if not isinstance(row, dict):
+        return row
+    row = dict(row)
+    recipient = {key: row.pop(key) for key in ('email', 'token') if key in row}
+    context = row.pop('context', {})
+    recipient['context'] = {**row, **context} if isinstance(context, dict) else context
+    return recipient
+
+
+def _import_chunk(recipient_import, email_record, rows, bytes_read):
+    """
+    Validate a chunk of (line number, row) pairs, insert its deliveries and
+    save the progress, in one transaction: a run that resumes from rows_read
+    never finds the deliveries of a chunk it has not counted.
+    """
+    validator = TemplateRecipientSerializer()
+    deliveries = []
+    for line_number, row in rows:
+        try:
+            recipient = validator.run_validation(_recipient(row))
+        except serializers.ValidationError as e:
+            errors = e.detail
+        else:
+            targets = []
+            if email_record.mail_action and 'email' in recipient:
+                targets.append(('email', recipient['email']))
+            if email_record.firebase_action and 'token' in recipient:
+                targets.append(('push', recipient['token']))
+            deliveries.extend(Delivery(email=email_record, channel=channel, address=address,
+                                       context=recipient['context'])
+                              for channel, address in targets)
+            if targets:
+                recipient_import.rows_imported += 1
+                continue
+            errors = ["No email or token for the chosen actions."]
+        recipient_import.rows_rejected += 1
+        if len(recipient_import.errors) < settings.MAIL_SERVICE_IMPORT_MAX_ERRORS:
+            recipient_import.errors.append({'line': line_number, 'errors': errors})
+
+    recipient_import.rows_read += len(rows)
+    recipient_import.bytes_read = bytes_read
+    with transaction.atomic():
+        Delivery.objects.bulk_create(deliveries, batch_size=1000)
+        recipient_import.save(update_fields=IMPORT_PROGRESS_FIELDS)
+
+
+def run_import(recipient_import):
+    """
+    Stream an import's file into Delivery rows of its Email.
+
+    Rows are read one at a time, validated like SendEmailSerializer
+    recipients and inserted MAIL_SERVICE_IMPORT_CHUNK_SIZE at a time, with
+    the progress saved after every chunk, so memory use does not grow with
+    the file. Invalid rows are counted and skipped. A task delivered again
+    after a worker died resumes after the rows_read already imported, and
+    one for an import that is no longer running does nothing. Returns True
+    once the whole file is imported.
+    """
+    if recipient_import.status != 'importing':
+        return False
+    email_record = recipient_import.email
+    chunk_size = settings.MAIL_SERVICE_IMPORT_CHUNK_SIZE
+    name = import_name(recipient_import)
+    try:
+        with default_storage.open(name, 'rb') as raw:
+            # utf-8-sig drops the byte order mark that spreadsheet exports often start with.
+            text = io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+            rows = _csv_rows(text) if recipient_import.format == 'csv' else _ndjson_rows(text)
+            # The rows before rows_read are parsed again, so line numbers stay right, but not imported again.
+            rows = itertools.islice(rows, recipient_import.rows_read, None)
+            chunk = []
+            for line_number, row in rows:
+                chunk.append((line_number, row))
+                if len(chunk) == chunk_size:
+                    _import_chunk(recipient_import, email_record, chunk, raw.tell())
+                    chunk = []
+            _import_chunk(recipient_import, email_record, chunk, recipient_import.size)
+    except (OSError, UnicodeDecodeError, csv.Error) as e:
+        logger.warning("Import %s failed: %s", recipient_import.id, e)
+        recipient_import.status = 'failed'
+        recipient_import.error = str(e)
+    else:
+        recipient_import.status = 'completed'
+    recipient_import.completed_at = timezone.now()
+    recipient_import.save(update_fields=['status', 'error', 'completed_at', 'updated_at'])
+
+    if recipient_import.status == 'failed' or not recipient_import.rows_imported:
+        # A file that could only be partly read sends nothing rather than part of the list.
+        email_record.deliveries.all().delete()
+        Email.objects.filter(id=email_record.id).update(sent_mail_status='failed')
+    default_storage.delete(name)
+    return recipient_import.status == 'completed' and recipient_import.rows_imported > 0
+
+
+def queue_import_deliveries(recipient_import):
+    """
+    Queue the pending deliveries of a completed import for sending,
+    MAIL_SERVICE_IMPORT_CHUNK_SIZE per task.
+
+    last_queued_id is saved after every chunk, so a task delivered again
+    after a worker died resumes after the chunks already queued, and finds
+    nothing to do once they all are. Returns the number of deliveries queued.
+    """
+    # Imported here because task.py imports this module for its import task.
+    from .task import send_deliveries_task
+
+    email_record = recipient_import.email
+    chunk_size = settings.MAIL_SERVICE_IMPORT_CHUNK_SIZE
+    queued = 0
+    while True:
+        delivery_ids = list(Delivery.objects.filter(email=email_record, status='pending',
+                                                    id__gt=recipient_import.last_queued_id)
+                            .order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not delivery_ids:
+            return queued
+        enqueue(send_deliveries_task, email_record.lane, email_record.id, delivery_ids)
+        queued += len(delivery_ids)
+        recipient_import.last_queued_id = delivery_ids[-1]
+        recipient_import.save(update_fields=['last_queued_id', 'updated_at'])
@@ -0,0 +1,82 @@
+# lanes.py
+
+from collections import OrderedDict
+from celery import current_app
+from django.conf import settings
+from .models import Email
+
+# In dispatch order: each scheduler sweep queues due transactional records first.
+LANES = [Email.TRANSACTIONAL, Email.BULK]
+
+
+def lane_queue(lane):
+    """The Celery queue a lane's delivery tasks go to, from MAIL_SERVICE_LANE_QUEUES."""
+    return settings.MAIL_SERVICE_LANE_QUEUES[lane]
+
+
+def enqueue(task, lane, *args, **kwargs):
+    """Queue a delivery task on its lane's queue, so bulk work never sits in front of transactional work."""
+    return task.apply_async(args, kwargs, queue=lane_queue(lane))
+
+
+def broker_depth(lane):
+    """Task messages waiting in the lane's broker queue, or None when the broker cannot say."""
+    if current_app.conf.task_always_eager:
+        return None
+    try:
+        with current_app.connection_for_read() as connection:
+            connection.ensure_connection(max_retries=1)
+            return connection.default_channel.queue_declare(lane_queue(lane), passive=True).message_count
+    except Exception:
+        # An unreachable broker, or a queue no worker has declared yet, leaves the depth out of the scrape.
+        return None
+
+
+def dispatch_limit(lane):
+    """Most records of the lane one scheduler sweep may queue, or None for no limit."""
+    return settings.MAIL_SERVICE_LANE_DISPATCH_LIMITS.get(lane)
+
+
+class FairShare:
+    """
+    Weighted deficit round robin over keys, such as the tenants with due records.
+
+    Every round, each key earns quantum * weight slots (weight 1 unless set
+    in weights) and takes whole slots from what it has earned. Unspent
+    credit carries over between calls and keys that were cut off go first
+    next time, so over many calls each busy key gets slots in proportion to
+    its weight, however large its backlog. A key that runs dry loses its
+    credit, as in DRR.
+    """
+
+    def __init__(self, quantum, weights=None):
+        self.quantum = quantum
+        self.weights = weights or {}
+        self._deficits = OrderedDict()  # key -> unspent credit, in round robin order
+
+    def allocate(self, keys, slots):
+        """Split up to `slots` slots between keys. Returns {key: slots}."""
+        keys = set(keys)
+        for key in [key for key in self._deficits if key not in keys]:
+            del self._deficits[key]
+        for key in sorted(keys - self._deficits.keys()):
+            self._deficits[key] = 0.0
+
+        allocation = dict.fromkeys(keys, 0)
+        if sum(self.weights.get(key, 1) for key in keys) <= 0:
+            return allocation
+        while slots > 0:
+            for key in list(self._deficits):
+                self._deficits[key] += self.quantum * self.weights.get(key, 1)
+                share = min(int(self._deficits[key]), slots)
+                allocation[key] += share
+                self._deficits[key] -= share
+                slots -= share
+                self._deficits.move_to_end(key)
+                if not slots:
+                    break
+        return allocation
+
+    def drained(self, key):
+        """Forget a key whose backlog ran out before it used its slots."""
+        self._deficits.pop(key, None)
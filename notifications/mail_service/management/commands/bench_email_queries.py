@@ -0,0 +1,91 @@
+import datetime
+import json
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from mail_service.models import Email
+
+
+class Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    help = ("Measure the Email status/schedule queries as the table grows. "
+            "Rows are inserted inside a transaction that is rolled back at the end.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--sizes', default='10000,100000,1000000',
+                            help="Comma-separated table sizes to measure at.")
+        parser.add_argument('--repeat', type=int, default=20, help="Runs per query; the median is reported.")
+        parser.add_argument('--output', help="Write the results as JSON to this file.")
+
+    def handle(self, *args, **options):
+        sizes = sorted(int(size) for size in options['sizes'].split(','))
+        self.results = []
+        try:
+            with transaction.atomic():
+                rows = 0
+                for size in sizes:
+                    self.insert_rows(rows, size)
+                    rows = size
+                    self.measure(size, options['repeat'])
+                raise Rollback()
+        except Rollback:
+            pass
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(self.results, output, indent=2)
+
+    def insert_rows(self, start, end, chunk_size=10000):
+        now = timezone.now()
+        statuses = ['sent'] * 90 + ['failed'] * 5 + ['pending'] * 5
+        for chunk_start in range(start, end, chunk_size):
+            emails = []
+            for _ in range(chunk_start, min(chunk_start + chunk_size, end)):
+                # About 1% of the table is scheduled, a tenth of which is due.
+                is_schedule = random.random() < 0.01
+                emails.append(Email(
+                    subject='Benchmark', message='Body', recipient_list='bench@example.com', token='',
+                    sent_mail_status='scheduled' if is_schedule else random.choice(statuses),
+                    is_schedule=is_schedule,
+                    delivery_time=now + datetime.timedelta(minutes=random.randint(-60, 540)) if is_schedule else None,
+                ))
+            Email.objects.bulk_create(emails, batch_size=1000)
+        # Backdate all but the newest 1000 rows so failed_since() selects a small recent slice.
+        newest_id = Email.objects.order_by('-id').values_list('id', flat=True).first()
+        Email.objects.filter(created_at__gte=now, id__lte=newest_id - 1000).update(
+            created_at=now - datetime.timedelta(days=30))
+
+    def measure(self, size, repeat):
+        since = timezone.now() - datetime.timedelta(days=1)
+        queries = {
+            'due': lambda: list(Email.objects.due().order_by('delivery_time').values_list('id', flat=True)[:1000]),
+            'pending': lambda: list(Email.objects.pending().order_by('created_at').values_list('id', flat=True)[:1000]),
+            'failed_since': lambda: list(Email.objects.failed_since(since).values_list('id', flat=True)),
+        }
+        plans = {
+            'due': Email.objects.due().order_by('delivery_time'),
+            'pending': Email.objects.pending().order_by('created_at'),
+            'failed_since': Email.objects.failed_since(since),
+        }
+        for name, query in queries.items():
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                query()
+                timings.append((time.perf_counter() - started) * 1000)
+            result = {
+                'rows': size,
+                'query': name,
+                'median_ms': round(statistics.median(timings), 3),
+                'plan': plans[name].explain(),
+            }
+            self.results.append(result)
+            self.stdout.write(f"{size:>10} rows  {name:<13} {result['median_ms']:>9.3f} ms  {result['plan']}")
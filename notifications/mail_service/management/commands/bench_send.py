@@ -0,0 +1,247 @@
+import datetime
+import itertools
+import json
+import statistics
+import threading
+import time
+import tracemalloc
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from celery import current_app
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from firebase_admin import messaging
+
+from mail_service.benchmark import EmailBackend, FakeFCMServer
+from mail_service.email_backends import BATCH_SEND_LIMITS, EMAIL_BACKEND_MAPPING
+from mail_service.email_service import backend_cache
+from mail_service.firebase_service import credential_name, firebase_app_cache
+from mail_service.models import Email, Suppression
+
+SCENARIOS = ['send_email', 'send_email_push', 'send_batch', 'schedule_notification', 'async_send_email']
+
+
+def percentile(ordered, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+class Command(BaseCommand):
+    help = ("Load-test the send endpoints offline, against a fake anymail backend and a local fake FCM "
+            "server, and report throughput, latency percentiles, queries and memory per request. "
+            "Celery runs eagerly, so each request includes its delivery. Uses the configured database; "
+            "the rows it creates are deleted at the end.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+                            help=f"Comma-separated scenarios to run, from: {', '.join(SCENARIOS)}.")
+        parser.add_argument('--requests', type=int, default=200, help="Requests per scenario.")
+        parser.add_argument('--concurrency', type=int, default=8, help="Requests in flight at once.")
+        parser.add_argument('--batch-size', type=int, default=50, help="Recipients per send_batch request.")
+        parser.add_argument('--email-latency', type=float, default=0.05, help="Seconds per fake email API call.")
+        parser.add_argument('--email-error-rate', type=float, default=0.0,
+                            help="Fraction of fake email API calls that fail with a 503.")
+        parser.add_argument('--fcm-latency', type=float, default=0.05, help="Seconds per fake FCM send.")
+        parser.add_argument('--fcm-error-rate', type=float, default=0.0,
+                            help="Fraction of fake FCM sends that fail with a 429.")
+        parser.add_argument('--memory-samples', type=int, default=20,
+                            help="Requests per scenario run one at a time under tracemalloc.")
+        parser.add_argument('--output', help="Write the results as JSON to this file.")
+
+    def handle(self, *args, **options):
+        scenarios = options['scenarios'].split(',')
+        unknown = set(scenarios) - set(SCENARIOS)
+        if unknown:
+            raise CommandError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+        self.options = options
+        self.tenant = f'bench-{uuid.uuid4().hex[:12]}'
+        self.counter = itertools.count()
+        self.counter_lock = threading.Lock()
+        fcm = FakeFCMServer(options['fcm_latency'], options['fcm_error_rate'])
+        self.service_account = fcm.service_account_json()
+        EmailBackend.latency = options['email_latency']
+        EmailBackend.error_rate = options['email_error_rate']
+        always_eager = current_app.conf.task_always_eager
+
+        results = {
+            'started_at': timezone.now().isoformat(),
+            'options': {key: options[key] for key in (
+                'requests', 'concurrency', 'batch_size', 'email_latency', 'email_error_rate',
+                'fcm_latency', 'fcm_error_rate', 'memory_samples')},
+            'scenarios': {},
+        }
+        fcm.start()
+        current_app.conf.task_always_eager = True
+        # Backends and Firebase apps built before the fakes were in place must not be reused.
+        backend_cache.clear()
+        firebase_app_cache.clear()
+        try:
+            # The test client sends requests for the host 'testserver'.
+            with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+                                   CELERY_TASK_ALWAYS_EAGER=True), \
+                    mock.patch.dict(EMAIL_BACKEND_MAPPING, {'Benchmark': 'mail_service.benchmark'}), \
+                    mock.patch.dict(BATCH_SEND_LIMITS, {'Benchmark': 1000}), \
+                    mock.patch.object(messaging._MessagingService, 'FCM_URL', fcm.fcm_url):
+                for name in scenarios:
+                    results['scenarios'][name] = self.run_scenario(name)
+        finally:
+            current_app.conf.task_always_eager = always_eager
+            backend_cache.clear()
+            firebase_app_cache.clear()
+            fcm.stop()
+            self.clean_up()
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def next_id(self):
+        with self.counter_lock:
+            return next(self.counter)
+
+    def headers(self):
+        return {
+            'HTTP_X_EMAIL_SERVICE': 'Benchmark',
+            'HTTP_X_EMAIL_SERVICE_API_KEY': 'benchmark',
+            'HTTP_X_TENANT_ID': self.tenant,
+        }
+
+    def send(self, client, name):
+        i = self.next_id()
+        if name == 'send_email':
+            return client.post(reverse('send_email'), {
+                'subject': 'Benchmark', 'message': 'Body', 'recipient_list': [f'user{i}@bench.example'],
+                'mail_action': True}, **self.headers())
+        if name == 'send_email_push':
+            return client.post(reverse('send_email'), {
+                'subject': 'Benchmark', 'message': 'Body', 'recipient_list': [f'user{i}@bench.example'],
+                'token': f'device-{i}', 'mail_action': True, 'firebase_action': True,
+                'credential_file': SimpleUploadedFile('credential.json', self.service_account)}, **self.headers())
+        if name == 'send_batch':
+            return client.post(reverse('send_batch'), json.dumps({
+                'template': {'subject': 'Benchmark', 'message': 'Body', 'mail_action': True},
+                'recipients': [{'recipient_list': [f'user{i}-{n}@bench.example']}
+                               for n in range(self.options['batch_size'])],
+            }), content_type='application/json', **self.headers())
+        if name == 'schedule_notification':
+            delivery_time = timezone.now() + datetime.timedelta(days=1)
+            return client.post(reverse('schedule_notification'), {
+                'subject': 'Benchmark', 'message': 'Body', 'recipient_list': [f'user{i}@bench.example'],
+                'mail_action': True, 'delivery_time': delivery_time.isoformat(),
+                # schedule_notification reads the provider from the body rather than the headers.
+                'email_service_name': 'Benchmark', 'email_service_api_key': 'benchmark'}, **self.headers())
+        return client.post(reverse('async_send_email'), json.dumps({
+            'subject': 'Benchmark', 'message': 'Body', 'recipient_list': [f'user{i}@bench.example'],
+            'mail_action': True}), content_type='application/json', **self.headers())
+
+    def timed_send(self, client, name):
+        """(status code or exception name, seconds, queries) for one request."""
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            try:
+                outcome = self.send(client, name).status_code
+            except Exception as e:
+                outcome = type(e).__name__
+            elapsed = time.perf_counter() - started
+        return outcome, elapsed, len(queries)
+
+    def run_worker(self, name, count):
+        client = Client()
+        try:
+            return [self.timed_send(client, name) for _ in range(count)]
+        finally:
+            # Each worker thread has its own database connection.
+            connection.close()
+
+    def run_scenario(self, name):
+        total = self.options['requests']
+        concurrency = max(1, min(self.options['concurrency'], total))
+        shares = [total // concurrency + (worker < total % concurrency) for worker in range(concurrency)]
+
+        # Warm up connection pools, the OAuth token and compiled code before timing anything.
+        self.timed_send(Client(), name)
+
+        started = time.perf_counter()
+        if concurrency == 1:
+            samples = [self.timed_send(Client(), name) for _ in range(total)]
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                samples = [sample for worker in executor.map(lambda share: self.run_worker(name, share), shares)
+                           for sample in worker]
+        duration = time.perf_counter() - started
+
+        outcomes = {}
+        for outcome, _, _ in samples:
+            outcomes[str(outcome)] = outcomes.get(str(outcome), 0) + 1
+        latencies = sorted(elapsed * 1000 for _, elapsed, _ in samples)
+        queries = [count for _, _, count in samples]
+        result = {
+            'requests': total,
+            'concurrency': concurrency,
+            'errors': sum(count for outcome, count in outcomes.items() if not outcome.startswith('2')),
+            'responses': outcomes,
+            'duration_s': round(duration, 3),
+            'throughput_rps': round(total / duration, 1),
+            'latency_ms': {
+                'p50': round(percentile(latencies, 0.50), 3),
+                'p95': round(percentile(latencies, 0.95), 3),
+                'p99': round(percentile(latencies, 0.99), 3),
+                'mean': round(statistics.fmean(latencies), 3),
+                'max': round(latencies[-1], 3),
+            },
+            'queries_per_request': {
+                'mean': round(statistics.fmean(queries), 2),
+                'max': max(queries),
+            },
+            'memory_kib_per_request': self.measure_memory(name),
+        }
+        self.stdout.write(
+            f"{name:<22} {result['throughput_rps']:>8.1f} req/s  "
+            f"p50 {result['latency_ms']['p50']:>8.1f} ms  p95 {result['latency_ms']['p95']:>8.1f} ms  "
+            f"p99 {result['latency_ms']['p99']:>8.1f} ms  {result['queries_per_request']['mean']:>6.1f} queries  "
+            f"{result['errors']} errors")
+        return result
+
+    def measure_memory(self, name):
+        """Peak and retained allocations of single requests, traced one at a time."""
+        samples = self.options['memory_samples']
+        if samples <= 0:
+            return None
+        client = Client()
+        peaks = []
+        retained = []
+        tracemalloc.start()
+        try:
+            for _ in range(samples):
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+                self.timed_send(client, name)
+                current, peak = tracemalloc.get_traced_memory()
+                peaks.append((peak - before) / 1024)
+                retained.append((current - before) / 1024)
+        finally:
+            tracemalloc.stop()
+        return {
+            'peak_mean': round(statistics.fmean(peaks), 1),
+            'peak_max': round(max(peaks), 1),
+            'retained_mean': round(statistics.fmean(retained), 1),
+        }
+
+    def clean_up(self):
+        fingerprints = set(Email.objects.filter(tenant=self.tenant).exclude(firebase_credential='')
+                           .values_list('firebase_credential', flat=True))
+        deleted, _ = Email.objects.filter(tenant=self.tenant).delete()
+        Suppression.objects.filter(tenant=self.tenant).delete()
+        for fingerprint in fingerprints:
+            default_storage.delete(credential_name(fingerprint))
+        self.stdout.write(f"Removed {deleted} benchmark rows")
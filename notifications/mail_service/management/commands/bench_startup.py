@@ -0,0 +1,118 @@
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# What a cold process of each kind loads before it can serve its first request or task.
+TARGETS = {
+    'web': ("from django.core.wsgi import get_wsgi_application; from django.urls import resolve; "
+            "get_wsgi_application(); resolve('/api/send-email/')"),
+    'worker': "import django; django.setup(); from notifications.celery import app; import mail_service.task",
+}
+
+# Provider SDKs that should only be imported by the first send that needs them.
+LAZY_MODULES = ['firebase_admin', 'google.auth', 'httpx', 'cryptography.x509']
+
+# Run in a fresh interpreter: times the target's imports and reports memory and modules as JSON.
+PROBE = """
+import json, resource, sys, time
+started = time.perf_counter()
+{target}
+ready = time.perf_counter()
+rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+try:
+    with open('/proc/self/status') as status:
+        rss = next(int(line.split()[1]) for line in status if line.startswith('VmRSS:'))
+except OSError:
+    pass
+print(json.dumps({{'ready_ms': (ready - started) * 1000, 'rss_kib': rss, 'modules': len(sys.modules),
+                  'lazy_loaded': [name for name in {lazy!r} if name in sys.modules]}}))
+"""
+
+
+class Command(BaseCommand):
+    help = ("Measure the cold start of a web process and a Celery worker: time to import everything needed "
+            "for the first request or task, resident memory and modules loaded, over several fresh "
+            "interpreters. Also lists the slowest top-level imports and any provider SDK loaded at startup.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--targets', default=','.join(TARGETS),
+                            help=f"Comma-separated process kinds to measure, from: {', '.join(TARGETS)}.")
+        parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters per target; medians are reported.")
+        parser.add_argument('--top', type=int, default=10, help="Slowest top-level imports to list per target.")
+        parser.add_argument('--output', help="Write the results as JSON to this file.")
+
+    def handle(self, *args, **options):
+        targets = options['targets'].split(',')
+        unknown = set(targets) - set(TARGETS)
+        if unknown:
+            raise CommandError(f"Unknown targets: {', '.join(sorted(unknown))}")
+
+        results = {'python': sys.version.split()[0], 'runs': options['runs'], 'targets': {}}
+        for target in targets:
+            samples = [self.probe(target) for _ in range(options['runs'])]
+            result = {
+                'process_ms': self.spread([sample['process_ms'] for sample in samples]),
+                'ready_ms': self.spread([sample['ready_ms'] for sample in samples]),
+                'rss_kib': round(statistics.median(sample['rss_kib'] for sample in samples)),
+                'modules': samples[0]['modules'],
+                'lazy_loaded': samples[0]['lazy_loaded'],
+                'slowest_imports': self.slowest_imports(target, options['top']),
+            }
+            results['targets'][target] = result
+            self.stdout.write(
+                f"{target:<8} ready {result['ready_ms']['median']:>7.1f} ms  "
+                f"process {result['process_ms']['median']:>7.1f} ms  "
+                f"rss {result['rss_kib'] / 1024:>6.1f} MiB  {result['modules']} modules")
+            for name, cumulative_ms in result['slowest_imports']:
+                self.stdout.write(f"    {cumulative_ms:>8.1f} ms  {name}")
+            if result['lazy_loaded']:
+                self.stdout.write(f"    loaded at startup: {', '.join(result['lazy_loaded'])}")
+
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(results, output, indent=2)
+
+    def run_python(self, target, *flags):
+        env = {**os.environ, 'DJANGO_SETTINGS_MODULE': os.environ.get('DJANGO_SETTINGS_MODULE',
+                                                                      'notifications.settings')}
+        code = PROBE.format(target=TARGETS[target], lazy=LAZY_MODULES)
+        completed = subprocess.run([sys.executable, *flags, '-c', code], cwd=settings.BASE_DIR, env=env,
+                                   capture_output=True, text=True)
+        if completed.returncode:
+            raise CommandError(f"The {target} probe failed:\n{completed.stderr}")
+        return completed
+
+    def probe(self, target):
+        started = time.perf_counter()
+        completed = self.run_python(target)
+        sample = json.loads(completed.stdout.splitlines()[-1])
+        # Includes interpreter start-up and shutdown, as an autoscaled process would see it.
+        sample['process_ms'] = (time.perf_counter() - started) * 1000
+        return sample
+
+    def slowest_imports(self, target, top):
+        """(module, cumulative ms) of the slowest imports made directly by the target, from -X importtime."""
+        if top <= 0:
+            return []
+        imports = []
+        for line in self.run_python(target, '-X', 'importtime').stderr.splitlines():
+            fields = line.split('|')
+            # Top-level imports are the names indented by exactly one space.
+            if len(fields) == 3 and fields[2].startswith(' ') and not fields[2].startswith('  '):
+                try:
+                    imports.append((fields[2].strip(), int(fields[1]) / 1000))
+                except ValueError:
+                    continue
+        return [(name, round(cumulative_ms, 1))
+                for name, cumulative_ms in sorted(imports, key=lambda item: -item[1])[:top]]
+
+    @staticmethod
+    def spread(values):
+        return {'median': round(statistics.median(values), 1), 'min': round(min(values), 1),
+                'max': round(max(values), 1)}
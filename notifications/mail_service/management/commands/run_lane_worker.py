@@ -0,0 +1,23 @@
+from celery import current_app
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mail_service.lanes import LANES, lane_queue
+
+
+class Command(BaseCommand):
+    help = ("Run a Celery worker for one delivery lane: it consumes only the lane's queue, with the lane's "
+            "MAIL_SERVICE_LANE_CONCURRENCY processes, so a bulk backlog cannot take the transactional workers.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('lane', choices=LANES, help="The lane to work.")
+        parser.add_argument('--concurrency', type=int, help="Worker processes, instead of the lane's setting.")
+        parser.add_argument('--loglevel', default='info')
+
+    def handle(self, *args, **options):
+        lane = options['lane']
+        concurrency = options['concurrency'] or settings.MAIL_SERVICE_LANE_CONCURRENCY[lane]
+        current_app.worker_main([
+            'worker', f'--queues={lane_queue(lane)}', f'--concurrency={concurrency}',
+            f'--loglevel={options["loglevel"]}', f'--hostname={lane}@%h',
+        ])
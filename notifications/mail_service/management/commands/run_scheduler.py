@@ -0,0 +1,37 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mail_service.metrics import measure_queue_depths
+from mail_service.scheduler import dispatch_due_notifications, dispatch_due_retries, release_stale_claims
+from mail_service.webhooks import apply_stored_events
+
+
+class Command(BaseCommand):
+    help = ("Queue scheduled notifications and delivery retries as they fall due, and apply saved tracking events. "
+            "Safe to run in several processes at once.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--interval', type=float, default=settings.MAIL_SERVICE_SCHEDULER_INTERVAL,
+                            help="Seconds to wait between sweeps of the due queue.")
+        parser.add_argument('--once', action='store_true', help="Run a single sweep and exit.")
+
+    def handle(self, *args, **options):
+        while True:
+            released = release_stale_claims()
+            if released:
+                self.stdout.write(f"Released {released} expired claims")
+            dispatched = dispatch_due_notifications()
+            if dispatched:
+                self.stdout.write(f"Dispatched {dispatched} scheduled notifications")
+            retried = dispatch_due_retries()
+            if retried:
+                self.stdout.write(f"Dispatched {retried} delivery retries")
+            applied = apply_stored_events()
+            if applied:
+                self.stdout.write(f"Applied {applied} tracking events")
+            measure_queue_depths()
+            if options['once']:
+                break
+            time.sleep(options['interval'])
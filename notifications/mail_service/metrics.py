@@ -0,0 +1,177 @@
+# metrics.py
+
+import os
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.cache import caches
+from django.db.backends.signals import connection_created
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Histogram, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from .tracing import phase
+
+# Provider calls range from a few milliseconds to the send timeouts.
+SEND_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# Due records are picked up by a sweep every few seconds, or late when the queue backs up.
+LAG_BUCKETS = (0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900, 3600)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+SEND_SECONDS = Histogram(
+    'mail_service_send_seconds', "Time spent in one provider call, by channel and provider.",
+    ['channel', 'provider', 'outcome'], buckets=SEND_BUCKETS)
+SEND_ERRORS = Counter(
+    'mail_service_send_errors', "Failed provider calls and push targets, by error class.",
+    ['channel', 'provider', 'error'])
+CLIENT_INIT_SECONDS = Histogram(
+    'mail_service_client_init_seconds', "Time to build a provider client on a cache miss.",
+    ['client'], buckets=SEND_BUCKETS)
+CACHE_LOOKUPS = Counter(
+    'mail_service_cache_lookups', "Lookups in the per-process caches, by result.", ['cache', 'result'])
+DB_QUERY_SECONDS = Histogram(
+    'mail_service_db_query_seconds', "Time spent in one database query.", ['alias'], buckets=DB_BUCKETS)
+REQUEST_SECONDS = Histogram(
+    'mail_service_request_seconds', "Time to handle an API request, by URL name and response status.",
+    ['view', 'method', 'status'], buckets=SEND_BUCKETS)
+SCHEDULER_LAG_SECONDS = Histogram(
+    'mail_service_scheduler_lag_seconds', "How long after its due time a record or retry was dispatched.",
+    ['job'], buckets=LAG_BUCKETS)
+SCHEDULER_JOB_SECONDS = Histogram(
+    'mail_service_scheduler_job_seconds', "Time for one scheduler sweep.", ['job'], buckets=SEND_BUCKETS)
+
+
+@contextmanager
+def timed_send(channel, provider):
+    """
+    Time a provider call, and count it as an error by exception class if it
+    raises. The call is also the '<channel>_send' phase of the request trace.
+    """
+    started = time.perf_counter()
+    outcome = 'error'
+    try:
+        with phase(f'{channel}_send'):
+            yield
+        outcome = 'ok'
+    except Exception as e:
+        SEND_ERRORS.labels(channel, provider, type(e).__name__).inc()
+        raise
+    finally:
+        SEND_SECONDS.labels(channel, provider, outcome).observe(time.perf_counter() - started)
+
+
+def cache_lookup(name):
+    """An LRUCache on_lookup callback that counts the cache's hits and misses."""
+    hits = CACHE_LOOKUPS.labels(name, 'hit')
+    misses = CACHE_LOOKUPS.labels(name, 'miss')
+
+    def on_lookup(hit):
+        (hits if hit else misses).inc()
+    return on_lookup
+
+
+def observe_lag(job, due_times, now):
+    histogram = SCHEDULER_LAG_SECONDS.labels(job)
+    for due_time in due_times:
+        histogram.observe(max((now - due_time).total_seconds(), 0))
+
+
+def _time_query(execute, sql, params, many, context):
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        DB_QUERY_SECONDS.labels(context['connection'].alias).observe(time.perf_counter() - started)
+
+
+def _instrument_connection(sender, connection, **kwargs):
+    if _time_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_time_query)
+
+
+connection_created.connect(_instrument_connection)
+
+
+# Cache key of the depths measured by measure_queue_depths().
+QUEUE_DEPTHS_KEY = 'mail_service:queue_depths'
+
+
+def measure_queue_depths(force=False):
+    """
+    Count the queues and store the result for QueueDepthCollector, unless a
+    measurement less than MAIL_SERVICE_QUEUE_DEPTH_INTERVAL seconds old is
+    already stored. The scheduler calls this after each sweep, so a scrape
+    costs no query however often it comes. Returns the stored measurement.
+    """
+    # Imported here so the metrics can be defined before the app registry is ready.
+    from .lanes import LANES, broker_depth
+    from .models import Delivery, Email
+
+    cache = caches[settings.MAIL_SERVICE_METRICS_CACHE]
+    interval = settings.MAIL_SERVICE_QUEUE_DEPTH_INTERVAL
+    measured = cache.get(QUEUE_DEPTHS_KEY)
+    if not force and measured is not None and time.time() - measured['measured_at'] < interval:
+        return measured
+    measured = {
+        'measured_at': time.time(),
+        'queues': {
+            'scheduled_due': Email.objects.due().count(),
+            'pending': Delivery.objects.filter(status='pending').count(),
+            'retrying': Delivery.objects.filter(status='retrying').count(),
+            'retry_due': Delivery.objects.retry_due().count(),
+        },
+        'lanes': {lane: {
+            'scheduled_due': Email.objects.due().filter(lane=lane).count(),
+            'retry_due': Delivery.objects.retry_due().filter(email__lane=lane).count(),
+            'broker': broker_depth(lane),
+        } for lane in LANES},
+    }
+    # Left to expire if the scheduler stops, so the gauges go missing rather than stale.
+    cache.set(QUEUE_DEPTHS_KEY, measured, timeout=max(interval * 5, 60))
+    return measured
+
+
+class QueueDepthCollector:
+    """
+    Queue depths last stored by measure_queue_depths(), so they are the same
+    whichever process is scraped and cost no query: due scheduled records
+    not yet dispatched, and deliveries waiting to be sent or retried; then
+    the same per delivery lane, with the tasks waiting in each lane's broker
+    queue; and how old the measurement is.
+    """
+
+    def collect(self):
+        measured = caches[settings.MAIL_SERVICE_METRICS_CACHE].get(QUEUE_DEPTHS_KEY)
+        if measured is None:
+            return
+
+        depth = GaugeMetricFamily('mail_service_queue_depth', "Records and deliveries waiting to go out.",
+                                  labels=['queue'])
+        for queue, count in measured['queues'].items():
+            depth.add_metric([queue], count)
+        yield depth
+
+        lanes = GaugeMetricFamily('mail_service_lane_depth', "Work waiting per delivery lane, in the database "
+                                  "(due records and retries) and in the lane's broker queue (tasks).",
+                                  labels=['lane', 'queue'])
+        for lane, queues in measured['lanes'].items():
+            for queue, count in queues.items():
+                if count is not None:
+                    lanes.add_metric([lane, queue], count)
+        yield lanes
+
+        yield GaugeMetricFamily('mail_service_queue_depth_age_seconds', "Seconds since the queue depths were counted.",
+                                value=time.time() - measured['measured_at'])
+
+
+def scrape_registry():
+    """
+    The registry to expose on /metrics. With PROMETHEUS_MULTIPROC_DIR set,
+    every web and worker process writes its samples there and they are
+    summed across processes; otherwise this process's own are used.
+    """
+    registry = CollectorRegistry()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry.register(REGISTRY)
+    registry.register(QueueDepthCollector())
+    return registry
@@ -1,9 +1,70 @@
 # middleware.py
+import logging
+import time
+from django.conf import settings
 from django.utils.deprecation import MiddlewareMixin
+from .metrics import REQUEST_SECONDS
+from .tracing import TRACE_HEADER, request_trace_id, sampled_profile, traced
+
+logger = logging.getLogger(__name__)
 
 
 class EmailServiceMiddleware(MiddlewareMixin):
+    """
+    Copies the provider headers onto the request. With MAIL_SERVICE_TRACING,
+    also traces the request: its phases (validation, queries, backend and
+    Firebase setup, provider calls) are returned in a Server-Timing header
+    and logged as one JSON line under its trace id, which is taken from an
+    X-Trace-ID header or generated, and passed on to the jobs it queues.
+    MAIL_SERVICE_PROFILE_SAMPLE_RATE of sync requests are also profiled.
+    """
+
     def process_request(self, request):
         request.email_service_name = request.headers.get('X-Email-Service')
         request.email_service_api_key = request.headers.get('X-Email-Service-API-Key')
         request.email_service_api_secret = request.headers.get('X-Email-Service-API-Secret')
+        request.tenant_id = request.headers.get('X-Tenant-ID', '')
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        self.process_request(request)
+        if not settings.MAIL_SERVICE_TRACING:
+            return self.get_response(request)
+        with traced(request_trace_id(request)) as trace, sampled_profile(trace) as profile:
+            response = self.get_response(request)
+        return self.finish_trace(request, response, trace, profile)
+
+    async def __acall__(self, request):
+        self.process_request(request)
+        if not settings.MAIL_SERVICE_TRACING:
+            return await self.get_response(request)
+        # cProfile follows one thread, so requests on the event loop are not profiled.
+        with traced(request_trace_id(request)) as trace:
+            response = await self.get_response(request)
+        return self.finish_trace(request, response, trace, None)
+
+    def finish_trace(self, request, response, trace, profile):
+        response[TRACE_HEADER] = trace.trace_id
+        response['Server-Timing'] = trace.server_timing()
+        fields = {'method': request.method, 'path': request.path, 'status': response.status_code}
+        if profile:
+            fields['profile'] = profile
+        logger.info("%s", trace.summary(**fields))
+        return response
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """Record each request's duration in mail_service_request_seconds, labelled by URL name."""
+
+    def process_request(self, request):
+        request.metrics_started = time.perf_counter()
+
+    def process_response(self, request, response):
+        started = getattr(request, 'metrics_started', None)
+        if started is not None:
+            match = request.resolver_match
+            # Unrouted paths share one label so scanners cannot add series.
+            view = (match.url_name or match.view_name) if match else 'unmatched'
+            REQUEST_SECONDS.labels(view, request.method, response.status_code).observe(time.perf_counter() - started)
+        return response
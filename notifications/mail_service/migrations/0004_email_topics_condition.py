@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0003_remove_email_email_service_api_key_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='condition',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='topics',
+            field=models.TextField(blank=True, default=''),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0004_email_topics_condition'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='email_service_credentials',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='email_service_name',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='firebase_credential',
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AlterField(
+            model_name='email',
+            name='sent_mail_status',
+            field=models.CharField(choices=[('sent', 'Sent'), ('failed', 'Failed'), ('pending', 'Pending'), ('scheduled', 'Scheduled')], default='pending', max_length=10),
+        ),
+    ]
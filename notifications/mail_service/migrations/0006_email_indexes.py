@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0005_email_delivery_settings'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(condition=models.Q(('is_schedule', True), ('schedule_status', 0)), fields=['delivery_time'], name='email_due_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(fields=['sent_mail_status', 'created_at'], name='email_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(fields=['created_at', 'id'], name='email_created_idx'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:59
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0006_email_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Delivery',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('channel', models.CharField(choices=[('email', 'Email'), ('push', 'Push token'), ('topic', 'Push topic'), ('condition', 'Push condition')], max_length=10)),
+                ('address', models.TextField()),
+                ('status', models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed')], default='pending', max_length=10)),
+                ('provider_message_id', models.CharField(blank=True, max_length=255)),
+                ('error', models.TextField(blank=True)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('email', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='deliveries', to='mail_service.email')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['email', 'status'], name='delivery_email_status_idx'), models.Index(fields=['status', 'updated_at'], name='delivery_status_updated_idx'), models.Index(fields=['channel', 'address'], name='delivery_channel_address_idx'), models.Index(fields=['provider_message_id'], name='delivery_provider_msg_idx')],
+            },
+        ),
+    ]
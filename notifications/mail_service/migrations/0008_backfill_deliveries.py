@@ -0,0 +1,78 @@
+import json
+
+from django.db import migrations
+
+
+def split_targets(value):
+    return [target for target in (value or '').split(',') if target]
+
+
+def email_status(email):
+    return email.sent_mail_status if email.sent_mail_status in ('sent', 'failed') else 'pending'
+
+
+def push_results(email):
+    """Per-target outcomes from firebase_response: a JSON summary, a message id or an error."""
+    response = email.firebase_response or ''
+    if response.startswith('{'):
+        try:
+            return {(result['type'], result['target']): result for result in json.loads(response)['results']}
+        except (ValueError, KeyError):
+            return {}
+    if response.startswith('projects/'):
+        return {('token', email.token): {'success': True, 'message_id': response}}
+    if response:
+        return {('token', email.token): {'success': False, 'error': response}}
+    return {}
+
+
+def backfill_deliveries(apps, schema_editor):
+    Email = apps.get_model('mail_service', 'Email')
+    Delivery = apps.get_model('mail_service', 'Delivery')
+
+    deliveries = []
+    for email in Email.objects.order_by('id').iterator(chunk_size=2000):
+        if email.mail_action:
+            status = email_status(email)
+            deliveries.extend(
+                Delivery(email_id=email.id, channel='email', address=address, status=status,
+                         attempts=0 if status == 'pending' else 1)
+                for address in split_targets(email.recipient_list)
+            )
+
+        if email.firebase_action:
+            results = push_results(email)
+            targets = [('push', 'token', token) for token in split_targets(email.token)]
+            targets += [('topic', 'topic', topic) for topic in split_targets(email.topics)]
+            if email.condition:
+                targets.append(('condition', 'condition', email.condition))
+            for channel, target_type, address in targets:
+                result = results.get((target_type, address))
+                if result is None:
+                    status = 'pending'
+                else:
+                    status = 'sent' if result.get('success') else 'failed'
+                deliveries.append(Delivery(
+                    email_id=email.id, channel=channel, address=address, status=status,
+                    provider_message_id=(result or {}).get('message_id') or '',
+                    error=(result or {}).get('error') or '',
+                    attempts=0 if status == 'pending' else 1,
+                ))
+
+        if len(deliveries) >= 2000:
+            Delivery.objects.bulk_create(deliveries)
+            deliveries = []
+
+    if deliveries:
+        Delivery.objects.bulk_create(deliveries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0007_delivery'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_deliveries, migrations.RunPython.noop),
+    ]
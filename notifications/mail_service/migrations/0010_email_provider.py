@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0009_delivery_retry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='delivery',
+            name='provider',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='tenant',
+            field=models.CharField(blank=True, db_index=True, max_length=255),
+        ),
+        migrations.CreateModel(
+            name='EmailProvider',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tenant', models.CharField(max_length=255)),
+                ('service_name', models.CharField(max_length=255)),
+                ('credentials', models.JSONField(default=dict)),
+                ('priority', models.IntegerField(default=0)),
+                ('weight', models.PositiveIntegerField(default=1)),
+                ('is_active', models.BooleanField(default=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['tenant', 'is_active'], name='provider_tenant_active_idx')],
+            },
+        ),
+    ]
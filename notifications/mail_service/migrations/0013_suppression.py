@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0012_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='delivery',
+            name='status',
+            field=models.CharField(choices=[('pending', 'Pending'), ('sent', 'Sent'), ('failed', 'Failed'), ('retrying', 'Retrying'), ('suppressed', 'Suppressed')], default='pending', max_length=10),
+        ),
+        migrations.CreateModel(
+            name='Suppression',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('tenant', models.CharField(blank=True, max_length=255)),
+                ('channel', models.CharField(choices=[('email', 'Email'), ('push', 'Push token')], max_length=10)),
+                ('address', models.TextField()),
+                ('reason', models.CharField(max_length=50)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('tenant', 'channel', 'address'), name='suppression_unique')],
+            },
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0013_suppression'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='delivery',
+            name='tracking_status',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='delivery',
+            name='tracking_updated_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
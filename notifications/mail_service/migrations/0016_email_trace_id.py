@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:39
+
+import mail_service.tracing
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0015_recipient_import'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='trace_id',
+            field=models.CharField(blank=True, default=mail_service.tracing.current_trace_id, max_length=64),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.18 on 2026-10-18 16:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0016_email_trace_id'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='email',
+            name='lane',
+            field=models.CharField(choices=[('transactional', 'Transactional'), ('bulk', 'Bulk')], default='transactional', max_length=16),
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(condition=models.Q(('is_schedule', True), ('schedule_status', 0)), fields=['lane', 'tenant', 'delivery_time'], name='email_lane_due_idx'),
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:05
+
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def start_existing_leases(apps, schema_editor):
+    # Rows claimed before the lease existed start theirs now, so the sweep can release them if they are stuck.
+    Email = apps.get_model('mail_service', 'Email')
+    Email.objects.filter(is_schedule=True, schedule_status=3).update(claimed_at=timezone.now())
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0017_email_lane'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='delivery',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='email',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='delivery',
+            index=models.Index(condition=models.Q(('claimed_at__isnull', False), ('status', 'pending')), fields=['claimed_at'], name='delivery_claimed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(condition=models.Q(('is_schedule', True), ('schedule_status', 3)), fields=['claimed_at'], name='email_claimed_idx'),
+        ),
+        migrations.RunPython(start_existing_leases, migrations.RunPython.noop),
+    ]
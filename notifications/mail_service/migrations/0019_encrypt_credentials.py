@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:07
+
+import json
+
+import mail_service.fields
+from django.db import migrations
+from django.db.models import TextField, Value
+
+# (model, credentials field) pairs whose plain JSON is encrypted.
+CREDENTIAL_FIELDS = [('Email', 'email_service_credentials'), ('EmailProvider', 'credentials')]
+
+
+def encrypt_credentials(apps, schema_editor):
+    # The field reads the plain JSON left by the old column and encrypts it on save.
+    for model_name, field in CREDENTIAL_FIELDS:
+        model = apps.get_model('mail_service', model_name)
+        rows = []
+        for row in model.objects.only('id', field).iterator(chunk_size=2000):
+            rows.append(row)
+            if len(rows) == 2000:
+                model.objects.bulk_update(rows, [field])
+                rows = []
+        model.objects.bulk_update(rows, [field])
+
+
+def decrypt_credentials(apps, schema_editor):
+    for model_name, field in CREDENTIAL_FIELDS:
+        model = apps.get_model('mail_service', model_name)
+        for row in model.objects.only('id', field).iterator(chunk_size=2000):
+            plain = Value(json.dumps(getattr(row, field)), output_field=TextField())
+            model.objects.filter(id=row.id).update(**{field: plain})
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0018_claim_lease'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='email',
+            name='email_service_credentials',
+            field=mail_service.fields.EncryptedJSONField(blank=True, default=dict),
+        ),
+        migrations.AlterField(
+            model_name='emailprovider',
+            name='credentials',
+            field=mail_service.fields.EncryptedJSONField(default=dict),
+        ),
+        migrations.RunPython(encrypt_credentials, decrypt_credentials),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0020_tracking_event'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='suppression',
+            index=models.Index(fields=['created_at'], name='suppression_created_idx'),
+        ),
+    ]
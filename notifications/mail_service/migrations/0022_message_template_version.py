@@ -0,0 +1,46 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:11
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+CONTENT_FIELDS = ['subject', 'text_body', 'html_body', 'push_title', 'push_body']
+
+
+def keep_current_versions(apps, schema_editor):
+    # Only the current content of existing templates is known; earlier versions were overwritten.
+    MessageTemplate = apps.get_model('mail_service', 'MessageTemplate')
+    MessageTemplateVersion = apps.get_model('mail_service', 'MessageTemplateVersion')
+    MessageTemplateVersion.objects.bulk_create(
+        [MessageTemplateVersion(template_id=template.id, version=template.version,
+                                **{field: getattr(template, field) for field in CONTENT_FIELDS})
+         for template in MessageTemplate.objects.iterator(chunk_size=2000)],
+        batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0021_suppression_created_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageTemplateVersion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField()),
+                ('subject', models.CharField(blank=True, max_length=255)),
+                ('text_body', models.TextField(blank=True)),
+                ('html_body', models.TextField(blank=True)),
+                ('push_title', models.CharField(blank=True, max_length=255)),
+                ('push_body', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('template', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='versions', to='mail_service.messagetemplate')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('template', 'version'), name='template_version_unique')],
+            },
+        ),
+        migrations.RunPython(keep_current_versions, migrations.RunPython.noop),
+    ]
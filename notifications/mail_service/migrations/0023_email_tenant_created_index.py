@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:15
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0022_message_template_version'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='email',
+            name='email_created_idx',
+        ),
+        migrations.AddIndex(
+            model_name='email',
+            index=models.Index(fields=['tenant', 'created_at', 'id'], name='email_tenant_created_idx'),
+        ),
+    ]
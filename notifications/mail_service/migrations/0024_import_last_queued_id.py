@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0023_email_tenant_created_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipientimport',
+            name='last_queued_id',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
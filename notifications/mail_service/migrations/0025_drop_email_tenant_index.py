@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 17:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_service', '0024_import_last_queued_id'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='email',
+            name='tenant',
+            field=models.CharField(blank=True, max_length=255),
+        ),
+    ]
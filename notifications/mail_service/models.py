@@ -1,4 +1,22 @@
 from django.db import models
+from django.utils import timezone
+from .fields import EncryptedJSONField
+from .tracing import current_trace_id
+
+
+class EmailQuerySet(models.QuerySet):
+    # Each filter matches an index in Email.Meta.indexes.
+
+    def due(self, now=None):
+        """Scheduled records whose delivery time has passed and that nobody has claimed."""
+        return self.filter(is_schedule=True, schedule_status=Email.SCHEDULED,
+                           delivery_time__lte=now or timezone.now())
+
+    def pending(self):
+        return self.filter(sent_mail_status='pending')
+
+    def failed_since(self, since):
+        return self.filter(sent_mail_status='failed', created_at__gte=since)
 
 
 class Email(models.Model):
@@ -6,22 +24,321 @@ class Email(models.Model):
         ('sent', 'Sent'),
         ('failed', 'Failed'),
         ('pending', 'Pending'),
+        ('scheduled', 'Scheduled'),
+    ]
+
+    SCHEDULED = 0
+    CANCELED = 1
+    SCHEDULE_SENT = 2
+    PROCESSING = 3
+
+    TRANSACTIONAL = 'transactional'
+    BULK = 'bulk'
+    LANE_CHOICES = [
+        (TRANSACTIONAL, 'Transactional'),
+        (BULK, 'Bulk'),
     ]
 
     id = models.AutoField(primary_key=True)
     subject = models.CharField(max_length=255)
     message = models.TextField()
-    token = models.TextField(default=None)
+    token = models.TextField(default=None)  # Comma-joined FCM device tokens
+    topics = models.TextField(blank=True, default='')  # Comma-joined FCM topics
+    condition = models.TextField(blank=True, default='')  # FCM topic condition expression
     recipient_list = models.TextField()  # Consider changing to JSON field or ManyToManyField if needed
     created_at = models.DateTimeField(auto_now_add=True)
     sent_mail_status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    # Message id, or a JSON summary with per-target results for multicast/topic sends.
     firebase_response = models.TextField(null=True, blank=True)
     mail_action = models.BooleanField(default=False)
     firebase_action = models.BooleanField(default=False)
     is_schedule = models.BooleanField(default=False)
     delivery_time = models.DateTimeField(null=True, blank=True)
-    # When is_schedule = True, 0 is scheduled , 1 is canceled , 2 sent the message.
+    # When is_schedule = True, 0 is scheduled , 1 is canceled , 2 sent the message,
+    # 3 claimed by a scheduler sweep and queued for delivery.
     schedule_status = models.IntegerField(default=0)
+    # When a scheduler sweep claimed the record; a PROCESSING claim older than MAIL_SERVICE_CLAIM_LEASE is reclaimed.
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    # Provider settings needed to deliver the record from any worker, at any time. The credentials are encrypted.
+    email_service_name = models.CharField(max_length=255, blank=True)
+    email_service_credentials = EncryptedJSONField(default=dict, blank=True)
+    firebase_credential = models.CharField(max_length=64, blank=True)  # Credential file fingerprint
+    # Tenant from the X-Tenant-ID header. With no email_service_name, mail is routed
+    # across the tenant's registered EmailProvider rows.
+    tenant = models.CharField(max_length=255, blank=True)
+    # Set for template sends: subject and bodies are rendered per delivery on the worker,
+    # with template_context overlaid by each Delivery's own context.
+    template = models.ForeignKey('MessageTemplate', null=True, blank=True, on_delete=models.PROTECT,
+                                 related_name='emails')
+    template_version = models.PositiveIntegerField(null=True, blank=True)
+    template_context = models.JSONField(default=dict, blank=True)
+    # Delivery lane: transactional records are queued and dispatched apart from, and ahead of, bulk ones.
+    lane = models.CharField(max_length=16, choices=LANE_CHOICES, default=TRANSACTIONAL)
+    # Trace id of the request that created the record, carried into its scheduled and queued delivery.
+    trace_id = models.CharField(max_length=64, blank=True, default=current_trace_id)
+
+    objects = EmailQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Scheduler due scan: only unclaimed scheduled rows are indexed.
+            models.Index(fields=['delivery_time'], name='email_due_idx',
+                         condition=models.Q(is_schedule=True, schedule_status=0)),
+            # Fair dispatch: each tenant's due rows in a lane, oldest first.
+            models.Index(fields=['lane', 'tenant', 'delivery_time'], name='email_lane_due_idx',
+                         condition=models.Q(is_schedule=True, schedule_status=0)),
+            # Lease sweep: claimed rows that were never sent.
+            models.Index(fields=['claimed_at'], name='email_claimed_idx',
+                         condition=models.Q(is_schedule=True, schedule_status=3)),
+            # Status dashboards and retry sweeps: status filter plus time range.
+            models.Index(fields=['sent_mail_status', 'created_at'], name='email_status_created_idx'),
+            # A tenant's time-ordered listing, export and cursor pages.
+            models.Index(fields=['tenant', 'created_at', 'id'], name='email_tenant_created_idx'),
+        ]
 
     def __str__(self):
         return self.subject
+
+
+class DeliveryQuerySet(models.QuerySet):
+
+    def retry_due(self, now=None):
+        """Deliveries waiting for a retry whose backoff has passed."""
+        return self.filter(status='retrying', next_attempt_at__lte=now or timezone.now())
+
+
+class Delivery(models.Model):
+    """One recipient of an Email: an address, a device token, a topic or a condition."""
+    CHANNEL_CHOICES = [
+        ('email', 'Email'),
+        ('push', 'Push token'),
+        ('topic', 'Push topic'),
+        ('condition', 'Push condition'),
+    ]
+    STATUS_CHOICES = [
+        ('pending', 'Pending'),
+        ('sent', 'Sent'),
+        ('failed', 'Failed'),
+        ('retrying', 'Retrying'),
+        ('suppressed', 'Suppressed'),
+    ]
+
+    email = models.ForeignKey(Email, on_delete=models.CASCADE, related_name='deliveries')
+    channel = models.CharField(max_length=10, choices=CHANNEL_CHOICES)
+    address = models.TextField()  # Email address, FCM token, topic name or condition
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='pending')
+    provider_message_id = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Set explicitly on bulk_update, which skips auto_now.
+    updated_at = models.DateTimeField(auto_now=True)
+    sent_at = models.DateTimeField(null=True, blank=True)
+    provider = models.CharField(max_length=255, blank=True)  # Provider that handled the last attempt
+    # When a 'retrying' delivery is due for its next attempt.
+    next_attempt_at = models.DateTimeField(null=True, blank=True)
+    # When a retry sweep claimed the delivery back to 'pending'; reclaimed if it is still pending after the lease.
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    context = models.JSONField(default=dict, blank=True)  # Per-recipient template variables
+    # Latest event reported by the provider's tracking webhook (delivered, opened, bounced, ...).
+    tracking_status = models.CharField(max_length=20, blank=True)
+    tracking_updated_at = models.DateTimeField(null=True, blank=True)
+
+    # Not a field: set in memory by deliver_email when the outcome should
+    # suppress the address for future sends, e.g. 'rejected' or 'unregistered'.
+    suppression_reason = ''
+
+    objects = DeliveryQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Loading the pending recipients of an email.
+            models.Index(fields=['email', 'status'], name='delivery_email_status_idx'),
+            # Retry sweeps and stats by status over time.
+            models.Index(fields=['status', 'updated_at'], name='delivery_status_updated_idx'),
+            # Suppression and dedupe checks for one address.
+            models.Index(fields=['channel', 'address'], name='delivery_channel_address_idx'),
+            # Retry sweep: only deliveries waiting for a retry are indexed.
+            models.Index(fields=['next_attempt_at'], name='delivery_retry_due_idx',
+                         condition=models.Q(status='retrying')),
+            # Lease sweep: retries claimed back to 'pending' that were never sent.
+            models.Index(fields=['claimed_at'], name='delivery_claimed_idx',
+                         condition=models.Q(status='pending', claimed_at__isnull=False)),
+            # Provider callbacks refer to the provider's message id.
+            models.Index(fields=['provider_message_id'], name='delivery_provider_msg_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.channel}:{self.address}"
+
+
+class EmailProvider(models.Model):
+    """A provider account a tenant registered for routing and failover."""
+    tenant = models.CharField(max_length=255)
+    service_name = models.CharField(max_length=255)  # A key of EMAIL_BACKEND_MAPPING
+    credentials = EncryptedJSONField(default=dict)
+    # Lower priorities are tried first; providers with the same priority share traffic by weight.
+    priority = models.IntegerField(default=0)
+    weight = models.PositiveIntegerField(default=1)
+    is_active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['tenant', 'is_active'], name='provider_tenant_active_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.tenant}:{self.service_name}"
+
+
+class MessageTemplate(models.Model):
+    """A stored email/push template, written in the Django template language."""
+    tenant = models.CharField(max_length=255, blank=True)
+    name = models.CharField(max_length=255)
+    subject = models.CharField(max_length=255, blank=True)
+    text_body = models.TextField(blank=True)
+    html_body = models.TextField(blank=True)
+    # Push notification title and body; the subject and text body are used when empty.
+    push_title = models.CharField(max_length=255, blank=True)
+    push_body = models.TextField(blank=True)
+    # Bumped on every change, with the content of each version kept in MessageTemplateVersion.
+    version = models.PositiveIntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['tenant', 'name'], name='template_tenant_name_idx'),
+        ]
+
+    # The parts of a template that are rendered, and copied to each MessageTemplateVersion.
+    CONTENT_FIELDS = ['subject', 'text_body', 'html_body', 'push_title', 'push_body']
+
+    def __str__(self):
+        return f"{self.tenant}:{self.name}"
+
+    def save_version(self):
+        """Keep the current content as this version's immutable copy."""
+        return MessageTemplateVersion.objects.create(
+            template=self, version=self.version, **{field: getattr(self, field) for field in self.CONTENT_FIELDS})
+
+
+class MessageTemplateVersion(models.Model):
+    """
+    The content of one version of a MessageTemplate. Records store the
+    version they were created with and are rendered from it, however the
+    template has been edited since.
+    """
+    template = models.ForeignKey(MessageTemplate, on_delete=models.CASCADE, related_name='versions')
+    version = models.PositiveIntegerField()
+    subject = models.CharField(max_length=255, blank=True)
+    text_body = models.TextField(blank=True)
+    html_body = models.TextField(blank=True)
+    push_title = models.CharField(max_length=255, blank=True)
+    push_body = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['template', 'version'], name='template_version_unique'),
+        ]
+
+    def __str__(self):
+        return f"{self.template_id} v{self.version}"
+
+
+class IdempotencyKey(models.Model):
+    """A send request already accepted under an Idempotency-Key header or content hash."""
+    tenant = models.CharField(max_length=255, blank=True)
+    endpoint = models.CharField(max_length=50)
+    key = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)  # To reject a key reused for a different request
+    email = models.ForeignKey(Email, on_delete=models.CASCADE, related_name='+')
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['tenant', 'endpoint', 'key'], name='idempotency_key_unique'),
+        ]
+        indexes = [
+            # Purge of expired keys.
+            models.Index(fields=['expires_at'], name='idempotency_expires_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.endpoint}:{self.key}"
+
+
+class Suppression(models.Model):
+    """An email address or FCM token that must not be sent to again."""
+    CHANNEL_CHOICES = [
+        ('email', 'Email'),
+        ('push', 'Push token'),
+    ]
+
+    tenant = models.CharField(max_length=255, blank=True)
+    channel = models.CharField(max_length=10, choices=CHANNEL_CHOICES)
+    address = models.TextField()  # Lower-cased for email
+    # e.g. 'bounced', 'rejected', 'complained', 'unregistered' or 'manual'.
+    reason = models.CharField(max_length=50)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['tenant', 'channel', 'address'], name='suppression_unique'),
+        ]
+        indexes = [
+            # Suppression filter refresh: rows created since the last one.
+            models.Index(fields=['created_at'], name='suppression_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.channel}:{self.address}"
+
+
+class TrackingEvent(models.Model):
+    """
+    A provider tracking event, saved by the webhook before it responds and
+    deleted once a worker has applied it to its delivery.
+    """
+    data = models.JSONField()  # As built by webhooks._event_data
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.data.get('event_type')}:{self.data.get('message_id')}"
+
+
+class RecipientImport(models.Model):
+    """A recipient file streamed into the deliveries of an Email, with its progress."""
+    FORMAT_CHOICES = [
+        ('csv', 'CSV'),
+        ('ndjson', 'NDJSON'),
+    ]
+    STATUS_CHOICES = [
+        ('importing', 'Importing'),
+        ('completed', 'Completed'),
+        ('failed', 'Failed'),
+    ]
+
+    tenant = models.CharField(max_length=255, blank=True, db_index=True)
+    email = models.ForeignKey(Email, on_delete=models.CASCADE, related_name='imports')
+    format = models.CharField(max_length=10, choices=FORMAT_CHOICES)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='importing')
+    size = models.PositiveBigIntegerField(default=0)  # Uploaded file size in bytes
+    bytes_read = models.PositiveBigIntegerField(default=0)
+    rows_read = models.PositiveIntegerField(default=0)
+    rows_imported = models.PositiveIntegerField(default=0)
+    rows_rejected = models.PositiveIntegerField(default=0)
+    # The first MAIL_SERVICE_IMPORT_MAX_ERRORS rejected rows, as {"line": ..., "errors": ...}.
+    errors = models.JSONField(default=list, blank=True)
+    error = models.TextField(blank=True)  # Why a failed import stopped
+    # Id of the last delivery queued for sending, so queueing resumes after it.
+    last_queued_id = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.format} import for email {self.email_id}"
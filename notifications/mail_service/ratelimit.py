@@ -0,0 +1,149 @@
+# ratelimit.py
+
+import threading
+import time
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+
+class RateLimited(Exception):
+    """Raised when a provider's token bucket is empty; wait is the seconds until it refills."""
+
+    def __init__(self, key, wait):
+        super().__init__(f"Rate limit reached for {key}, retry in {wait:.2f}s.")
+        self.key = key
+        self.wait = wait
+
+
+def _take(state, now, rate, burst, tokens):
+    """
+    Refill a bucket state (tokens, updated_at) and try to take tokens from it.
+
+    Returns (new_state, wait): wait is 0 when the tokens were taken, else
+    the seconds until enough tokens will be available (nothing is taken).
+    """
+    available, updated_at = state if state is not None else (burst, now)
+    available = min(burst, available + (now - updated_at) * rate)
+    if available >= tokens:
+        return (available - tokens, now), 0.0
+    return (available, now), (tokens - available) / rate
+
+
+class MemoryStore:
+    """Token buckets in process memory. Not shared between workers; meant for tests and single-process use."""
+
+    shared = False
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, key, rate, burst, tokens):
+        with self._lock:
+            self._buckets[key], wait = _take(self._buckets.get(key), time.time(), rate, burst, tokens)
+        return wait
+
+
+class CacheStore:
+    """
+    Token buckets in a Django cache, shared by every process that uses it.
+
+    Point MAIL_SERVICE_RATE_LIMIT_CACHE at a Redis or database cache. Each
+    bucket update runs under a short lock taken with cache.add(), which is
+    atomic on those backends.
+    """
+
+    lock_timeout = 5
+    lock_attempts = 50
+
+    def __init__(self):
+        self.cache = caches[settings.MAIL_SERVICE_RATE_LIMIT_CACHE]
+
+    @property
+    def shared(self):
+        # A local-memory cache is per process, and a dummy cache keeps nothing.
+        return not isinstance(self.cache, (LocMemCache, DummyCache))
+
+    def take(self, key, rate, burst, tokens):
+        bucket_key = f'ratelimit:{key}'
+        lock_key = f'{bucket_key}:lock'
+        for _ in range(self.lock_attempts):
+            if self.cache.add(lock_key, 1, timeout=self.lock_timeout):
+                break
+            time.sleep(0.005)
+        else:
+            # Could not get the lock; treat as a short wait rather than sending unthrottled.
+            return 0.1
+        try:
+            state, wait = _take(self.cache.get(bucket_key), time.time(), rate, burst, tokens)
+            # Keep the bucket around long enough to refill completely.
+            self.cache.set(bucket_key, state, timeout=int(burst / rate) + 60)
+            return wait
+        finally:
+            self.cache.delete(lock_key)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    """
+    The MAIL_SERVICE_RATE_LIMIT_STORE. With a real broker, delivery runs in
+    many worker processes, and a store that is not shared between them
+    would let each one send at the full rate, so it is refused.
+    """
+    global _store
+    with _store_lock:
+        if _store is None:
+            store = import_string(settings.MAIL_SERVICE_RATE_LIMIT_STORE)()
+            if not store.shared and not settings.CELERY_TASK_ALWAYS_EAGER:
+                raise ImproperlyConfigured(
+                    "Rate limits need a store shared by all workers: use CacheStore with "
+                    "MAIL_SERVICE_RATE_LIMIT_CACHE pointing at Redis or a database cache.")
+            _store = store
+        return _store
+
+
+def get_limit(provider):
+    """(rate, burst) for a provider from MAIL_SERVICE_RATE_LIMITS, or None for no limit."""
+    limits = settings.MAIL_SERVICE_RATE_LIMITS
+    limit = limits.get(provider, limits.get('default'))
+    if not limit:
+        return None
+    rate, burst = float(limit['rate']), float(limit.get('burst', limit['rate']))
+    if rate <= 0 or burst <= 0:
+        # A bucket that never refills would divide by zero; remove the entry to stop limiting instead.
+        raise ImproperlyConfigured(f"MAIL_SERVICE_RATE_LIMITS[{provider!r}]: rate and burst must be positive.")
+    return rate, burst
+
+
+def acquire(provider, account, tokens=1):
+    """
+    Take tokens from the bucket of a provider account (tenant or credentials).
+
+    Short waits, up to MAIL_SERVICE_RATE_LIMIT_MAX_WAIT seconds, are slept
+    off here. Longer ones raise RateLimited so the caller can try another
+    provider or defer the send.
+    """
+    limit = get_limit(provider)
+    if limit is None:
+        return
+    rate, burst = limit
+    # A call larger than the burst could never be granted, so it costs the whole burst. Callers take
+    # tokens per provider call (an FCM call has at most 500 targets), so a large send pays for each call.
+    tokens = min(tokens, burst)
+    key = f'{provider}:{account}'
+    store = get_store()
+    deadline = time.monotonic() + settings.MAIL_SERVICE_RATE_LIMIT_MAX_WAIT
+    while True:
+        wait = store.take(key, rate, burst, tokens)
+        if wait <= 0:
+            return
+        if time.monotonic() + wait > deadline:
+            raise RateLimited(key, wait)
+        time.sleep(wait)
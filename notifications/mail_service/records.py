@@ -0,0 +1,134 @@
+# records.py
+
+import base64
+import csv
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Count, Q
+from django.utils.dateparse import parse_datetime
+from .models import Delivery, Email
+
+# Email fields the read API returns, in export column order. Provider credentials are never exposed.
+EMAIL_FIELDS = [
+    'id', 'created_at', 'subject', 'message', 'recipient_list', 'token', 'topics', 'condition',
+    'sent_mail_status', 'firebase_response', 'mail_action', 'firebase_action', 'is_schedule', 'delivery_time',
+    'schedule_status', 'email_service_name', 'tenant', 'template_id', 'template_version', 'lane', 'trace_id',
+]
+# Always returned, as pages are keyed on them.
+KEY_FIELDS = ['id', 'created_at']
+
+# schedule filter -> Email.schedule_status; 'none' matches records that were not scheduled.
+SCHEDULE_STATES = {
+    'scheduled': Email.SCHEDULED,
+    'canceled': Email.CANCELED,
+    'sent': Email.SCHEDULE_SENT,
+    'processing': Email.PROCESSING,
+}
+
+
+def filter_emails(tenant, filters):
+    """The tenant's Email records matching validated EmailFilterSerializer filters."""
+    emails = Email.objects.filter(tenant=tenant)
+    if 'status' in filters:
+        emails = emails.filter(sent_mail_status=filters['status'])
+    if 'lane' in filters:
+        emails = emails.filter(lane=filters['lane'])
+    if filters.get('channel') == 'email':
+        emails = emails.filter(mail_action=True)
+    elif filters.get('channel') == 'push':
+        emails = emails.filter(firebase_action=True)
+    if filters.get('schedule') == 'none':
+        emails = emails.filter(is_schedule=False)
+    elif 'schedule' in filters:
+        emails = emails.filter(is_schedule=True, schedule_status=SCHEDULE_STATES[filters['schedule']])
+    if 'created_after' in filters:
+        emails = emails.filter(created_at__gte=filters['created_after'])
+    if 'created_before' in filters:
+        emails = emails.filter(created_at__lt=filters['created_before'])
+    return emails
+
+
+def encode_cursor(row):
+    return base64.urlsafe_b64encode(f"{row['created_at'].isoformat()}|{row['id']}".encode()).decode()
+
+
+def decode_cursor(cursor):
+    """The (created_at, id) a cursor points at, or None if it is not one of ours."""
+    try:
+        created_at, email_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        created_at = parse_datetime(created_at)
+        email_id = int(email_id)
+    except ValueError:
+        return None
+    return (created_at, email_id) if created_at is not None else None
+
+
+def email_page(emails, fields, limit, after=None):
+    """
+    One page of emails as dicts of `fields`, newest first, and the cursor of
+    the next page, or None on the last one.
+
+    Pages are keyed on (created_at, id) within a tenant, the
+    email_tenant_created_idx index: a page starts right after the row
+    `after` points at rather than at an OFFSET, so the millionth page costs
+    the same as the first and rows inserted meanwhile never shift a page.
+    """
+    if after is not None:
+        created_at, email_id = after
+        emails = emails.filter(Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=email_id))
+    columns = [*KEY_FIELDS, *(field for field in fields if field not in KEY_FIELDS)]
+    # One row more than the page tells whether there is a next page.
+    rows = list(emails.order_by('-created_at', '-id').values(*columns)[:limit + 1])
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(rows[-1])
+
+
+def delivery_counts(email_id):
+    """{channel: {status: count}} over an email's deliveries, counted in the database however many there are."""
+    counts = {}
+    rows = (Delivery.objects.filter(email_id=email_id).order_by()
+            .values_list('channel', 'status').annotate(count=Count('id')))
+    for channel, status, count in rows:
+        counts.setdefault(channel, {})[status] = count
+    return counts
+
+
+class Echo:
+    """A file-like object whose write() returns the line, for csv.writer in a streamed response."""
+
+    def write(self, value):
+        return value
+
+
+def export_lines(emails, fields, export_format):
+    """
+    The NDJSON or CSV export of emails, oldest first, as blocks of lines for
+    a StreamingHttpResponse.
+
+    Rows come from a single query read with iterator() in chunks of
+    MAIL_SERVICE_EXPORT_CHUNK_SIZE (a server-side cursor on PostgreSQL), and
+    each chunk is written out before the next is fetched, so memory use does
+    not grow with the number of rows.
+    """
+    chunk_size = settings.MAIL_SERVICE_EXPORT_CHUNK_SIZE
+    rows = emails.order_by('created_at', 'id').values_list(*fields).iterator(chunk_size=chunk_size)
+    if export_format == 'csv':
+        writer = csv.writer(Echo())
+        yield writer.writerow(fields)
+        encode = writer.writerow
+    else:
+        encoder = DjangoJSONEncoder()
+
+        def encode(row):
+            return encoder.encode(dict(zip(fields, row))) + '\n'
+
+    block = []
+    for row in rows:
+        block.append(encode(row))
+        if len(block) == chunk_size:
+            yield ''.join(block)
+            block = []
+    if block:
+        yield ''.join(block)
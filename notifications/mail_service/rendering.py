@@ -0,0 +1,99 @@
+# rendering.py
+
+import json
+from collections import namedtuple
+from django.conf import settings
+from django.template import Context, Engine
+from .cache import LRUCache
+from .metrics import cache_lookup
+from .models import MessageTemplateVersion
+
+CompiledTemplate = namedtuple('CompiledTemplate', ['subject', 'text_body', 'html_body', 'push_title', 'push_body'])
+
+# A standalone engine with only the built-in tags and filters; stored templates
+# cannot load template files or app tag libraries.
+engine = Engine()
+
+# Compiled templates keyed by (template id, version). Versions never change, so
+# an entry is never stale; an edit adds a new version and old entries age out.
+template_cache = LRUCache(max_size=settings.MAIL_SERVICE_TEMPLATE_CACHE_SIZE, on_lookup=cache_lookup('template'))
+
+
+def compile_template(template):
+    """
+    Compile every part of a MessageTemplate or MessageTemplateVersion.
+    Raises TemplateSyntaxError for invalid source.
+    """
+    return CompiledTemplate(
+        subject=engine.from_string(template.subject),
+        text_body=engine.from_string(template.text_body),
+        html_body=engine.from_string(template.html_body) if template.html_body else None,
+        push_title=engine.from_string(template.push_title or template.subject),
+        push_body=engine.from_string(template.push_body or template.text_body),
+    )
+
+
+def template_version(template_id, version):
+    """
+    The stored content of a template version. Records from before versions
+    were kept may refer to one that was not; they get the first kept after
+    it, which is the content they were rendered with until then.
+    """
+    return (MessageTemplateVersion.objects.filter(template_id=template_id, version__gte=version)
+            .order_by('version').first())
+
+
+def get_compiled_template(template_id, version):
+    return template_cache.get_or_create(
+        (template_id, version), lambda: compile_template(template_version(template_id, version)))
+
+
+def _render(compiled, context, autoescape=False):
+    # Plain text parts are not HTML-escaped; only the HTML body is.
+    return compiled.render(Context(context, autoescape=autoescape)) if compiled is not None else ''
+
+
+def render_email(compiled, context):
+    """(subject, text body, html body) of a compiled template for one context."""
+    # Subjects must be a single line.
+    subject = ' '.join(_render(compiled.subject, context).split())
+    return subject, _render(compiled.text_body, context), _render(compiled.html_body, context, autoescape=True)
+
+
+def render_push(compiled, context):
+    """(title, body) of a compiled template for one context."""
+    return _render(compiled.push_title, context).strip(), _render(compiled.push_body, context)
+
+
+def _group_by_rendering(email_record, deliveries, render):
+    compiled = get_compiled_template(email_record.template_id, email_record.template_version)
+    renderings = {}
+    groups = {}
+    for delivery in deliveries:
+        context = {**email_record.template_context, **delivery.context}
+        context_key = json.dumps(context, sort_keys=True, default=str)
+        content = renderings.get(context_key)
+        if content is None:
+            content = renderings[context_key] = render(compiled, context)
+        groups.setdefault(content, []).append(delivery)
+    return list(groups.items())
+
+
+def mail_groups(email_record, deliveries):
+    """
+    Group email deliveries by rendered content, as [((subject, text, html), deliveries)].
+
+    Records without a template are one group with the stored subject and
+    message. Each distinct context is rendered once, so recipients without
+    context of their own share one rendering and one provider call.
+    """
+    if email_record.template_id is None:
+        return [((email_record.subject, email_record.message, ''), deliveries)]
+    return _group_by_rendering(email_record, deliveries, render_email)
+
+
+def push_groups(email_record, deliveries):
+    """Group push deliveries by rendered content, as [((title, body), deliveries)]."""
+    if email_record.template_id is None:
+        return [((email_record.subject, email_record.message), deliveries)]
+    return _group_by_rendering(email_record, deliveries, render_push)
@@ -0,0 +1,177 @@
+# retry.py
+
+import random
+import sys
+import threading
+import time
+from anymail.exceptions import (AnymailAPIError, AnymailError, AnymailInvalidAddress, AnymailRecipientsRefused,
+                                AnymailRequestsAPIError)
+from django.conf import settings
+import requests
+
+TRANSIENT = 'transient'
+PERMANENT = 'permanent'
+
+# Names of the firebase_admin.exceptions classes worth retrying; everything else
+# (invalid argument, unregistered token, auth problems) will fail the same way again.
+FIREBASE_TRANSIENT_ERRORS = (
+    'UnavailableError',
+    'InternalError',
+    'DeadlineExceededError',
+    'ResourceExhaustedError',
+    'UnknownError',
+)
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a provider whose circuit breaker is open."""
+
+
+def classify_error(error):
+    """Return TRANSIENT if the failed call may succeed when retried, else PERMANENT."""
+    if isinstance(error, CircuitOpenError):
+        return TRANSIENT
+    if isinstance(error, (AnymailRecipientsRefused, AnymailInvalidAddress)):
+        return PERMANENT
+    if isinstance(error, AnymailRequestsAPIError):
+        status_code = error.status_code
+        # No status code means the request never got a response (timeout, connection error).
+        if status_code is None or status_code == 429 or status_code >= 500:
+            return TRANSIENT
+        return PERMANENT
+    if isinstance(error, AnymailAPIError):
+        return TRANSIENT
+    if isinstance(error, AnymailError):
+        return PERMANENT
+    # firebase_admin is only imported once a push is sent, and a Firebase error cannot exist before that.
+    firebase_exceptions = sys.modules.get('firebase_admin.exceptions')
+    if firebase_exceptions is not None and isinstance(error, firebase_exceptions.FirebaseError):
+        transient = tuple(getattr(firebase_exceptions, name) for name in FIREBASE_TRANSIENT_ERRORS)
+        return TRANSIENT if isinstance(error, transient) else PERMANENT
+    if isinstance(error, (requests.ConnectionError, requests.Timeout, ConnectionError, TimeoutError)):
+        return TRANSIENT
+    return PERMANENT
+
+
+def backoff_delay(attempt):
+    """Seconds to wait before retry number `attempt`: capped exponential backoff with full jitter."""
+    ceiling = min(settings.MAIL_SERVICE_RETRY_MAX_DELAY,
+                  settings.MAIL_SERVICE_RETRY_BASE_DELAY * 2 ** max(attempt - 1, 0))
+    return random.uniform(0, ceiling)
+
+
+class CircuitBreaker:
+    """
+    Per-provider circuit breaker.
+
+    After failure_threshold consecutive failures the breaker opens and
+    calls fail fast. Once reset_timeout has passed, one trial call is let
+    through (half-open); its outcome closes or re-opens the breaker.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Return True if a call may go to the provider now."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            # Open, or half-open with the trial call still in flight.
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def snapshot(self):
+        with self._lock:
+            retry_in = None
+            if self.state == self.OPEN:
+                retry_in = max(self.reset_timeout - (time.monotonic() - self.opened_at), 0)
+            return {'state': self.state, 'failures': self.failures, 'retry_in': retry_in}
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """Return the circuit breaker for a provider, e.g. an EMAIL_BACKEND_MAPPING name or 'Firebase'."""
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(
+                name,
+                failure_threshold=settings.MAIL_SERVICE_BREAKER_FAILURE_THRESHOLD,
+                reset_timeout=settings.MAIL_SERVICE_BREAKER_RESET_TIMEOUT,
+            )
+        return breaker
+
+
+def breaker_states():
+    """State of every breaker in this process."""
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    return {breaker.name: breaker.snapshot() for breaker in breakers}
+
+
+def call_with_breaker(name, func, *args, **kwargs):
+    """
+    Call func through the named circuit breaker.
+
+    Raises CircuitOpenError without calling func while the breaker is open.
+    Only transient errors count as breaker failures: a rejected request says
+    nothing about the provider's health.
+    """
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise CircuitOpenError(f"Circuit breaker for {name} is open.")
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        if classify_error(e) == TRANSIENT:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    breaker.record_success()
+    return result
+
+
+async def acall_with_breaker(name, func, *args, **kwargs):
+    """call_with_breaker for a coroutine function: awaits func through the named circuit breaker."""
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        raise CircuitOpenError(f"Circuit breaker for {name} is open.")
+    try:
+        result = await func(*args, **kwargs)
+    except Exception as e:
+        if classify_error(e) == TRANSIENT:
+            breaker.record_failure()
+        else:
+            breaker.record_success()
+        raise
+    breaker.record_success()
+    return result
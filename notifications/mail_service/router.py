@@ -0,0 +1,146 @@
+# router.py
+
+import logging
+import random
+import threading
+import time
+from collections import namedtuple
+from django.conf import settings
+from .cache import LRUCache
+from .metrics import cache_lookup
+from .email_service import credentials_fingerprint
+from .models import EmailProvider
+from .ratelimit import RateLimited
+from .retry import CircuitOpenError, get_breaker
+
+logger = logging.getLogger(__name__)
+
+Route = namedtuple('Route', ['service_name', 'credentials', 'priority', 'weight'])
+
+
+class ProviderStats:
+    """Exponentially weighted latency and error rate of one provider account."""
+
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.latency = None
+        self.error_rate = 0.0
+        self.calls = 0
+
+    def record(self, latency, success):
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.alpha * (latency - self.latency)
+        self.error_rate += self.alpha * ((0.0 if success else 1.0) - self.error_rate)
+        self.calls += 1
+
+    def health(self):
+        """A 0-1 score that scales a provider's configured weight."""
+        latency = self.latency or 0.0
+        return (1.0 - self.error_rate) / (1.0 + latency / settings.MAIL_SERVICE_ROUTER_REFERENCE_LATENCY)
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def _stats_key(route):
+    return route.service_name, credentials_fingerprint(route.credentials)
+
+
+def _get_stats(route):
+    key = _stats_key(route)
+    with _stats_lock:
+        stats = _stats.get(key)
+        if stats is None:
+            stats = _stats[key] = ProviderStats(settings.MAIL_SERVICE_ROUTER_EWMA_ALPHA)
+        return stats
+
+
+def record_outcome(route, latency, success):
+    stats = _get_stats(route)
+    with _stats_lock:
+        stats.record(latency, success)
+
+
+def provider_stats(route):
+    stats = _get_stats(route)
+    with _stats_lock:
+        return {'latency': stats.latency, 'error_rate': round(stats.error_rate, 4), 'calls': stats.calls,
+                'health': round(stats.health(), 4)}
+
+
+# Active providers per tenant, refreshed every MAIL_SERVICE_ROUTER_PROVIDER_TTL seconds.
+_tenant_routes = LRUCache(max_size=1024, on_lookup=cache_lookup('tenant_routes'))
+
+
+def tenant_routes(tenant):
+    """The tenant's active providers as Routes, cached briefly to keep the query off the send path."""
+    cached = _tenant_routes.get(tenant)
+    if cached is not None and time.monotonic() - cached[0] < settings.MAIL_SERVICE_ROUTER_PROVIDER_TTL:
+        return cached[1]
+    routes = [
+        Route(provider.service_name, provider.credentials, provider.priority, provider.weight)
+        for provider in EmailProvider.objects.filter(tenant=tenant, is_active=True)
+    ]
+    _tenant_routes.set(tenant, (time.monotonic(), routes))
+    return routes
+
+
+def forget_tenant_routes(tenant):
+    """Drop the cached provider list after the tenant's providers change."""
+    _tenant_routes.delete(tenant)
+
+
+def order_routes(routes):
+    """
+    Order routes for one send: by priority, then by weighted random choice.
+
+    Within a priority, each provider's weight is scaled by its live health
+    (error rate and latency), so traffic drifts away from a degraded
+    provider. Providers whose circuit breaker is open go last.
+    """
+    def sort_key(route):
+        breaker_open = get_breaker(route.service_name).snapshot()['state'] == 'open'
+        effective_weight = max(route.weight * _get_stats(route).health(), 1e-6)
+        # Weighted random sampling without replacement (Efraimidis-Spirakis).
+        return breaker_open, route.priority, -random.random() ** (1.0 / effective_weight)
+
+    return sorted(routes, key=sort_key)
+
+
+def email_routes(email_record):
+    """Routes to try for an Email: its own provider if it has one, else the tenant's providers."""
+    if email_record.email_service_name:
+        return [Route(email_record.email_service_name, email_record.email_service_credentials, 0, 1)]
+    return order_routes(tenant_routes(email_record.tenant))
+
+
+def send_with_failover(routes, send):
+    """
+    Call send(route) on each route in turn until one succeeds.
+
+    Returns (route, result) for the first success and re-raises the last
+    error when every route fails.
+    """
+    if not routes:
+        raise ValueError("No email provider is configured for this message.")
+
+    last_error = None
+    for route in routes:
+        started = time.monotonic()
+        try:
+            result = send(route)
+        except (CircuitOpenError, RateLimited) as e:
+            # Skipped without a call, so this says nothing about the provider's health.
+            last_error = e
+            continue
+        except Exception as e:
+            record_outcome(route, time.monotonic() - started, False)
+            logger.warning("Provider %s failed, trying the next one: %s", route.service_name, e)
+            last_error = e
+            continue
+        record_outcome(route, time.monotonic() - started, True)
+        return route, result
+    raise last_error
@@ -0,0 +1,200 @@
+# scheduler.py
+
+import datetime
+import logging
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from .lanes import LANES, FairShare, dispatch_limit, enqueue
+from .metrics import SCHEDULER_JOB_SECONDS, observe_lag
+from .models import Email, Delivery
+
+logger = logging.getLogger(__name__)
+
+
+# One FairShare per lane, kept for the life of the process so credit carries over between sweeps.
+_fair_shares = {}
+
+
+def fair_share(lane):
+    if lane not in _fair_shares:
+        _fair_shares[lane] = FairShare(settings.MAIL_SERVICE_FAIR_SHARE_QUANTUM, settings.MAIL_SERVICE_TENANT_WEIGHTS)
+    return _fair_shares[lane]
+
+
+def due_tenants(lane):
+    """The tenants with due scheduled records in a lane."""
+    return set(Email.objects.due().filter(lane=lane).order_by().values_list('tenant', flat=True).distinct())
+
+
+def claim_due_notifications(batch_size, lane=Email.TRANSACTIONAL, tenants=None):
+    """
+    Claim up to batch_size due scheduled records of a lane and return their ids.
+
+    The batch is split between the tenants with due records by the lane's
+    FairShare, so a tenant with a large campaign gets its weighted share of
+    each batch rather than all of it; each tenant's records go oldest first.
+    tenants is the set from due_tenants(), and tenants found drained are
+    removed from it.
+
+    Rows are locked with SKIP LOCKED, so several schedulers running at once
+    each claim a different set of rows. Claimed rows move to PROCESSING
+    before the transaction commits, so they are never claimed twice, and
+    only the rows this call moved are returned. claimed_at starts the lease
+    that release_stale_claims() enforces.
+    """
+    tenants = due_tenants(lane) if tenants is None else tenants
+    share = fair_share(lane)
+    due = []
+    claimed_at = timezone.now()
+    with transaction.atomic():
+        while len(due) < batch_size and tenants:
+            allocation = share.allocate(tenants, batch_size - len(due))
+            if not any(allocation.values()):
+                # Only tenants without weight are left (see checks.check_fair_share); no round would claim anything.
+                break
+            for tenant, count in allocation.items():
+                if not count:
+                    continue
+                rows = list(
+                    Email.objects.select_for_update(skip_locked=True)
+                    .due()
+                    .filter(lane=lane, tenant=tenant)
+                    .order_by('delivery_time')
+                    .values_list('id', 'delivery_time')[:count]
+                )
+                if rows:
+                    # Claimed at once, so the next round's query for this tenant skips them. The status
+                    # filter keeps this safe on databases without row locks (SQLite).
+                    ids = [email_id for email_id, _ in rows]
+                    moved = Email.objects.filter(id__in=ids, schedule_status=Email.SCHEDULED).update(
+                        schedule_status=Email.PROCESSING, claimed_at=claimed_at)
+                    if moved < len(rows):
+                        # Another scheduler claimed some of them first.
+                        ours = set(Email.objects.filter(id__in=ids, schedule_status=Email.PROCESSING,
+                                                        claimed_at=claimed_at).values_list('id', flat=True))
+                        rows = [row for row in rows if row[0] in ours]
+                    due.extend(rows)
+                if len(rows) < count:
+                    tenants.discard(tenant)
+                    share.drained(tenant)
+    email_ids = [email_id for email_id, _ in due]
+    observe_lag('notifications', [delivery_time for _, delivery_time in due], timezone.now())
+    return email_ids
+
+
+def claim_due_retries(batch_size, lane=Email.TRANSACTIONAL):
+    """
+    Claim up to batch_size deliveries of a lane whose retry is due and return their ids.
+
+    Claimed deliveries go back to 'pending', using the same SKIP LOCKED claim
+    and lease as scheduled records, and are queued by id: the other pending
+    deliveries of their records may already be queued in import chunks.
+    """
+    with transaction.atomic():
+        due = list(
+            Delivery.objects.select_for_update(skip_locked=True)
+            .retry_due()
+            .filter(email__lane=lane)
+            .order_by('next_attempt_at')
+            .values_list('id', 'next_attempt_at')[:batch_size]
+        )
+        if not due:
+            return []
+        claimed = Delivery.objects.filter(id__in=[delivery_id for delivery_id, _ in due], status='retrying')
+        delivery_ids = list(claimed.values_list('id', flat=True))
+        Delivery.objects.filter(id__in=delivery_ids).update(status='pending', next_attempt_at=None,
+                                                            claimed_at=timezone.now())
+    observe_lag('retries', [next_attempt_at for _, next_attempt_at in due], timezone.now())
+    return delivery_ids
+
+
+def release_stale_claims():
+    """
+    Release claims older than MAIL_SERVICE_CLAIM_LEASE whose task never ran,
+    e.g. because queueing it failed or its message was lost: records go back
+    to SCHEDULED and deliveries back to 'retrying', due at once, for the
+    next sweep to dispatch again. Returns the number of records and
+    deliveries released.
+
+    A task that is merely slow is released too, so the lease should be well
+    above the time a queued batch takes to start and finish.
+    """
+    now = timezone.now()
+    expired = now - datetime.timedelta(seconds=settings.MAIL_SERVICE_CLAIM_LEASE)
+    records = Email.objects.filter(is_schedule=True, schedule_status=Email.PROCESSING,
+                                   claimed_at__lt=expired).update(schedule_status=Email.SCHEDULED, claimed_at=None)
+    deliveries = Delivery.objects.filter(status='pending', claimed_at__lt=expired).update(
+        status='retrying', next_attempt_at=now, claimed_at=None)
+    if records or deliveries:
+        logger.warning("Released %s scheduled records and %s retries whose claim expired", records, deliveries)
+    return records + deliveries
+
+
+def _dispatch(claim, send, lane, batch_size, max_batches):
+    """
+    Run claim(batch_size) until the lane's due queue is drained, or its
+    dispatch_limit() reached, and pass the claimed ids to send() in chunks
+    of MAIL_SERVICE_BATCH_TASK_SIZE.
+    """
+    batch_size = batch_size or settings.MAIL_SERVICE_SCHEDULER_BATCH_SIZE
+    chunk_size = settings.MAIL_SERVICE_BATCH_TASK_SIZE
+    limit = dispatch_limit(lane)
+    dispatched = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        size = batch_size if limit is None else min(batch_size, limit - dispatched)
+        if size <= 0:
+            break
+        ids = claim(size)
+        for start in range(0, len(ids), chunk_size):
+            send(ids[start:start + chunk_size])
+        dispatched += len(ids)
+        batches += 1
+        if len(ids) < size:
+            break
+    return dispatched
+
+
+@SCHEDULER_JOB_SECONDS.labels('notifications').time()
+def dispatch_due_notifications(batch_size=None, max_batches=None):
+    """
+    Queue delivery for every scheduled record whose delivery_time has passed.
+
+    Works through the due queue one claimed batch at a time, so memory use
+    does not depend on how many sends are scheduled. Transactional records
+    go first; bulk records are shared fairly between tenants and at most
+    the lane's dispatch_limit() are queued per sweep, so the rest of a
+    large campaign waits in the database, where later records of other
+    tenants can still be taken ahead of it. Returns the number of records
+    queued.
+    """
+    # Imported here because task.py imports this module for its periodic task.
+    from .task import batch_delivery_task
+
+    dispatched = 0
+    for lane in LANES:
+        tenants = due_tenants(lane)
+        if not tenants:
+            continue
+        dispatched += _dispatch(lambda size: claim_due_notifications(size, lane, tenants),
+                                lambda email_ids: enqueue(batch_delivery_task(), lane, email_ids),
+                                lane, batch_size, max_batches)
+    if dispatched:
+        logger.info("Dispatched %s scheduled notifications", dispatched)
+    return dispatched
+
+
+@SCHEDULER_JOB_SECONDS.labels('retries').time()
+def dispatch_due_retries(batch_size=None, max_batches=None):
+    """Queue every delivery whose retry backoff has passed, lane by lane. Returns the number of deliveries queued."""
+    from .task import batch_delivery_task
+
+    dispatched = 0
+    for lane in LANES:
+        dispatched += _dispatch(lambda size: claim_due_retries(size, lane),
+                                lambda delivery_ids: enqueue(batch_delivery_task(), lane, delivery_ids=delivery_ids),
+                                lane, batch_size, max_batches)
+    if dispatched:
+        logger.info("Dispatched %s delivery retries", dispatched)
+    return dispatched
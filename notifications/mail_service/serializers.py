@@ -1,21 +1,318 @@
+from django.conf import settings
+from django.template import TemplateSyntaxError
 from rest_framework import serializers
+from .email_backends import EMAIL_BACKEND_MAPPING
+from .models import Email, EmailProvider, MessageTemplate, RecipientImport, Suppression
+from .records import EMAIL_FIELDS, SCHEDULE_STATES, decode_cursor
+from .rendering import compile_template
+from .tracing import phase
 
+# Topic names accepted by FCM.
+FCM_TOPIC_REGEX = r'^[-a-zA-Z0-9_.~%]+$'
 
-class SendEmailSerializer(serializers.Serializer):
+# Recipient file extension -> RecipientImport.format, when no format is given.
+IMPORT_EXTENSIONS = {'.csv': 'csv', '.ndjson': 'ndjson', '.jsonl': 'ndjson'}
+
+
+def merge_push_targets(data):
+    """Fold the single token into the tokens list and check each chosen action has a target."""
+    tokens = [data.pop('token')] if data.get('token') else []
+    for token in data.get('tokens', []):
+        if token not in tokens:
+            tokens.append(token)
+    data['tokens'] = tokens
+    data.setdefault('topics', [])
+    data.setdefault('condition', '')
+
+    if data.get('mail_action') and not data.get('recipient_list'):
+        raise serializers.ValidationError("A recipient_list is required for mail action.")
+    if data.get('firebase_action') and not (tokens or data['topics'] or data['condition']):
+        raise serializers.ValidationError("A token, tokens, topics or condition is required for firebase action.")
+    return data
+
+
+class TracedValidationMixin:
+    """Times is_valid() as the 'validate' phase of the request trace."""
+
+    def is_valid(self, *, raise_exception=False):
+        with phase('validate'):
+            return super().is_valid(raise_exception=raise_exception)
+
+
+class MessageSerializer(serializers.Serializer):
     subject = serializers.CharField(max_length=255, required=True)
     message = serializers.CharField(required=True)
     recipient_list = serializers.ListField(
         child=serializers.EmailField(),  # Ensure each recipient is a valid email address
         required=True
     )
-    token = serializers.CharField(required=True)
+    token = serializers.CharField(required=False)
+    tokens = serializers.ListField(child=serializers.CharField(), required=False)
+    topics = serializers.ListField(child=serializers.RegexField(FCM_TOPIC_REGEX), required=False)
+    condition = serializers.CharField(required=False)
     mail_action = serializers.BooleanField(default=False)
     firebase_action = serializers.BooleanField(default=False)
+
+    def validate(self, data):
+        return merge_push_targets(data)
+
+
+class TemplateRecipientSerializer(serializers.Serializer):
+    email = serializers.EmailField(required=False)
+    token = serializers.CharField(required=False)
+    context = serializers.DictField(default=dict)
+
+    def validate(self, data):
+        if 'email' not in data and 'token' not in data:
+            raise serializers.ValidationError("An email or token is required for every recipient.")
+        return data
+
+
+class SendEmailSerializer(TracedValidationMixin, MessageSerializer):
+    """
+    A message with a literal subject and body, or a stored template.
+
+    Template sends give template_id, a context shared by every recipient,
+    and recipients carrying their own context; rendering happens on the
+    worker. Pass the tenant in the serializer context.
+    """
+    subject = serializers.CharField(max_length=255, required=False)
+    message = serializers.CharField(required=False)
+    recipient_list = serializers.ListField(child=serializers.EmailField(), required=False)
+    template_id = serializers.PrimaryKeyRelatedField(queryset=MessageTemplate.objects.all(), source='template',
+                                                     required=False)
+    context = serializers.DictField(required=False)
+    recipients = TemplateRecipientSerializer(many=True, required=False,
+                                             max_length=settings.MAIL_SERVICE_BATCH_MAX_SIZE)
     is_schedule = serializers.BooleanField(default=False)
     deliver_time = serializers.DateTimeField(default=False)
+    delivery_time = serializers.DateTimeField(required=False)
     schedule_status = serializers.IntegerField(default=0)
-    email_service_name = serializers.CharField(max_length=255)
-    email_service_api_key = serializers.CharField(max_length=255)
+    # Single sends default to the transactional lane; campaigns should pass 'bulk'.
+    lane = serializers.ChoiceField(choices=Email.LANE_CHOICES, default=Email.TRANSACTIONAL)
+    # Checked by the views, which also accept headers or the tenant's registered providers.
+    email_service_name = serializers.CharField(max_length=255, required=False)
+    email_service_api_key = serializers.CharField(max_length=255, required=False)
     email_service_api_secret = serializers.CharField(max_length=255, required=False)
 
+    def validate(self, data):
+        template = data.get('template')
+        if template is None:
+            missing = {field: ["This field is required."]
+                       for field in ('subject', 'message', 'recipient_list') if field not in data}
+            if missing:
+                raise serializers.ValidationError(missing)
+            if data.get('recipients') or data.get('context'):
+                raise serializers.ValidationError("recipients and context can only be used with template_id.")
+            return super().validate(data)
+
+        if template.tenant != self.context.get('tenant', ''):
+            raise serializers.ValidationError({'template_id': ["Template not found."]})
+        recipient_list = list(data.get('recipient_list', []))
+        tokens = list(data.get('tokens', []))
+        recipient_contexts = {}
+        for recipient in data.pop('recipients', []):
+            if 'email' in recipient:
+                if recipient['email'] not in recipient_list:
+                    recipient_list.append(recipient['email'])
+                recipient_contexts[('email', recipient['email'])] = recipient['context']
+            if 'token' in recipient:
+                if recipient['token'] not in tokens:
+                    tokens.append(recipient['token'])
+                recipient_contexts[('push', recipient['token'])] = recipient['context']
+        data.update(recipient_list=recipient_list, tokens=tokens, recipient_contexts=recipient_contexts,
+                    subject=template.subject, message=template.text_body)
+        return super().validate(data)
+
+
+class BatchTemplateSerializer(serializers.Serializer):
+    subject = serializers.CharField(max_length=255, required=True)
+    message = serializers.CharField(required=True)
+    topics = serializers.ListField(child=serializers.RegexField(FCM_TOPIC_REGEX), required=False)
+    condition = serializers.CharField(required=False)
+    mail_action = serializers.BooleanField(default=False)
+    firebase_action = serializers.BooleanField(default=False)
+
+
+class BatchRecipientSerializer(serializers.Serializer):
+    recipient_list = serializers.ListField(child=serializers.EmailField(), default=list)
+    token = serializers.CharField(required=False)
+    tokens = serializers.ListField(child=serializers.CharField(), required=False)
+
+
+class SendBatchSerializer(TracedValidationMixin, serializers.Serializer):
+    """
+    A batch is either a list of full messages, or one template plus a list
+    of recipient/token rows that share its subject and body.
+    """
+    messages = MessageSerializer(many=True, required=False, max_length=settings.MAIL_SERVICE_BATCH_MAX_SIZE)
+    template = BatchTemplateSerializer(required=False)
+    recipients = BatchRecipientSerializer(many=True, required=False,
+                                          max_length=settings.MAIL_SERVICE_BATCH_MAX_SIZE)
+    lane = serializers.ChoiceField(choices=Email.LANE_CHOICES, default=Email.BULK)
+
+    def validate(self, data):
+        if 'messages' in data:
+            if 'template' in data or 'recipients' in data:
+                raise serializers.ValidationError("Send either messages or template and recipients, not both.")
+            items = data['messages']
+        elif 'template' in data and 'recipients' in data:
+            items = [merge_push_targets({**data['template'], **recipient}) for recipient in data['recipients']]
+        else:
+            raise serializers.ValidationError("Either messages or template and recipients must be provided.")
+
+        if not items:
+            raise serializers.ValidationError("The batch is empty.")
+        for item in items:
+            if not item['mail_action'] and not item['firebase_action']:
+                raise serializers.ValidationError("You must choose at least one action for every message.")
+        return {'items': items, 'lane': data['lane']}
+
+
+class EmailProviderSerializer(serializers.ModelSerializer):
+    service_name = serializers.ChoiceField(choices=list(EMAIL_BACKEND_MAPPING))
+    credentials = serializers.DictField(child=serializers.CharField(), write_only=True)
+
+    class Meta:
+        model = EmailProvider
+        fields = ['id', 'service_name', 'credentials', 'priority', 'weight', 'is_active', 'created_at']
+        read_only_fields = ['id', 'created_at']
+
+    def validate(self, data):
+        credentials = data.get('credentials', getattr(self.instance, 'credentials', {}))
+        service_name = data.get('service_name', getattr(self.instance, 'service_name', None))
+        if not credentials.get('api_key') or (service_name == 'Mailjet' and not credentials.get('api_secret')):
+            raise serializers.ValidationError("API key, and API secret (for Mailjet) must be provided.")
+        return data
+
+
+class RecipientFileSerializer(TracedValidationMixin, serializers.Serializer):
+    """
+    A send whose recipients come from an uploaded CSV or NDJSON file rather
+    than the request body, with a literal subject and body or a template.
+    Pass the tenant in the serializer context.
+    """
+    file = serializers.FileField()
+    format = serializers.ChoiceField(choices=RecipientImport.FORMAT_CHOICES, required=False)
+    subject = serializers.CharField(max_length=255, required=False)
+    message = serializers.CharField(required=False)
+    template_id = serializers.PrimaryKeyRelatedField(queryset=MessageTemplate.objects.all(), source='template',
+                                                     required=False)
+    # Sent as multipart form data, so the shared context is a JSON string.
+    context = serializers.JSONField(binary=True, required=False)
+    mail_action = serializers.BooleanField(default=False)
+    firebase_action = serializers.BooleanField(default=False)
+    lane = serializers.ChoiceField(choices=Email.LANE_CHOICES, default=Email.BULK)
+
+    def validate(self, data):
+        if not data['mail_action'] and not data['firebase_action']:
+            raise serializers.ValidationError("You must choose at least one action.")
+        if 'format' not in data:
+            extension = data['file'].name[data['file'].name.rfind('.'):].lower()
+            if extension not in IMPORT_EXTENSIONS:
+                raise serializers.ValidationError({'format': ["Unknown file type; give csv or ndjson."]})
+            data['format'] = IMPORT_EXTENSIONS[extension]
+        if not isinstance(data.get('context', {}), dict):
+            raise serializers.ValidationError({'context': ["Must be a JSON object."]})
+
+        template = data.get('template')
+        if template is None:
+            missing = {field: ["This field is required."] for field in ('subject', 'message') if field not in data}
+            if missing:
+                raise serializers.ValidationError(missing)
+            if data.get('context'):
+                raise serializers.ValidationError("context can only be used with template_id.")
+            return data
+        if template.tenant != self.context.get('tenant', ''):
+            raise serializers.ValidationError({'template_id': ["Template not found."]})
+        data.update(subject=template.subject, message=template.text_body)
+        return data
+
+
+class RecipientImportSerializer(serializers.ModelSerializer):
+    progress = serializers.SerializerMethodField()
+
+    class Meta:
+        model = RecipientImport
+        fields = ['id', 'email', 'format', 'status', 'progress', 'size', 'bytes_read', 'rows_read',
+                  'rows_imported', 'rows_rejected', 'errors', 'error', 'created_at', 'updated_at', 'completed_at']
+
+    def get_progress(self, recipient_import):
+        """Percentage of the file read so far."""
+        if recipient_import.status == 'completed':
+            return 100.0
+        if not recipient_import.size:
+            return 0.0
+        return round(min(recipient_import.bytes_read / recipient_import.size, 1) * 100, 1)
+
+
+class EmailFieldsSerializer(serializers.Serializer):
+    """The fields query parameter of the email read endpoints: a comma-separated subset of EMAIL_FIELDS."""
+    fields = serializers.CharField(required=False)
+
+    def validate_fields(self, value):
+        fields = [field.strip() for field in value.split(',') if field.strip()]
+        unknown = [field for field in fields if field not in EMAIL_FIELDS]
+        if unknown:
+            raise serializers.ValidationError(f"Unknown fields: {', '.join(unknown)}.")
+        return fields or EMAIL_FIELDS
+
+    def validate(self, data):
+        data.setdefault('fields', EMAIL_FIELDS)
+        return data
+
+
+class EmailFilterSerializer(EmailFieldsSerializer):
+    """Filters of the email list and export, by status, channel, schedule state, lane and creation time."""
+    status = serializers.ChoiceField(choices=Email.STATUS_CHOICES, required=False)
+    channel = serializers.ChoiceField(choices=['email', 'push'], required=False)
+    schedule = serializers.ChoiceField(choices=[*SCHEDULE_STATES, 'none'], required=False)
+    lane = serializers.ChoiceField(choices=Email.LANE_CHOICES, required=False)
+    created_after = serializers.DateTimeField(required=False)
+    created_before = serializers.DateTimeField(required=False)
+
+
+class EmailQuerySerializer(EmailFilterSerializer):
+    """Query parameters of the email list: the filters, page size and the cursor from the previous page."""
+    limit = serializers.IntegerField(min_value=1, max_value=settings.MAIL_SERVICE_LIST_MAX_PAGE_SIZE,
+                                     default=settings.MAIL_SERVICE_LIST_PAGE_SIZE)
+    cursor = serializers.CharField(required=False)
+
+    def validate_cursor(self, value):
+        after = decode_cursor(value)
+        if after is None:
+            raise serializers.ValidationError("Invalid cursor.")
+        return after
+
+
+class EmailExportSerializer(EmailFilterSerializer):
+    """Query parameters of the email export: the list filters and the file format."""
+    format = serializers.ChoiceField(choices=['ndjson', 'csv'], default='ndjson')
+
+
+class MessageTemplateSerializer(serializers.ModelSerializer):
+
+    class Meta:
+        model = MessageTemplate
+        fields = ['id', 'name', 'subject', 'text_body', 'html_body', 'push_title', 'push_body', 'version',
+                  'created_at', 'updated_at']
+        read_only_fields = ['id', 'version', 'created_at', 'updated_at']
+
+    def validate(self, data):
+        # Compile on save so a syntax error is reported now rather than on the worker.
+        parts = {field: data.get(field, getattr(self.instance, field, ''))
+                 for field in ('subject', 'text_body', 'html_body', 'push_title', 'push_body')}
+        try:
+            compile_template(MessageTemplate(**parts))
+        except TemplateSyntaxError as e:
+            raise serializers.ValidationError(f"Invalid template: {e}")
+        return data
+
+
+class SuppressionSerializer(serializers.ModelSerializer):
+    reason = serializers.CharField(max_length=50, default='manual')
 
+    class Meta:
+        model = Suppression
+        fields = ['channel', 'address', 'reason', 'created_at']
+        read_only_fields = ['created_at']
@@ -0,0 +1,176 @@
+# suppression.py
+
+import datetime
+import logging
+import threading
+import time
+from collections import defaultdict
+from celery.concurrency import prefork
+from celery.signals import worker_process_init, worker_ready
+from django.conf import settings
+from django.db import connection
+from .bloom import BloomFilter
+from .models import Suppression
+
+logger = logging.getLogger(__name__)
+
+# Delivery.channel values that can be suppressed; topics and conditions cannot bounce.
+SUPPRESSIBLE_CHANNELS = {'email', 'push'}
+
+
+def normalize_address(channel, address):
+    return address.strip().lower() if channel == 'email' else address
+
+
+def _filter_key(tenant, channel, address):
+    return f'{tenant}\x1f{channel}\x1f{address}'
+
+
+class SuppressionScreen:
+    """
+    Per-process Bloom filter over the Suppression table.
+
+    Only addresses the filter may contain are looked up in the database,
+    so a send to clean addresses costs no query at all. The filter is built
+    in a background thread when a worker process starts (start()); until
+    then recipients are checked against the database directly, so no send
+    waits for the table to be read. Every MAIL_SERVICE_SUPPRESSION_REFRESH
+    seconds rows added by other processes are loaded by created_at, going
+    back MAIL_SERVICE_SUPPRESSION_OVERLAP seconds so rows that committed
+    after newer ones are not missed. The filter is rebuilt, larger, once it
+    outgrows its capacity. Removed suppressions only leave false positives,
+    which the exact check catches.
+    """
+
+    def __init__(self):
+        self.bloom = None
+        self.loaded_until = None  # Latest created_at loaded into the filter
+        self.refreshed_at = None
+        self._building = False
+        self._lock = threading.Lock()
+
+    def _rows(self, since=None):
+        rows = Suppression.objects.all()
+        if since is not None:
+            rows = rows.filter(created_at__gte=since - datetime.timedelta(
+                seconds=settings.MAIL_SERVICE_SUPPRESSION_OVERLAP))
+        return rows.values_list('tenant', 'channel', 'address', 'created_at').iterator(chunk_size=10000)
+
+    def rebuild(self):
+        count = Suppression.objects.count()
+        bloom = BloomFilter(max(count * 2, settings.MAIL_SERVICE_SUPPRESSION_MIN_CAPACITY),
+                            settings.MAIL_SERVICE_SUPPRESSION_ERROR_RATE)
+        loaded_until = None
+        for tenant, channel, address, created_at in self._rows():
+            bloom.add(_filter_key(tenant, channel, address))
+            loaded_until = created_at if loaded_until is None else max(loaded_until, created_at)
+        with self._lock:
+            # Rows added while the table was read are loaded again by the next refresh's overlap.
+            self.bloom, self.loaded_until, self.refreshed_at = bloom, loaded_until, time.monotonic()
+        logger.info("Suppression filter rebuilt with %d addresses.", bloom.count)
+
+    def _build(self):
+        try:
+            self.rebuild()
+        except Exception:
+            logger.exception("Suppression filter build failed; recipients are checked against the database.")
+        finally:
+            self._building = False
+            connection.close()
+
+    def start(self):
+        """Build the filter in a background thread, unless a build is already running."""
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+        threading.Thread(target=self._build, name='suppression-filter', daemon=True).start()
+
+    def refresh(self, force=False):
+        with self._lock:
+            if self.bloom is None:
+                return
+            now = time.monotonic()
+            if not force and now - self.refreshed_at < settings.MAIL_SERVICE_SUPPRESSION_REFRESH:
+                return
+            outgrown = self.bloom.count > self.bloom.capacity
+            if not outgrown:
+                for tenant, channel, address, created_at in self._rows(self.loaded_until):
+                    key = _filter_key(tenant, channel, address)
+                    # Rows in the overlap are already in; adding them again would only inflate the count.
+                    if key not in self.bloom:
+                        self.bloom.add(key)
+                    if self.loaded_until is None or created_at > self.loaded_until:
+                        self.loaded_until = created_at
+            self.refreshed_at = now
+        if outgrown:
+            # The old filter keeps screening until the larger one replaces it.
+            self.start()
+
+    def add(self, tenant, channel, address):
+        """Add a suppression made by this process without waiting for the next refresh."""
+        with self._lock:
+            if self.bloom is not None:
+                self.bloom.add(_filter_key(tenant, channel, address))
+
+    def suppressed(self, tenant, targets):
+        """The (channel, address) pairs among targets that are suppressed for the tenant."""
+        self.refresh()
+        bloom = self.bloom
+        candidates = defaultdict(set)
+        for channel, address in targets:
+            if channel not in SUPPRESSIBLE_CHANNELS:
+                continue
+            normalized = normalize_address(channel, address)
+            # With no filter yet, every target is checked exactly.
+            if bloom is None or _filter_key(tenant, channel, normalized) in bloom:
+                candidates[channel].add(normalized)
+
+        suppressed = set()
+        for channel, addresses in candidates.items():
+            found = set(Suppression.objects.filter(tenant=tenant, channel=channel, address__in=addresses)
+                        .values_list('address', flat=True))
+            suppressed.update((channel, address) for address in found)
+        return {(channel, address) for channel, address in targets
+                if (channel, normalize_address(channel, address)) in suppressed}
+
+
+screen = SuppressionScreen()
+
+
+@worker_process_init.connect
+def _build_in_worker_process(**kwargs):
+    screen.start()
+
+
+@worker_ready.connect
+def _build_in_worker(sender, **kwargs):
+    # Prefork workers build one filter per child, from worker_process_init; other pools run tasks here.
+    if not isinstance(sender.pool, prefork.TaskPool):
+        screen.start()
+
+
+def suppressed_targets(tenant, targets):
+    return screen.suppressed(tenant, targets)
+
+
+def suppress(entries):
+    """
+    Add (tenant, channel, address, reason) entries to the suppression list.
+    Addresses that are already suppressed keep their original reason.
+    """
+    rows = [Suppression(tenant=tenant, channel=channel, address=normalize_address(channel, address), reason=reason)
+            for tenant, channel, address, reason in entries if channel in SUPPRESSIBLE_CHANNELS]
+    if not rows:
+        return 0
+    Suppression.objects.bulk_create(rows, ignore_conflicts=True, batch_size=1000)
+    for row in rows:
+        screen.add(row.tenant, row.channel, row.address)
+    return len(rows)
+
+
+def suppress_deliveries(email_records, deliveries):
+    """Suppress the addresses whose deliveries deliver_email flagged with a suppression_reason."""
+    tenants = {email_record.id: email_record.tenant for email_record in email_records}
+    return suppress((tenants[delivery.email_id], delivery.channel, delivery.address, delivery.suppression_reason)
+                    for delivery in deliveries if delivery.suppression_reason)
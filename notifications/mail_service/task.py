@@ -1,6 +1,167 @@
+from asgiref.sync import async_to_sync, sync_to_async
 from celery import shared_task
-from django.core.mail import send_mail
+from collections import defaultdict
+from django.conf import settings
+from .models import Email, Delivery, RecipientImport
+from .async_delivery import adeliver_emails
+from .delivery import deliver_email, refresh_sent_status, stored_statuses, DELIVERY_UPDATE_FIELDS
+from .idempotency import purge_expired_keys
+from .imports import queue_import_deliveries, run_import
+from .metrics import measure_queue_depths
+from .scheduler import dispatch_due_notifications, dispatch_due_retries, release_stale_claims
+from .suppression import suppress_deliveries
+from .tracing import resume
+
+
+def mark_schedule_sent(email_record):
+    """Close out a claimed scheduled record. Returns the changed fields."""
+    if email_record.is_schedule and email_record.schedule_status == Email.PROCESSING:
+        email_record.schedule_status = Email.SCHEDULE_SENT
+        return ['schedule_status']
+    return []
+
+
+@shared_task
+def send_email_task(email_id):
+    """Deliver a previously accepted Email record and store the outcome."""
+    try:
+        email_record = Email.objects.get(id=email_id)
+    except Email.DoesNotExist:
+        return None
+
+    deliveries = list(email_record.deliveries.filter(status='pending'))
+    updated_fields = deliver_email(email_record, deliveries) + mark_schedule_sent(email_record)
+    Delivery.objects.bulk_update(deliveries, DELIVERY_UPDATE_FIELDS)
+    refresh_sent_status([email_record], deliveries)
+    if updated_fields:
+        email_record.save(update_fields=updated_fields)
+    suppress_deliveries([email_record], deliveries)
+    return email_record.sent_mail_status
+
+
+def pending_deliveries(email_ids, delivery_ids):
+    """
+    The deliveries a batch task sends: the given ones that are still pending,
+    or with no delivery_ids every pending delivery of the records.
+    """
+    if delivery_ids is None:
+        return Delivery.objects.filter(email_id__in=email_ids, status='pending')
+    return Delivery.objects.filter(id__in=delivery_ids, status='pending')
+
+
+@shared_task
+def send_batch_task(email_ids=None, delivery_ids=None):
+    """
+    Deliver a chunk of Email records and write all outcomes in one bulk update per table.
+
+    A retry pass gives delivery_ids instead, so only the claimed deliveries
+    are sent, never others of the same records that are queued elsewhere.
+    """
+    deliveries = list(pending_deliveries(email_ids, delivery_ids))
+    if delivery_ids is not None:
+        email_ids = {delivery.email_id for delivery in deliveries}
+    email_records = list(Email.objects.filter(id__in=email_ids))
+    deliveries_by_email = defaultdict(list)
+    for delivery in deliveries:
+        deliveries_by_email[delivery.email_id].append(delivery)
+
+    for email_record in email_records:
+        # Each record is delivered under the trace of the request that created it.
+        with resume(email_record.trace_id, email_id=email_record.id):
+            deliver_email(email_record, deliveries_by_email[email_record.id])
+        mark_schedule_sent(email_record)
+
+    Delivery.objects.bulk_update(deliveries, DELIVERY_UPDATE_FIELDS, batch_size=1000)
+    refresh_sent_status(email_records, deliveries)
+    Email.objects.bulk_update(email_records, ['sent_mail_status', 'firebase_response', 'schedule_status'])
+    suppress_deliveries(email_records, deliveries)
+    return len(email_records)
+
+
+async def adeliver_batch(email_ids=None, delivery_ids=None):
+    """send_batch_task on the event loop: the records are delivered concurrently, then saved the same way."""
+    deliveries = [delivery async for delivery in pending_deliveries(email_ids, delivery_ids)]
+    if delivery_ids is not None:
+        email_ids = {delivery.email_id for delivery in deliveries}
+    email_records = [email_record async for email_record in Email.objects.filter(id__in=email_ids)]
+
+    await adeliver_emails(email_records, deliveries)
+    for email_record in email_records:
+        mark_schedule_sent(email_record)
+
+    await Delivery.objects.abulk_update(deliveries, DELIVERY_UPDATE_FIELDS, batch_size=1000)
+    await sync_to_async(refresh_sent_status)(email_records, deliveries)
+    await Email.objects.abulk_update(email_records, ['sent_mail_status', 'firebase_response', 'schedule_status'])
+    await sync_to_async(suppress_deliveries)(email_records, deliveries)
+    return len(email_records)
+
+
+@shared_task
+def send_batch_async_task(email_ids=None, delivery_ids=None):
+    """Deliver a chunk of Email records, or of retried deliveries, with many provider calls in flight at once."""
+    return async_to_sync(adeliver_batch)(email_ids, delivery_ids)
+
+
+def batch_delivery_task():
+    """The task that delivers chunks of records: send_batch_async_task with MAIL_SERVICE_ASYNC_WORKERS."""
+    return send_batch_async_task if settings.MAIL_SERVICE_ASYNC_WORKERS else send_batch_task
+
+
+@shared_task
+def import_recipients_task(import_id):
+    """Stream an uploaded recipient file into deliveries, then queue them for sending."""
+    try:
+        recipient_import = RecipientImport.objects.select_related('email').get(id=import_id)
+    except RecipientImport.DoesNotExist:
+        return None
+    run_import(recipient_import)
+    if recipient_import.status == 'completed':
+        # Also when this task is delivered again after the import completed, in case queueing was cut short.
+        queue_import_deliveries(recipient_import)
+    return recipient_import.status
+
+
+@shared_task
+def send_deliveries_task(email_id, delivery_ids):
+    """Deliver one chunk of a large Email's deliveries."""
+    try:
+        email_record = Email.objects.get(id=email_id)
+    except Email.DoesNotExist:
+        return None
+
+    deliveries = list(Delivery.objects.filter(id__in=delivery_ids, status='pending'))
+    deliver_email(email_record, deliveries)
+    Delivery.objects.bulk_update(deliveries, DELIVERY_UPDATE_FIELDS, batch_size=1000)
+    suppress_deliveries([email_record], deliveries)
+
+    sent_mail_status = stored_statuses([email_id])[email_id]
+    Email.objects.filter(id=email_id).update(sent_mail_status=sent_mail_status)
+    return sent_mail_status
+
+
+@shared_task
+def dispatch_due_notifications_task():
+    """
+    Periodic sweep that releases expired claims, queues due scheduled records
+    and due delivery retries, then counts the queues for /metrics.
+    """
+    release_stale_claims()
+    dispatched = dispatch_due_notifications() + dispatch_due_retries()
+    measure_queue_depths()
+    return dispatched
+
+
+@shared_task
+def purge_idempotency_keys_task():
+    """Periodic cleanup of idempotency keys past their TTL."""
+    return purge_expired_keys()
+
 
 @shared_task
-def send_email_task(recipient, subject, body):
-    send_mail(subject, body, 'from@example.com', [recipient])
\ No newline at end of file
+def apply_tracking_events_task(events=None):
+    """Periodic job that applies the saved provider tracking events to their deliveries, in batches."""
+    from .webhooks import apply_stored_events, apply_tracking_events
+    if events is not None:
+        # A batch queued by a release that buffered events in memory.
+        return apply_tracking_events(events)
+    return apply_stored_events()
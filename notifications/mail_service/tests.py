@@ -1,10 +1,57 @@
 from django.test import TestCase, Client
+from django.conf import settings
+from django.core.cache import caches
+from django.core.exceptions import ImproperlyConfigured
 from django.urls import reverse
 from django.core import mail
-from .models import Email
+from django.core.management import call_command
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext, override_settings
+from .models import Email, Delivery, EmailProvider, IdempotencyKey, RecipientImport, Suppression, TrackingEvent
+from . import router
 from .serializers import SendEmailSerializer
+from .checks import check_fair_share, check_metrics_cache, check_webhook_secret
+from .scheduler import claim_due_notifications, dispatch_due_notifications, dispatch_due_retries, release_stale_claims
+from .lanes import FairShare
+from . import retry
+from . import ratelimit
+from anymail.exceptions import AnymailRequestsAPIError
+from django.utils import timezone
+from .cache import LRUCache
+from .bloom import BloomFilter
+from .suppression import SuppressionScreen
+from . import suppression
+import base64
+from .email_service import backend_cache, get_dynamic_email_backend
+from . import firebase_service
+from . import imports
+from . import tracing
+from .task import (send_batch_task, send_batch_async_task, send_email_task, import_recipients_task,
+                   purge_idempotency_keys_task, apply_tracking_events_task)
+from .async_delivery import asend_push
+from .concurrency import submit
+from asgiref.sync import async_to_sync
+import asyncio
+from .delivery import send_push, summarize_push_results, build_deliveries, deliver_email, batch_size
+from .rendering import get_compiled_template, render_email, template_cache
+from anymail.message import AnymailStatus, AnymailRecipientStatus
+from firebase_admin import messaging
+from prometheus_client import REGISTRY
+from .metrics import QUEUE_DEPTHS_KEY, measure_queue_depths
+from django.core.files.uploadedfile import SimpleUploadedFile
+from cryptography.fernet import Fernet
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+import firebase_admin
+import requests
+import tempfile
+import threading
+import io
+import csv
 from rest_framework import status
+from unittest import mock
 import json
+import os
 import datetime
 
 class TestSendEmailView(TestCase):
@@ -31,14 +78,111 @@ class TestSendEmailView(TestCase):
             'firebase_action': False
         }
 
-    def test_send_email_valid_data(self):
-        response = self.client.post(reverse('send_email'), self.valid_data, HTTP_ACCEPT='application/json')
-        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.headers = {
+            'HTTP_X_EMAIL_SERVICE': 'Mailjet',
+            'HTTP_X_EMAIL_SERVICE_API_KEY': 'test_api_key',
+            'HTTP_X_EMAIL_SERVICE_API_SECRET': 'test_api_secret',
+        }
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_send_email_valid_data(self, send_email_message):
+        response = self.client.post(reverse('send_email'), self.valid_data, HTTP_ACCEPT='application/json',
+                                    **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        email_record = Email.objects.get(id=response.json()['id'])
+        self.assertEqual(email_record.sent_mail_status, 'sent')
+        send_email_message.assert_called_once()
+
+    @mock.patch('mail_service.delivery.send_email_message', side_effect=Exception('provider down'))
+    def test_send_email_provider_failure_is_recorded(self, send_email_message):
+        response = self.client.post(reverse('send_email'), self.valid_data, HTTP_ACCEPT='application/json',
+                                    **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        email_record = Email.objects.get(id=response.json()['id'])
+        self.assertEqual(email_record.sent_mail_status, 'failed')
 
     def test_send_email_invalid_data(self):
         response = self.client.post(reverse('send_email'), self.invalid_data, HTTP_ACCEPT='application/json')
         self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
 
+    def test_mail_action_without_recipients_is_rejected(self):
+        data = {**self.valid_data, 'recipient_list': []}
+        response = self.client.post(reverse('send_email'), json.dumps(data), content_type='application/json',
+                                    **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Email.objects.exists())
+
+    def test_record_without_deliveries_fails(self):
+        email_record = Email.objects.create(
+            subject='S', message='B', recipient_list='', token='', mail_action=True,
+            email_service_name='SendGrid', email_service_credentials={'api_key': 'test_api_key'})
+        self.assertEqual(send_email_task(email_record.id), 'failed')
+        email_record.refresh_from_db()
+        self.assertEqual(email_record.sent_mail_status, 'failed')
+
+
+class TestSendBatchView(TestCase):
+
+    def setUp(self):
+        self.client = Client()
+        self.headers = {
+            'HTTP_X_EMAIL_SERVICE': 'SendGrid',
+            'HTTP_X_EMAIL_SERVICE_API_KEY': 'test_api_key',
+        }
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_send_batch_messages(self, send_email_message):
+        data = {'messages': [
+            {'subject': f'Subject {i}', 'message': 'Body', 'recipient_list': [f'user{i}@example.com'],
+             'token': 'test_token', 'mail_action': True}
+            for i in range(3)
+        ]}
+        # The chunks are queued once the records commit.
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            response = self.client.post(reverse('send_batch'), json.dumps(data), content_type='application/json',
+                                        **self.headers)
+        self.assertEqual(len(callbacks), 1)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        results = response.json()['results']
+        self.assertEqual(len(results), 3)
+        self.assertEqual(Email.objects.filter(id__in=[r['id'] for r in results], sent_mail_status='sent').count(), 3)
+        self.assertEqual(send_email_message.call_count, 3)
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_send_batch_template(self, send_email_message):
+        data = {
+            'template': {'subject': 'Campaign', 'message': 'Body', 'mail_action': True},
+            'recipients': [{'recipient_list': ['a@example.com']}, {'recipient_list': ['b@example.com']}],
+        }
+        response = self.client.post(reverse('send_batch'), json.dumps(data), content_type='application/json',
+                                    **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(list(Email.objects.values_list('recipient_list', flat=True).order_by('id')),
+                         ['a@example.com', 'b@example.com'])
+
+    def test_send_batch_rejects_mixed_payload(self):
+        data = {
+            'messages': [{'subject': 'S', 'message': 'B', 'recipient_list': ['a@example.com'], 'token': 't',
+                          'mail_action': True}],
+            'template': {'subject': 'Campaign', 'message': 'Body', 'mail_action': True},
+        }
+        response = self.client.post(reverse('send_batch'), json.dumps(data), content_type='application/json',
+                                    **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertFalse(Email.objects.exists())
+
+    def test_failed_delivery_insert_leaves_no_records(self):
+        data = {'messages': [{'subject': 'S', 'message': 'B', 'recipient_list': ['a@example.com'],
+                              'mail_action': True}]}
+        client = Client(raise_request_exception=False)
+        with mock.patch.object(Delivery.objects, 'bulk_create', side_effect=IntegrityError('insert failed')), \
+                mock.patch.object(send_batch_task, 'apply_async') as apply_async:
+            response = client.post(reverse('send_batch'), json.dumps(data), content_type='application/json',
+                                   **self.headers)
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse(Email.objects.exists())
+        apply_async.assert_not_called()
+
 
 class TestScheduleNotificationView(TestCase):
 
@@ -95,4 +239,1345 @@ class TestCancelNotificationView(TestCase):
 
     def test_cancel_notification_invalid_job_id(self):
         response = self.client.delete(reverse('cancel_notification', args=[999]), HTTP_ACCEPT='application/json')
-        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
\ No newline at end of file
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_cancel_notification_already_dispatched(self):
+        Email.objects.filter(id=self.email.id).update(schedule_status=Email.PROCESSING)
+        response = self.client.delete(reverse('cancel_notification', args=[self.email.id]), HTTP_ACCEPT='application/json')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+
+class TestScheduler(TestCase):
+
+    def schedule(self, delivery_time, **kwargs):
+        email_record = Email.objects.create(
+            subject='Scheduled', message='Body', recipient_list='test@example.com', token='',
+            mail_action=True, is_schedule=True, delivery_time=delivery_time, sent_mail_status='scheduled',
+            email_service_name='SendGrid', email_service_credentials={'api_key': 'test_api_key'}, **kwargs)
+        Delivery.objects.bulk_create(build_deliveries(email_record))
+        return email_record
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_due_records_are_sent_once(self, send_email_message):
+        due = self.schedule(timezone.now() - datetime.timedelta(minutes=1))
+        future = self.schedule(timezone.now() + datetime.timedelta(hours=1))
+        canceled = self.schedule(timezone.now() - datetime.timedelta(minutes=1), schedule_status=Email.CANCELED)
+
+        self.assertEqual(dispatch_due_notifications(), 1)
+        self.assertEqual(dispatch_due_notifications(), 0)
+        send_email_message.assert_called_once()
+
+        due.refresh_from_db()
+        self.assertEqual((due.schedule_status, due.sent_mail_status), (Email.SCHEDULE_SENT, 'sent'))
+        future.refresh_from_db()
+        self.assertEqual(future.schedule_status, Email.SCHEDULED)
+        canceled.refresh_from_db()
+        self.assertEqual(canceled.schedule_status, Email.CANCELED)
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_due_queue_is_drained_in_batches(self, send_email_message):
+        for _ in range(5):
+            self.schedule(timezone.now() - datetime.timedelta(minutes=1))
+        self.assertEqual(dispatch_due_notifications(batch_size=2), 5)
+        self.assertEqual(Email.objects.filter(schedule_status=Email.SCHEDULE_SENT).count(), 5)
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_lost_dispatch_is_released_after_the_lease(self, send_email_message):
+        email_record = self.schedule(timezone.now() - datetime.timedelta(minutes=1))
+        with mock.patch('mail_service.scheduler.enqueue'):
+            self.assertEqual(dispatch_due_notifications(), 1)
+        self.assertEqual(release_stale_claims(), 0)
+        response = self.client.delete(reverse('cancel_notification', args=[email_record.id]))
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        expired = timezone.now() - datetime.timedelta(seconds=settings.MAIL_SERVICE_CLAIM_LEASE + 1)
+        Email.objects.update(claimed_at=expired)
+        self.assertEqual(release_stale_claims(), 1)
+        email_record.refresh_from_db()
+        self.assertEqual(email_record.schedule_status, Email.SCHEDULED)
+        self.assertEqual(dispatch_due_notifications(), 1)
+        send_email_message.assert_called_once()
+
+    def test_lost_retry_is_released_after_the_lease(self):
+        email_record = self.schedule(timezone.now() - datetime.timedelta(minutes=1),
+                                     schedule_status=Email.SCHEDULE_SENT)
+        email_record.deliveries.update(status='retrying', next_attempt_at=timezone.now())
+        with mock.patch('mail_service.scheduler.enqueue'):
+            self.assertEqual(dispatch_due_retries(), 1)
+        self.assertEqual(email_record.deliveries.get().status, 'pending')
+
+        expired = timezone.now() - datetime.timedelta(seconds=settings.MAIL_SERVICE_CLAIM_LEASE + 1)
+        Delivery.objects.update(claimed_at=expired)
+        self.assertEqual(release_stale_claims(), 1)
+        self.assertEqual(email_record.deliveries.get().status, 'retrying')
+        with mock.patch('mail_service.delivery.send_email_message', return_value=None):
+            self.assertEqual(dispatch_due_retries(), 1)
+        self.assertEqual(email_record.deliveries.get().status, 'sent')
+
+
+
+class TestDeliveryLanes(TestCase):
+
+    def schedule(self, tenant, lane, count=1):
+        email_records = Email.objects.bulk_create([Email(
+            subject=tenant, message='Body', recipient_list='test@example.com', token='', mail_action=True,
+            is_schedule=True, delivery_time=timezone.now() - datetime.timedelta(minutes=1),
+            sent_mail_status='scheduled', email_service_name='SendGrid',
+            email_service_credentials={'api_key': 'test_api_key'}, tenant=tenant, lane=lane,
+        ) for _ in range(count)])
+        Delivery.objects.bulk_create(
+            [delivery for email_record in email_records for delivery in build_deliveries(email_record)])
+
+    def test_fair_share_splits_slots_by_weight(self):
+        share = FairShare(quantum=1, weights={'big': 2})
+        totals = {'big': 0, 'small': 0}
+        for _ in range(10):
+            for tenant, slots in share.allocate(totals, 3).items():
+                totals[tenant] += slots
+        self.assertEqual(totals, {'big': 20, 'small': 10})
+
+        share.drained('small')
+        self.assertEqual(share.allocate({'big'}, 5), {'big': 5})
+
+    def test_tenant_without_weight_does_not_stall_the_claim(self):
+        self.schedule('t0', Email.BULK)
+        with mock.patch('mail_service.scheduler._fair_shares', {}), \
+                self.settings(MAIL_SERVICE_TENANT_WEIGHTS={'t0': 0}):
+            self.assertEqual(claim_due_notifications(10, Email.BULK), [])
+            self.assertEqual([error.id for error in check_fair_share(None)], ['mail_service.E002'])
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_campaign_does_not_hold_up_other_tenants(self, send_email_message):
+        self.schedule('campaign', Email.BULK, count=20)
+        self.schedule('newsletter', Email.BULK, count=2)
+        self.schedule('otp', Email.TRANSACTIONAL)
+
+        # A quantum of one record, so the shares show within a single small batch.
+        with mock.patch('mail_service.scheduler._fair_shares', {}), \
+                self.settings(MAIL_SERVICE_FAIR_SHARE_QUANTUM=1):
+            self.assertEqual(dispatch_due_notifications(batch_size=6, max_batches=1), 7)
+
+        tenants = [call.args[0] for call in send_email_message.call_args_list]
+        self.assertEqual(tenants[0], 'otp')
+        self.assertEqual(tenants.count('newsletter'), 2)
+        self.assertEqual(tenants.count('campaign'), 4)
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_sends_are_queued_on_their_lane(self, send_email_message):
+        headers = {'HTTP_X_EMAIL_SERVICE': 'SendGrid', 'HTTP_X_EMAIL_SERVICE_API_KEY': 'test_api_key'}
+        with mock.patch.object(send_email_task, 'apply_async') as apply_async:
+            self.client.post(reverse('send_email'), {
+                'subject': 'Reset', 'message': 'Body', 'recipient_list': ['test@example.com'], 'mail_action': True,
+            }, **headers)
+        self.assertEqual(apply_async.call_args.kwargs['queue'], 'mail_transactional')
+
+        with mock.patch.object(send_batch_task, 'apply_async') as apply_async, \
+                self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('send_batch'), json.dumps({
+                'template': {'subject': 'News', 'message': 'Body', 'mail_action': True},
+                'recipients': [{'recipient_list': ['test@example.com']}],
+            }), content_type='application/json', **headers)
+        self.assertEqual(apply_async.call_args.kwargs['queue'], 'mail_bulk')
+        self.assertEqual(Email.objects.get(subject='News').lane, Email.BULK)
+
+
+class TestEmailQuerySet(TestCase):
+
+    def test_due_pending_and_failed_since(self):
+        now = timezone.now()
+        due = Email.objects.create(subject='S', message='B', recipient_list='a@example.com', token='',
+                                   is_schedule=True, delivery_time=now - datetime.timedelta(minutes=1))
+        Email.objects.create(subject='S', message='B', recipient_list='a@example.com', token='',
+                             is_schedule=True, delivery_time=now + datetime.timedelta(minutes=1))
+        failed = Email.objects.create(subject='S', message='B', recipient_list='a@example.com', token='',
+                                      sent_mail_status='failed')
+
+        self.assertEqual(list(Email.objects.due(now)), [due])
+        self.assertEqual(Email.objects.pending().count(), 2)
+        self.assertEqual(list(Email.objects.failed_since(now - datetime.timedelta(hours=1))), [failed])
+        self.assertFalse(Email.objects.failed_since(now + datetime.timedelta(hours=1)).exists())
+
+
+class TestLRUCache(TestCase):
+
+    def test_evicts_least_recently_used(self):
+        evicted = []
+        cache = LRUCache(max_size=2, on_evict=lambda key, value: evicted.append(key))
+        cache.get_or_create('a', lambda: 1)
+        cache.get_or_create('b', lambda: 2)
+        cache.get('a')
+        cache.get_or_create('c', lambda: 3)
+        self.assertEqual(evicted, ['b'])
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_idle_entries_expire(self):
+        cache = LRUCache(max_size=10, idle_timeout=60)
+        with mock.patch('mail_service.cache.time.monotonic', return_value=0):
+            cache.get_or_create('a', lambda: 1)
+        with mock.patch('mail_service.cache.time.monotonic', return_value=61):
+            self.assertEqual(cache.evict_idle(), 1)
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_held_value_is_closed_on_release(self):
+        evicted = []
+        cache = LRUCache(max_size=1, on_evict=lambda key, value: evicted.append(key))
+        held = cache.acquire('a', lambda: object())
+        cache.get_or_create('b', lambda: object())
+        self.assertEqual(evicted, [])
+        cache.release(held)
+        self.assertEqual(evicted, ['a'])
+
+    def test_build_does_not_block_other_keys(self):
+        cache = LRUCache(max_size=10)
+        started = threading.Event()
+        finish = threading.Event()
+
+        def slow_build():
+            started.set()
+            finish.wait(5)
+            return 'slow'
+
+        builder = threading.Thread(target=cache.get_or_create, args=('slow', slow_build))
+        builder.start()
+        started.wait(5)
+        # The slow build holds only its own key.
+        self.assertEqual(cache.get_or_create('fast', lambda: 'fast'), 'fast')
+        finish.set()
+        builder.join(5)
+        self.assertEqual(cache.get_or_create('slow', lambda: 'rebuilt'), 'slow')
+
+
+class TestEmailBackendCache(TestCase):
+
+    def tearDown(self):
+        backend_cache.clear()
+
+    def test_backend_is_reused_per_credentials(self):
+        first = get_dynamic_email_backend('SendGrid', {'api_key': 'key-1'})
+        again = get_dynamic_email_backend('SendGrid', {'api_key': 'key-1'})
+        other = get_dynamic_email_backend('SendGrid', {'api_key': 'key-2'})
+        self.assertIs(first, again)
+        self.assertIsNot(first, other)
+        self.assertIsNotNone(first.session)
+
+    def test_evicted_backend_is_closed(self):
+        backend = get_dynamic_email_backend('SendGrid', {'api_key': 'key-1'})
+        backend_cache.clear()
+        self.assertIsNone(backend.session)
+
+
+def make_service_account_json(project_id='test-project'):
+    """Build a syntactically valid service-account file with a throwaway key."""
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                            serialization.NoEncryption()).decode()
+    return json.dumps({
+        'type': 'service_account',
+        'project_id': project_id,
+        'private_key_id': 'test',
+        'private_key': pem,
+        'client_email': f'firebase@{project_id}.iam.gserviceaccount.com',
+        'client_id': '1',
+        'token_uri': 'https://oauth2.googleapis.com/token',
+    }).encode()
+
+
+class TestFirebaseCredentialStore(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.service_account = make_service_account_json()
+
+    def setUp(self):
+        self.media_root = tempfile.TemporaryDirectory()
+        storage = override_settings(MEDIA_ROOT=self.media_root.name)
+        storage.enable()
+        self.addCleanup(storage.disable)
+        self.addCleanup(self.media_root.cleanup)
+        self.addCleanup(firebase_service.firebase_app_cache.clear)
+
+    def upload(self):
+        return SimpleUploadedFile('credential.json', self.service_account, content_type='application/json')
+
+    def test_same_credentials_are_stored_once(self):
+        first = firebase_service.save_credential_file(self.upload())
+        second = firebase_service.save_credential_file(self.upload())
+        self.assertEqual(first, second)
+        self.assertEqual(os.listdir(os.path.join(self.media_root.name, 'firebase')), [f'{first}.json'])
+
+    def test_upload_is_not_counted_as_a_cache_lookup(self):
+        fingerprint = firebase_service.save_credential_file(self.upload())
+        firebase_service.get_firebase_app(fingerprint)
+        stats = firebase_service.firebase_app_cache.stats()
+        firebase_service.save_credential_file(self.upload())
+        self.assertEqual(firebase_service.firebase_app_cache.stats(), stats)
+
+    def test_app_is_reused_and_deleted_on_eviction(self):
+        fingerprint = firebase_service.save_credential_file(self.upload())
+        app = firebase_service.get_firebase_app(fingerprint)
+        self.assertEqual(app.name, fingerprint)
+        self.assertIs(firebase_service.get_firebase_app(fingerprint), app)
+
+        firebase_service.firebase_app_cache.clear()
+        with self.assertRaises(ValueError):
+            firebase_admin.get_app(fingerprint)
+
+
+def fake_batch_response(messages_or_multicast, app=None):
+    """Stand-in for send_each/send_each_for_multicast; tokens starting with 'stale' are unregistered."""
+    if isinstance(messages_or_multicast, messaging.MulticastMessage):
+        targets = messages_or_multicast.tokens
+    else:
+        targets = [message.topic or message.condition for message in messages_or_multicast]
+    return messaging.BatchResponse([
+        messaging.SendResponse(None, messaging.UnregisteredError('gone')) if target.startswith('stale')
+        else messaging.SendResponse({'name': f'projects/p/messages/{target}'}, None)
+        for target in targets
+    ])
+
+
+@mock.patch('mail_service.delivery.firebase_app')
+@mock.patch('firebase_admin.messaging.send_each', side_effect=fake_batch_response)
+@mock.patch('firebase_admin.messaging.send_each_for_multicast', side_effect=fake_batch_response)
+class TestSendPush(TestCase):
+
+    def test_tokens_are_sent_in_chunks_of_500(self, send_each_for_multicast, send_each, firebase_app):
+        tokens = [f'token-{i}' for i in range(1001)]
+        results = send_push('Subject', 'Body', tokens, [], '', 'fingerprint')
+        self.assertEqual(send_each_for_multicast.call_count, 3)
+        self.assertEqual(len(results), 1001)
+        self.assertTrue(all(result['success'] for result in results))
+        send_each.assert_not_called()
+
+    @mock.patch('mail_service.ratelimit._store', None)
+    def test_rate_limit_is_taken_per_fcm_call(self, send_each_for_multicast, send_each, firebase_app):
+        tokens = [f'token-{i}' for i in range(1001)]
+        with self.settings(MAIL_SERVICE_RATE_LIMITS={'Firebase': {'rate': 0.01, 'burst': 500}}):
+            results = send_push('Subject', 'Body', tokens, [], '', 'limited')
+        # The first call takes the whole burst; the other 501 targets wait for the bucket.
+        send_each_for_multicast.assert_called_once()
+        self.assertEqual(sum(result['success'] for result in results), 500)
+        self.assertEqual(sum('retry_in' in result for result in results), 501)
+
+    def test_unregistered_tokens_are_reported(self, send_each_for_multicast, send_each, firebase_app):
+        results = send_push('Subject', 'Body', ['token-1', 'stale-1'], ['news'], "'news' in topics", 'fingerprint')
+        summary = json.loads(summarize_push_results(results))
+        self.assertEqual(summary['success_count'], 3)
+        self.assertEqual(summary['failure_count'], 1)
+        self.assertEqual(summary['unregistered_tokens'], ['stale-1'])
+        self.assertEqual(summary['failures'], [{'type': 'token', 'target': 'stale-1', 'error': 'gone'}])
+        self.assertNotIn('results', summary)
+        send_each.assert_called_once()
+
+
+class TestDeliveries(TestCase):
+
+    def setUp(self):
+        self.email_record = Email.objects.create(
+            subject='S', message='B', recipient_list='ok@example.com,bad@example.com', token='token-1,stale-1',
+            mail_action=True, firebase_action=True, email_service_name='SendGrid',
+            email_service_credentials={'api_key': 'test_api_key'}, firebase_credential='fingerprint')
+        Delivery.objects.bulk_create(build_deliveries(self.email_record))
+
+    def test_build_deliveries(self):
+        self.assertEqual(
+            sorted(self.email_record.deliveries.values_list('channel', 'address')),
+            [('email', 'bad@example.com'), ('email', 'ok@example.com'), ('push', 'stale-1'), ('push', 'token-1')])
+
+    @mock.patch('mail_service.delivery.firebase_app')
+    @mock.patch('firebase_admin.messaging.send_each_for_multicast', side_effect=fake_batch_response)
+    @mock.patch('mail_service.delivery.send_email_message')
+    def test_outcome_is_recorded_per_recipient(self, send_email_message, send_each_for_multicast, firebase_app):
+        anymail_status = AnymailStatus()
+        anymail_status.set_recipient_status({
+            'ok@example.com': AnymailRecipientStatus(message_id='msg-1', status='queued'),
+            'bad@example.com': AnymailRecipientStatus(message_id=None, status='rejected'),
+        })
+        send_email_message.return_value = anymail_status
+
+        deliveries = list(self.email_record.deliveries.all())
+        deliver_email(self.email_record, deliveries)
+        outcome = {(d.address, d.status, d.provider_message_id, d.attempts) for d in deliveries}
+
+        self.assertEqual(outcome, {
+            ('ok@example.com', 'sent', 'msg-1', 1),
+            ('bad@example.com', 'failed', '', 1),
+            ('token-1', 'sent', 'projects/p/messages/token-1', 1),
+            ('stale-1', 'failed', '', 1),
+        })
+        self.assertEqual(self.email_record.sent_mail_status, 'sent')
+
+    @mock.patch('mail_service.delivery.firebase_app')
+    @mock.patch('firebase_admin.messaging.send_each_for_multicast', side_effect=fake_batch_response)
+    def test_push_is_sent_when_the_email_fails(self, send_each_for_multicast, firebase_app):
+        deliveries = list(self.email_record.deliveries.all())
+        with mock.patch('mail_service.delivery.send_email_message', side_effect=provider_error(400)):
+            updated_fields = deliver_email(self.email_record, deliveries)
+
+        self.assertEqual({(d.channel, d.status) for d in deliveries if d.address != 'stale-1'},
+                         {('email', 'failed'), ('push', 'sent')})
+        self.assertIn('firebase_response', updated_fields)
+        self.assertEqual(self.email_record.sent_mail_status, 'sent')
+
+    def test_executor_closes_its_connections(self):
+        # acquire() may query a database cache on an executor thread, which nothing else would close.
+        with mock.patch('mail_service.concurrency.connections') as connections:
+            submit(len, []).result()
+        connections.close_all.assert_called_once()
+
+
+async def fake_batch_response_async(messages_or_multicast, app=None):
+    return fake_batch_response(messages_or_multicast, app)
+
+
+class TestAsyncSendPath(TestCase):
+
+    def setUp(self):
+        self.email_record = Email.objects.create(
+            subject='S', message='B', recipient_list='ok@example.com', token='token-1,stale-1',
+            mail_action=True, firebase_action=True, email_service_name='SendGrid',
+            email_service_credentials={'api_key': 'test_api_key'}, firebase_credential='fingerprint')
+        Delivery.objects.bulk_create(build_deliveries(self.email_record))
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_async_send_email_delivers_before_responding(self, send_email_message):
+        response = Client().post(reverse('async_send_email'), json.dumps({
+            'subject': 'Hi', 'message': 'Body', 'recipient_list': ['a@example.com'], 'mail_action': True,
+        }), content_type='application/json', HTTP_X_EMAIL_SERVICE='SendGrid', HTTP_X_EMAIL_SERVICE_API_KEY='key')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.json()['status'], 'sent')
+        self.assertEqual(Delivery.objects.get(email_id=response.json()['id']).status, 'sent')
+        send_email_message.assert_called_once()
+
+    @mock.patch('mail_service.async_delivery.release_firebase_app')
+    @mock.patch('mail_service.async_delivery.acquire_firebase_app')
+    @mock.patch('firebase_admin.messaging.send_each_for_multicast_async',
+                side_effect=fake_batch_response_async)
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_async_batch_task_records_outcomes(self, send_email_message, send_each_for_multicast_async,
+                                               acquire_firebase_app, release_firebase_app):
+        send_batch_async_task([self.email_record.id])
+
+        self.assertEqual(sorted(self.email_record.deliveries.values_list('address', 'status')), [
+            ('ok@example.com', 'sent'), ('stale-1', 'failed'), ('token-1', 'sent')])
+        self.email_record.refresh_from_db()
+        self.assertEqual(self.email_record.sent_mail_status, 'sent')
+        self.assertEqual(json.loads(self.email_record.firebase_response)['unregistered_tokens'], ['stale-1'])
+
+    @mock.patch('mail_service.async_delivery.release_firebase_app')
+    @mock.patch('mail_service.async_delivery.acquire_firebase_app')
+    def test_fcm_calls_are_bounded_by_the_semaphore(self, acquire_firebase_app, release_firebase_app):
+        in_flight = []
+        peak = []
+
+        async def send_each_for_multicast_async(multicast, app=None):
+            in_flight.append(multicast)
+            peak.append(len(in_flight))
+            await asyncio.sleep(0.01)
+            in_flight.remove(multicast)
+            return fake_batch_response(multicast)
+
+        tokens = [f'token-{i}' for i in range(2001)]
+        with self.settings(MAIL_SERVICE_ASYNC_CONCURRENCY=2), \
+                mock.patch('firebase_admin.messaging.send_each_for_multicast_async',
+                           side_effect=send_each_for_multicast_async):
+            results = async_to_sync(asend_push)('Subject', 'Body', tokens, [], '', 'fingerprint')
+        self.assertEqual(len(results), 2001)
+        self.assertEqual(len(peak), 5)
+        self.assertEqual(max(peak), 2)
+
+
+def provider_error(status_code):
+    response = requests.Response()
+    response.status_code = status_code
+    response.reason = 'Provider error'
+    response._content = b''
+    return AnymailRequestsAPIError('provider error', status_code=status_code,
+                                   response=response if status_code else None)
+
+
+class TestRetry(TestCase):
+
+    def test_classify_error(self):
+        self.assertEqual(retry.classify_error(provider_error(503)), retry.TRANSIENT)
+        self.assertEqual(retry.classify_error(provider_error(429)), retry.TRANSIENT)
+        self.assertEqual(retry.classify_error(provider_error(None)), retry.TRANSIENT)
+        self.assertEqual(retry.classify_error(provider_error(401)), retry.PERMANENT)
+        self.assertEqual(retry.classify_error(messaging.UnregisteredError('gone')), retry.PERMANENT)
+        self.assertEqual(retry.classify_error(retry.CircuitOpenError()), retry.TRANSIENT)
+
+    def test_backoff_is_capped(self):
+        with self.settings(MAIL_SERVICE_RETRY_BASE_DELAY=10, MAIL_SERVICE_RETRY_MAX_DELAY=60):
+            with mock.patch('mail_service.retry.random.uniform', side_effect=lambda low, high: high):
+                self.assertEqual([retry.backoff_delay(attempt) for attempt in range(1, 6)], [10, 20, 40, 60, 60])
+
+    def test_breaker_opens_and_recovers(self):
+        breaker = retry.CircuitBreaker('Test', failure_threshold=2, reset_timeout=30)
+        with mock.patch('mail_service.retry.time.monotonic', return_value=0):
+            breaker.record_failure()
+            self.assertTrue(breaker.allow())
+            breaker.record_failure()
+            self.assertFalse(breaker.allow())
+        with mock.patch('mail_service.retry.time.monotonic', return_value=31):
+            self.assertTrue(breaker.allow())
+            self.assertFalse(breaker.allow())  # Only one trial call while half-open.
+            breaker.record_success()
+        self.assertEqual(breaker.snapshot()['state'], retry.CircuitBreaker.CLOSED)
+
+
+@mock.patch.dict('mail_service.retry._breakers', clear=True)
+class TestDeliveryRetries(TestCase):
+
+    def setUp(self):
+        self.email_record = Email.objects.create(
+            subject='S', message='B', recipient_list='a@example.com', token='', mail_action=True,
+            email_service_name='SendGrid', email_service_credentials={'api_key': 'test_api_key'})
+        Delivery.objects.bulk_create(build_deliveries(self.email_record))
+
+    def test_transient_failure_is_retried(self):
+        with mock.patch('mail_service.delivery.send_email_message', side_effect=provider_error(503)):
+            send_batch_task([self.email_record.id])
+        delivery = self.email_record.deliveries.get()
+        self.assertEqual((delivery.status, delivery.attempts), ('retrying', 1))
+        self.assertIsNotNone(delivery.next_attempt_at)
+
+        Delivery.objects.update(next_attempt_at=timezone.now() - datetime.timedelta(seconds=1))
+        with mock.patch('mail_service.delivery.send_email_message', return_value=None) as send_email_message:
+            self.assertEqual(dispatch_due_retries(), 1)
+        send_email_message.assert_called_once()
+        delivery.refresh_from_db()
+        self.assertEqual((delivery.status, delivery.attempts), ('sent', 2))
+
+    def test_retry_sends_only_the_claimed_deliveries(self):
+        # The other recipient is pending in an import chunk that is already queued.
+        Delivery.objects.create(email=self.email_record, channel='email', address='b@example.com')
+        self.email_record.deliveries.filter(address='a@example.com').update(
+            status='retrying', next_attempt_at=timezone.now() - datetime.timedelta(seconds=1))
+        with mock.patch('mail_service.delivery.send_email_message', return_value=None) as send_email_message:
+            self.assertEqual(dispatch_due_retries(), 1)
+        self.assertEqual(send_email_message.call_args.args[2], ['a@example.com'])
+        self.assertEqual(self.email_record.deliveries.get(address='b@example.com').status, 'pending')
+
+    @mock.patch('mail_service.delivery.firebase_app')
+    @mock.patch('firebase_admin.messaging.send_each_for_multicast', side_effect=fake_batch_response)
+    def test_retry_keeps_status_of_deliveries_already_sent(self, send_each_for_multicast, firebase_app):
+        email_record = Email.objects.create(
+            subject='S', message='B', recipient_list='b@example.com', token='token-1', mail_action=True,
+            firebase_action=True, email_service_name='SendGrid', email_service_credentials={'api_key': 'test_api_key'},
+            firebase_credential='fingerprint')
+        Delivery.objects.bulk_create(build_deliveries(email_record))
+        with mock.patch('mail_service.delivery.send_email_message', side_effect=provider_error(503)):
+            send_batch_task([email_record.id])
+        email_record.refresh_from_db()
+        self.assertEqual(email_record.sent_mail_status, 'sent')
+
+        Delivery.objects.filter(status='retrying').update(next_attempt_at=timezone.now() - datetime.timedelta(seconds=1))
+        with mock.patch('mail_service.delivery.send_email_message', side_effect=provider_error(400)):
+            self.assertEqual(dispatch_due_retries(), 1)
+        self.assertEqual(dict(email_record.deliveries.values_list('channel', 'status')),
+                         {'email': 'failed', 'push': 'sent'})
+        email_record.refresh_from_db()
+        self.assertEqual(email_record.sent_mail_status, 'sent')
+
+    def test_permanent_failure_is_not_retried(self):
+        with mock.patch('mail_service.delivery.send_email_message', side_effect=provider_error(400)):
+            send_batch_task([self.email_record.id])
+        self.assertEqual(self.email_record.deliveries.get().status, 'failed')
+
+    def test_open_breaker_fails_fast(self):
+        with self.settings(MAIL_SERVICE_BREAKER_FAILURE_THRESHOLD=1):
+            retry.get_breaker('SendGrid').record_failure()
+        with mock.patch('mail_service.delivery.send_email_message') as send_email_message:
+            send_batch_task([self.email_record.id])
+        send_email_message.assert_not_called()
+        self.assertEqual(self.email_record.deliveries.get().status, 'retrying')
+        response = self.client.get(reverse('circuit_breakers'))
+        self.assertEqual(response.json()['SendGrid']['state'], 'open')
+
+
+class TestCredentialEncryption(TestCase):
+
+    def stored(self, model, field, pk):
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT {field} FROM {model._meta.db_table} WHERE id = %s', [pk])
+            return cursor.fetchone()[0]
+
+    def test_credentials_are_stored_encrypted(self):
+        email_record = Email.objects.create(
+            subject='S', message='B', recipient_list='a@example.com', token='', mail_action=True,
+            email_service_name='SendGrid', email_service_credentials={'api_key': 'secret-key'})
+        provider = EmailProvider.objects.create(tenant='acme', service_name='Postmark',
+                                                credentials={'api_key': 'other-secret'})
+
+        self.assertNotIn('secret-key', self.stored(Email, 'email_service_credentials', email_record.id))
+        self.assertNotIn('other-secret', self.stored(EmailProvider, 'credentials', provider.id))
+        self.assertEqual(Email.objects.get(id=email_record.id).email_service_credentials, {'api_key': 'secret-key'})
+        self.assertEqual(EmailProvider.objects.get(id=provider.id).credentials, {'api_key': 'other-secret'})
+
+    def test_old_key_still_decrypts_after_rotation(self):
+        old_key, new_key = Fernet.generate_key().decode(), Fernet.generate_key().decode()
+        with self.settings(MAIL_SERVICE_CREDENTIAL_KEYS=[old_key]):
+            provider = EmailProvider.objects.create(tenant='acme', service_name='Postmark', credentials={'api_key': 'k'})
+        with self.settings(MAIL_SERVICE_CREDENTIAL_KEYS=[new_key, old_key]):
+            self.assertEqual(EmailProvider.objects.get(id=provider.id).credentials, {'api_key': 'k'})
+        with self.settings(MAIL_SERVICE_CREDENTIAL_KEYS=[new_key]), self.assertRaises(ImproperlyConfigured):
+            EmailProvider.objects.get(id=provider.id)
+
+
+@mock.patch.dict('mail_service.retry._breakers', clear=True)
+@mock.patch.dict('mail_service.router._stats', clear=True)
+class TestProviderRouting(TestCase):
+
+    def setUp(self):
+        self.headers = {'HTTP_X_TENANT_ID': 'acme'}
+        for service_name, priority in [('SendGrid', 0), ('Mailgun', 1)]:
+            response = self.client.post(reverse('email_providers'), json.dumps({
+                'service_name': service_name, 'credentials': {'api_key': f'{service_name}-key'},
+                'priority': priority,
+            }), content_type='application/json', **self.headers)
+            self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+
+    def test_order_by_priority_and_breaker(self):
+        routes = router.tenant_routes('acme')
+        self.assertEqual([route.service_name for route in router.order_routes(routes)], ['SendGrid', 'Mailgun'])
+        breaker = retry.get_breaker('SendGrid')
+        for _ in range(breaker.failure_threshold):
+            breaker.record_failure()
+        self.assertEqual([route.service_name for route in router.order_routes(routes)], ['Mailgun', 'SendGrid'])
+
+    def test_weights_share_traffic(self):
+        routes = [router.Route('SendGrid', {'api_key': 'a'}, 0, 3), router.Route('Mailgun', {'api_key': 'b'}, 0, 1)]
+        first = [router.order_routes(routes)[0].service_name for _ in range(2000)]
+        self.assertAlmostEqual(first.count('SendGrid') / len(first), 0.75, delta=0.05)
+
+    def test_registered_provider_sends_routed_mail(self):
+        provider = EmailProvider.objects.get(tenant='acme', service_name='SendGrid')
+        self.assertEqual(provider.credentials, {'api_key': 'SendGrid-key'})
+
+        data = {'subject': 'S', 'message': 'B', 'recipient_list': ['a@example.com'], 'mail_action': True}
+        with mock.patch('mail_service.delivery.send_email_message', return_value=None) as send_email_message:
+            response = self.client.post(reverse('send_email'), json.dumps(data), content_type='application/json',
+                                        **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED, response.content)
+        # The record keeps no credentials of its own; the provider's are used at delivery time.
+        email_record = Email.objects.get(id=response.json()['id'])
+        self.assertEqual((email_record.email_service_name, email_record.email_service_credentials), ('', {}))
+        email_backend = send_email_message.call_args.args[3]
+        self.assertEqual((email_backend.esp_name, email_backend.api_key), ('SendGrid', 'SendGrid-key'))
+        delivery = Delivery.objects.get(email=email_record)
+        self.assertEqual((delivery.status, delivery.provider), ('sent', 'SendGrid'))
+
+    def test_send_fails_over_to_next_provider(self):
+        def send_email_message(subject, message, recipient_list, email_backend, html_message='', batch=False):
+            if email_backend.esp_name == 'SendGrid':
+                raise provider_error(503)
+
+        data = {'subject': 'S', 'message': 'B', 'recipient_list': ['a@example.com'], 'mail_action': True}
+        with mock.patch('mail_service.delivery.send_email_message', side_effect=send_email_message):
+            response = self.client.post(reverse('send_email'), json.dumps(data), content_type='application/json',
+                                        **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED, response.content)
+        delivery = Delivery.objects.get(email_id=response.json()['id'])
+        self.assertEqual((delivery.status, delivery.provider), ('sent', 'Mailgun'))
+
+        providers = self.client.get(reverse('email_providers'), **self.headers).json()
+        self.assertNotIn('credentials', providers[0])
+        self.assertEqual(providers[0]['health']['error_rate'], 0.2)
+
+
+@mock.patch('mail_service.ratelimit._store', None)
+class TestRateLimit(TestCase):
+
+    def setUp(self):
+        self.email_record = Email.objects.create(
+            subject='S', message='B', recipient_list='a@example.com', token='', mail_action=True,
+            email_service_name='SendGrid', email_service_credentials={'api_key': 'test_api_key'})
+        Delivery.objects.bulk_create(build_deliveries(self.email_record))
+
+    def test_token_bucket_refills(self):
+        store = ratelimit.MemoryStore()
+        with mock.patch('mail_service.ratelimit.time.time', return_value=100):
+            self.assertEqual(store.take('k', 1, 2, 1), 0)
+            self.assertEqual(store.take('k', 1, 2, 1), 0)
+            self.assertEqual(store.take('k', 1, 2, 1), 1)
+        with mock.patch('mail_service.ratelimit.time.time', return_value=101):
+            self.assertEqual(store.take('k', 1, 2, 1), 0)
+
+    def test_cache_store_is_shared(self):
+        with self.settings(MAIL_SERVICE_RATE_LIMIT_STORE='mail_service.ratelimit.CacheStore'):
+            self.assertEqual(ratelimit.CacheStore().take('shared', 0.01, 1, 1), 0)
+            self.assertGreater(ratelimit.CacheStore().take('shared', 0.01, 1, 1), 0)
+
+    def test_non_positive_rate_is_rejected(self):
+        with self.settings(MAIL_SERVICE_RATE_LIMITS={'SendGrid': {'rate': 0}}), \
+                self.assertRaises(ImproperlyConfigured):
+            ratelimit.acquire('SendGrid', 'account')
+
+    def test_per_process_store_is_refused_with_a_broker(self):
+        for store in ('mail_service.ratelimit.MemoryStore', 'mail_service.ratelimit.CacheStore'):
+            with self.settings(MAIL_SERVICE_RATE_LIMIT_STORE=store, CELERY_TASK_ALWAYS_EAGER=False), \
+                    self.assertRaises(ImproperlyConfigured):
+                ratelimit.get_store()
+
+    def test_over_limit_send_is_deferred(self):
+        limits = {'SendGrid': {'rate': 0.01, 'burst': 1}}
+        with self.settings(MAIL_SERVICE_RATE_LIMITS=limits), \
+                mock.patch('mail_service.delivery.send_email_message', return_value=None) as send_email_message:
+            send_batch_task([self.email_record.id])
+            send_email_message.assert_called_once()
+            Delivery.objects.update(status='pending')
+            send_batch_task([self.email_record.id])
+            send_email_message.assert_called_once()
+        delivery = self.email_record.deliveries.get()
+        self.assertEqual((delivery.status, delivery.attempts), ('retrying', 1))
+        self.assertGreater(delivery.next_attempt_at, timezone.now() + datetime.timedelta(seconds=90))
+        self.email_record.refresh_from_db()
+        self.assertEqual(self.email_record.sent_mail_status, 'pending')
+
+
+@mock.patch('mail_service.rendering.template_cache', LRUCache(max_size=8))
+class TestMessageTemplates(TestCase):
+
+    def setUp(self):
+        self.headers = {
+            'HTTP_X_EMAIL_SERVICE': 'SendGrid',
+            'HTTP_X_EMAIL_SERVICE_API_KEY': 'test_api_key',
+        }
+        response = self.client.post(reverse('message_templates'), json.dumps({
+            'name': 'welcome',
+            'subject': 'Hi {{ name }}',
+            'text_body': 'Welcome to {{ product }}, {{ name }}.',
+            'html_body': '<p>Welcome, {{ name }}</p>',
+        }), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED, response.content)
+        self.template_id = response.json()['id']
+
+    def test_invalid_template_is_rejected(self):
+        response = self.client.post(reverse('message_templates'), json.dumps({
+            'name': 'broken', 'subject': 'Hi {% if %}', 'text_body': 'B'}), content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_send_renders_per_recipient(self):
+        data = {
+            'template_id': self.template_id,
+            'context': {'product': 'Acme', 'name': 'there'},
+            'recipient_list': ['c@example.com', 'd@example.com'],
+            'recipients': [
+                {'email': 'a@example.com', 'context': {'name': 'Ann'}},
+                {'email': 'b@example.com', 'context': {'name': '<b>Bob</b>'}},
+            ],
+            'mail_action': True,
+        }
+        with mock.patch('mail_service.delivery.send_email_message', return_value=None) as send_email_message:
+            response = self.client.post(reverse('send_email'), json.dumps(data), content_type='application/json',
+                                        **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED, response.content)
+
+        # Recipients without their own context share one rendering and one send.
+        sends = {call.args[0]: (call.args[1], sorted(call.args[2]), call.kwargs['html_message'])
+                 for call in send_email_message.call_args_list}
+        self.assertEqual(sends, {
+            'Hi there': ('Welcome to Acme, there.', ['c@example.com', 'd@example.com'], '<p>Welcome, there</p>'),
+            'Hi Ann': ('Welcome to Acme, Ann.', ['a@example.com'], '<p>Welcome, Ann</p>'),
+            'Hi <b>Bob</b>': ('Welcome to Acme, <b>Bob</b>.', ['b@example.com'],
+                              '<p>Welcome, &lt;b&gt;Bob&lt;/b&gt;</p>'),
+        })
+        self.assertEqual(Delivery.objects.filter(email_id=response.json()['id'], status='sent').count(), 4)
+
+    def test_update_bumps_version_and_recompiles(self):
+        compiled = get_compiled_template(self.template_id, 1)
+        self.assertIs(get_compiled_template(self.template_id, 1), compiled)
+
+        response = self.client.put(reverse('message_template_detail', args=[self.template_id]), json.dumps({
+            'name': 'welcome', 'subject': 'Hello {{ name }}', 'text_body': 'B'}), content_type='application/json')
+        self.assertEqual(response.json()['version'], 2)
+        self.assertEqual(render_email(get_compiled_template(self.template_id, 2), {'name': 'Ann'})[0], 'Hello Ann')
+
+    def test_record_is_rendered_from_its_own_version(self):
+        data = {'template_id': self.template_id, 'context': {'name': 'Ann', 'product': 'Acme'},
+                'recipient_list': ['a@example.com'], 'mail_action': True}
+        with mock.patch('mail_service.views.send_email_task'):
+            response = self.client.post(reverse('send_email'), json.dumps(data), content_type='application/json',
+                                        **self.headers)
+        self.client.put(reverse('message_template_detail', args=[self.template_id]), json.dumps({
+            'name': 'welcome', 'subject': 'Changed {{ name }}', 'text_body': 'B'}), content_type='application/json')
+
+        template_cache.clear()
+        with mock.patch('mail_service.delivery.send_email_message', return_value=None) as send_email_message:
+            send_email_task(response.json()['id'])
+        self.assertEqual(send_email_message.call_args.args[:2], ('Hi Ann', 'Welcome to Acme, Ann.'))
+
+    def test_template_of_another_tenant_is_not_found(self):
+        data = {'template_id': self.template_id, 'recipient_list': ['a@example.com'], 'mail_action': True}
+        response = self.client.post(reverse('send_email'), json.dumps(data), content_type='application/json',
+                                    HTTP_X_TENANT_ID='other', **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class TestBatchSending(TestCase):
+
+    def setUp(self):
+        backend_cache.clear()
+        self.email_record = Email.objects.create(
+            subject='S', message='B', recipient_list='a@example.com,b@example.com,c@example.com', token='',
+            mail_action=True, email_service_name='SendGrid', email_service_credentials={'api_key': 'key'})
+        Delivery.objects.bulk_create(build_deliveries(self.email_record))
+
+    def tearDown(self):
+        backend_cache.clear()
+
+    def test_recipients_are_sent_individually_in_chunks(self):
+        response = requests.Response()
+        response.status_code = 202
+        response._content = b''
+        with self.settings(MAIL_SERVICE_BATCH_SEND_SIZE=2), \
+                mock.patch('requests.Session.request', return_value=response) as request:
+            send_batch_task([self.email_record.id])
+
+        payloads = [json.loads(call.kwargs['data']) for call in request.call_args_list]
+        # One personalization per recipient, so nobody sees the other addresses.
+        self.assertEqual([[p['to'] for p in payload['personalizations']] for payload in payloads], [
+            [[{'email': 'a@example.com'}], [{'email': 'b@example.com'}]],
+            [[{'email': 'c@example.com'}]],
+        ])
+        deliveries = list(self.email_record.deliveries.all())
+        self.assertEqual({delivery.status for delivery in deliveries}, {'sent'})
+        self.assertEqual(len({delivery.provider_message_id for delivery in deliveries}), 3)
+
+    def test_batch_size_follows_provider_limits(self):
+        routes = [router.Route('SendGrid', {}, 0, 1), router.Route('Mailjet', {}, 1, 1)]
+        self.assertEqual(batch_size(routes), 50)
+        self.assertEqual(batch_size([router.Route('Postal', {}, 0, 1)]), 1000)
+
+
+class TestIdempotency(TestCase):
+
+    def setUp(self):
+        self.headers = {
+            'HTTP_X_EMAIL_SERVICE': 'SendGrid',
+            'HTTP_X_EMAIL_SERVICE_API_KEY': 'test_api_key',
+        }
+        self.data = {'subject': 'S', 'message': 'B', 'recipient_list': ['a@example.com'], 'mail_action': True}
+
+    def post(self, data, **headers):
+        return self.client.post(reverse('send_email'), json.dumps(data), content_type='application/json',
+                                **self.headers, **headers)
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_retried_request_returns_original_record(self, send_email_message):
+        first = self.post(self.data, HTTP_IDEMPOTENCY_KEY='order-42')
+        second = self.post(self.data, HTTP_IDEMPOTENCY_KEY='order-42')
+        self.assertEqual(second.status_code, status.HTTP_202_ACCEPTED)
+        self.assertEqual(second.json()['id'], first.json()['id'])
+        self.assertEqual(second['Idempotent-Replayed'], 'true')
+        self.assertEqual(Email.objects.count(), 1)
+        send_email_message.assert_called_once()
+
+        changed = self.post({**self.data, 'subject': 'Other'}, HTTP_IDEMPOTENCY_KEY='order-42')
+        self.assertEqual(changed.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_content_hash(self, send_email_message):
+        with self.settings(MAIL_SERVICE_IDEMPOTENCY_CONTENT_HASH=True):
+            self.post(self.data)
+            self.post(self.data)
+            self.post({**self.data, 'recipient_list': ['b@example.com']})
+        self.assertEqual(Email.objects.count(), 2)
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_expired_keys_are_reusable_and_purged(self, send_email_message):
+        self.post(self.data, HTTP_IDEMPOTENCY_KEY='order-42')
+        IdempotencyKey.objects.update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        response = self.post(self.data, HTTP_IDEMPOTENCY_KEY='order-42')
+        self.assertNotIn('Idempotent-Replayed', response)
+        self.assertEqual(Email.objects.count(), 2)
+
+        IdempotencyKey.objects.update(expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        self.assertEqual(purge_idempotency_keys_task(), 1)
+        self.assertFalse(IdempotencyKey.objects.exists())
+
+    def test_conflict_with_a_purged_key_asks_for_a_retry(self):
+        # A concurrent request stored the key first, and it expired and was purged before the replay lookup.
+        with mock.patch('mail_service.views.create_email_record', return_value=None):
+            response = self.post(self.data, HTTP_IDEMPOTENCY_KEY='order-42')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+
+@mock.patch('mail_service.suppression.screen', new_callable=SuppressionScreen)
+class TestSuppression(TestCase):
+
+    def setUp(self):
+        self.email_record = Email.objects.create(
+            subject='S', message='B', recipient_list='a@example.com,B@Example.com', token='',
+            mail_action=True, email_service_name='SendGrid', email_service_credentials={'api_key': 'key'})
+        Delivery.objects.bulk_create(build_deliveries(self.email_record))
+
+    def test_bloom_filter(self, screen):
+        bloom = BloomFilter(1000, 0.01)
+        for i in range(1000):
+            bloom.add(f'user{i}@example.com')
+        self.assertTrue(all(f'user{i}@example.com' in bloom for i in range(1000)))
+        false_positives = sum(f'other{i}@example.com' in bloom for i in range(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_suppressed_address_is_skipped(self, screen):
+        response = self.client.post(reverse('suppressions'),
+                                    json.dumps({'channel': 'email', 'address': 'b@example.com'}),
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        with mock.patch('mail_service.delivery.send_email_message', return_value=None) as send_email_message:
+            send_batch_task([self.email_record.id])
+        self.assertEqual(send_email_message.call_args.args[2], ['a@example.com'])
+        self.assertEqual(self.email_record.deliveries.get(address='B@Example.com').status, 'suppressed')
+
+        response = self.client.delete(reverse('suppressions') + '?address=B@example.com')
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(screen.suppressed('', {('email', 'b@example.com')}), set())
+
+    def test_rejected_recipient_is_suppressed(self, screen):
+        anymail_status = AnymailStatus()
+        anymail_status.set_recipient_status({
+            'a@example.com': AnymailRecipientStatus(message_id='1', status='queued'),
+            'B@Example.com': AnymailRecipientStatus(message_id=None, status='rejected'),
+        })
+        with mock.patch('mail_service.delivery.send_email_message', return_value=anymail_status):
+            send_batch_task([self.email_record.id])
+        self.assertEqual(Suppression.objects.get().address, 'b@example.com')
+
+        # Other processes see it after their next refresh; this one sees it straight away.
+        self.assertEqual(screen.suppressed('', {('email', 'B@EXAMPLE.COM')}), {('email', 'B@EXAMPLE.COM')})
+        other = SuppressionScreen()
+        self.assertEqual(other.suppressed('', {('email', 'b@example.com'), ('email', 'a@example.com')}),
+                         {('email', 'b@example.com')})
+        self.assertEqual(other.suppressed('acme', {('email', 'b@example.com')}), set())
+
+
+    def test_no_filter_checks_the_database_without_building_one(self, screen):
+        Suppression.objects.create(channel='email', address='b@example.com', reason='manual')
+        with mock.patch.object(screen, 'rebuild') as rebuild, self.assertNumQueries(1):
+            self.assertEqual(screen.suppressed('', {('email', 'b@example.com'), ('email', 'a@example.com')}),
+                             {('email', 'b@example.com')})
+        rebuild.assert_not_called()
+
+    def test_refresh_loads_rows_that_committed_late(self, screen):
+        Suppression.objects.create(channel='email', address='late@example.com', reason='manual')
+        Suppression.objects.create(channel='email', address='first@example.com', reason='manual')
+        # The first row's transaction committed after the second's, and after the filter was built.
+        Suppression.objects.filter(address='late@example.com').update(
+            created_at=timezone.now() - datetime.timedelta(seconds=1))
+        with mock.patch.object(Suppression.objects, 'all', return_value=Suppression.objects.exclude(
+                address='late@example.com')):
+            screen.rebuild()
+        self.assertNotIn(suppression._filter_key('', 'email', 'late@example.com'), screen.bloom)
+
+        screen.refresh(force=True)
+        self.assertIn(suppression._filter_key('', 'email', 'late@example.com'), screen.bloom)
+        self.assertEqual(screen.bloom.count, 2)
+
+
+@mock.patch('mail_service.suppression.screen', new_callable=SuppressionScreen)
+class TestTrackingWebhooks(TestCase):
+
+    def setUp(self):
+        self.email_record = Email.objects.create(
+            subject='S', message='B', recipient_list='a@example.com,b@example.com', token='', mail_action=True,
+            sent_mail_status='sent')
+        Delivery.objects.bulk_create([
+            Delivery(email=self.email_record, channel='email', address='a@example.com', status='sent',
+                     provider_message_id='m1'),
+            Delivery(email=self.email_record, channel='email', address='b@example.com', status='sent',
+                     provider_message_id='m2'),
+        ])
+        self.auth = {'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(b'user:pass').decode()}
+
+    def post_events(self, events):
+        with self.settings(ANYMAIL={'WEBHOOK_SECRET': 'user:pass'}):
+            response = self.client.post('/anymail/sendgrid/tracking/', json.dumps(events),
+                                        content_type='application/json', **self.auth)
+        self.assertEqual(response.status_code, 200)
+
+    def test_events_are_saved_and_applied_in_batches(self, screen):
+        self.post_events([
+            {'event': 'delivered', 'email': 'a@example.com', 'anymail_id': 'm1', 'timestamp': 1700000000},
+            {'event': 'bounce', 'type': 'bounce', 'email': 'b@example.com', 'anymail_id': 'm2',
+             'reason': 'mailbox unavailable', 'timestamp': 1700000001},
+        ])
+        self.post_events([{'event': 'open', 'email': 'a@example.com', 'anymail_id': 'm1',
+                           'timestamp': 1700000100}])
+        self.assertEqual(TrackingEvent.objects.count(), 3)
+        self.assertFalse(Delivery.objects.exclude(tracking_status='').exists())
+
+        with self.settings(MAIL_SERVICE_WEBHOOK_BATCH_SIZE=2):
+            self.assertEqual(apply_tracking_events_task(), 3)
+        self.assertFalse(TrackingEvent.objects.exists())
+        first, second = self.email_record.deliveries.order_by('address')
+        self.assertEqual((first.status, first.tracking_status), ('sent', 'opened'))
+        self.assertEqual((second.status, second.tracking_status), ('failed', 'bounced'))
+        self.assertEqual(second.error, 'Bounced: mailbox unavailable')
+        self.assertTrue(Suppression.objects.filter(address='b@example.com', reason='bounced').exists())
+        self.email_record.refresh_from_db()
+        self.assertEqual(self.email_record.sent_mail_status, 'sent')
+
+    def test_bounce_of_only_recipient_fails_the_email(self, screen):
+        Delivery.objects.filter(address='a@example.com').delete()
+        self.post_events([{'event': 'bounce', 'type': 'bounce', 'email': 'b@example.com', 'anymail_id': 'm2',
+                           'timestamp': 1700000001}])
+        apply_tracking_events_task()
+        self.email_record.refresh_from_db()
+        self.assertEqual(self.email_record.sent_mail_status, 'failed')
+
+    def test_webhook_without_secret_rejects_events(self, screen):
+        with self.settings(ANYMAIL={'WEBHOOK_SECRET': ''}):
+            response = self.client.post('/anymail/sendgrid/tracking/', json.dumps([
+                {'event': 'bounce', 'type': 'bounce', 'email': 'b@example.com', 'anymail_id': 'm2',
+                 'timestamp': 1700000001}]), content_type='application/json')
+            self.assertEqual([warning.id for warning in check_webhook_secret(None)], ['mail_service.W001'])
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        self.assertFalse(TrackingEvent.objects.exists())
+
+
+class TestRecipientImport(TestCase):
+
+    def setUp(self):
+        self.headers = {
+            'HTTP_X_EMAIL_SERVICE': 'SendGrid',
+            'HTTP_X_EMAIL_SERVICE_API_KEY': 'test_api_key',
+        }
+        self.media_root = tempfile.TemporaryDirectory()
+        storage = override_settings(MEDIA_ROOT=self.media_root.name)
+        storage.enable()
+        self.addCleanup(storage.disable)
+        self.addCleanup(self.media_root.cleanup)
+        self.template = self.client.post(reverse('message_templates'), json.dumps({
+            'name': 'campaign', 'subject': 'Hi {{ name }}', 'text_body': '{{ greeting }}, {{ name }}.',
+        }), content_type='application/json').json()
+
+    def upload(self, name, content, **data):
+        return self.client.post(reverse('recipient_imports'), {
+            'file': SimpleUploadedFile(name, content), 'mail_action': True, **data}, **self.headers)
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_csv_is_imported_in_chunks_and_sent(self, send_email_message):
+        content = (b'email,name\r\nann@example.com,Ann\r\nnot-an-email,Bob\r\n'
+                   b'cat@example.com,Cat\r\n,Dan\r\nemu@example.com,\r\n')
+        with self.settings(MAIL_SERVICE_IMPORT_CHUNK_SIZE=2):
+            response = self.upload('recipients.csv', content, template_id=self.template['id'],
+                                   context=json.dumps({'greeting': 'Hello', 'name': 'there'}))
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED, response.content)
+
+        progress = self.client.get(reverse('recipient_import_detail', args=[response.json()['id']])).json()
+        self.assertEqual(progress['status'], 'completed')
+        self.assertEqual(progress['progress'], 100.0)
+        self.assertEqual((progress['rows_read'], progress['rows_imported'], progress['rows_rejected']), (5, 3, 2))
+        self.assertEqual([error['line'] for error in progress['errors']], [3, 5])
+
+        email_record = Email.objects.get(id=progress['email'])
+        self.assertEqual(email_record.recipient_list, '')
+        self.assertEqual(email_record.sent_mail_status, 'sent')
+        self.assertEqual(set(email_record.deliveries.values_list('status', flat=True)), {'sent'})
+        subjects = sorted(call.args[0] for call in send_email_message.call_args_list)
+        self.assertEqual(subjects, ['Hi Ann', 'Hi Cat', 'Hi there'])
+        self.assertFalse(os.listdir(os.path.join(self.media_root.name, imports.IMPORTS_DIR)))
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_redelivered_task_resumes_after_imported_rows(self, send_email_message):
+        content = b'email\r\nann@example.com\r\nbob@example.com\r\ncat@example.com\r\n'
+        with mock.patch('mail_service.views.enqueue'):
+            response = self.upload('recipients.csv', content, subject='Hi', message='Body')
+        recipient_import = RecipientImport.objects.get(id=response.json()['id'])
+        # The first run committed one chunk before its worker died.
+        Delivery.objects.create(email=recipient_import.email, channel='email', address='ann@example.com')
+        RecipientImport.objects.filter(id=recipient_import.id).update(rows_read=1, rows_imported=1)
+
+        self.assertEqual(import_recipients_task(recipient_import.id), 'completed')
+        self.assertEqual(sorted(recipient_import.email.deliveries.values_list('address', flat=True)),
+                         ['ann@example.com', 'bob@example.com', 'cat@example.com'])
+        self.assertEqual(set(recipient_import.email.deliveries.values_list('status', flat=True)), {'sent'})
+        send_email_message.assert_called_once()
+
+        # Once the import is over, another delivery of the task does nothing.
+        self.assertEqual(import_recipients_task(recipient_import.id), 'completed')
+        self.assertEqual(recipient_import.email.deliveries.count(), 3)
+        send_email_message.assert_called_once()
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_redelivered_task_queues_a_completed_import(self, send_email_message):
+        content = b'email\r\nann@example.com\r\nbob@example.com\r\n'
+        with mock.patch('mail_service.views.enqueue'):
+            response = self.upload('recipients.csv', content, subject='Hi', message='Body')
+        recipient_import = RecipientImport.objects.get(id=response.json()['id'])
+        # The worker died after the import completed, before its deliveries were queued.
+        with mock.patch('mail_service.imports.enqueue', side_effect=RuntimeError('worker lost')), \
+                self.assertRaises(RuntimeError):
+            import_recipients_task(recipient_import.id)
+        self.assertEqual(set(recipient_import.email.deliveries.values_list('status', flat=True)), {'pending'})
+
+        self.assertEqual(import_recipients_task(recipient_import.id), 'completed')
+        self.assertEqual(set(recipient_import.email.deliveries.values_list('status', flat=True)), {'sent'})
+        send_email_message.assert_called_once()
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_ndjson_rows_are_validated(self, send_email_message):
+        content = (b'{"email": "ann@example.com", "context": {"name": "Ann"}}\n'
+                   b'not json\n'
+                   b'{"token": "device-1"}\n')
+        response = self.upload('recipients.ndjson', content, subject='Hi', message='Body')
+        self.assertEqual(response.status_code, status.HTTP_202_ACCEPTED, response.content)
+
+        recipient_import = RecipientImport.objects.get(id=response.json()['id'])
+        self.assertEqual((recipient_import.rows_imported, recipient_import.rows_rejected), (1, 2))
+        self.assertEqual(list(recipient_import.email.deliveries.values_list('address', 'context')),
+                         [('ann@example.com', {'name': 'Ann'})])
+        send_email_message.assert_called_once()
+
+    def test_unknown_file_type_is_rejected(self):
+        response = self.upload('recipients.txt', b'email\n', subject='Hi', message='Body')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('format', response.json()['errors'])
+
+
+
+class TestEmailReadAPI(TestCase):
+
+    def setUp(self):
+        self.headers = {'HTTP_X_TENANT_ID': 'acme'}
+        self.emails = Email.objects.bulk_create([Email(
+            subject=f'Message {i}', message='A long body', recipient_list=f'user{i}@example.com', token='',
+            mail_action=True, firebase_action=i % 2 == 0, sent_mail_status='failed' if i % 3 == 0 else 'sent',
+            tenant='acme',
+        ) for i in range(7)])
+        # Rows created in the same instant are told apart by id.
+        Email.objects.filter(id__in=[email.id for email in self.emails[:4]]).update(
+            created_at=timezone.now() - datetime.timedelta(hours=1))
+        Email.objects.create(subject='Other tenant', message='Body', recipient_list='a@example.com', token='',
+                             tenant='other')
+
+    def test_list_pages_by_cursor_without_offsets(self):
+        ids = []
+        cursor = None
+        with CaptureQueriesContext(connection) as queries:
+            while True:
+                params = {'limit': 3, 'fields': 'subject'}
+                if cursor:
+                    params['cursor'] = cursor
+                page = self.client.get(reverse('emails'), params, **self.headers).json()
+                ids += [row['id'] for row in page['results']]
+                cursor = page['next_cursor']
+                if cursor is None:
+                    break
+        self.assertEqual(ids, [email.id for email in self.emails[4:][::-1] + self.emails[:4][::-1]])
+        self.assertEqual(set(page['results'][0]), {'id', 'created_at', 'subject'})
+        self.assertFalse(any('OFFSET' in query['sql'] for query in queries.captured_queries))
+
+        failed_push = self.client.get(reverse('emails'), {'status': 'failed', 'channel': 'push'},
+                                      **self.headers).json()['results']
+        self.assertEqual([row['subject'] for row in failed_push], ['Message 6', 'Message 0'])
+        response = self.client.get(reverse('emails'), {'fields': 'email_service_credentials'}, **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get(reverse('emails'), {'cursor': 'not-a-cursor'}, **self.headers)
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_detail_counts_deliveries(self):
+        email_record = self.emails[0]
+        Delivery.objects.bulk_create(build_deliveries(email_record))
+        response = self.client.get(reverse('email_detail', args=[email_record.id]), {'fields': 'id,sent_mail_status'},
+                                   **self.headers)
+        self.assertEqual(response.json(), {'id': email_record.id, 'sent_mail_status': 'failed',
+                                           'deliveries': {'email': {'pending': 1}}})
+        response = self.client.get(reverse('email_detail', args=[email_record.id]), HTTP_X_TENANT_ID='other')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_export_streams_ndjson_and_csv(self):
+        with self.settings(MAIL_SERVICE_EXPORT_CHUNK_SIZE=2):
+            response = self.client.get(reverse('export_emails'), {'fields': 'id,subject', 'status': 'sent'},
+                                       **self.headers)
+            self.assertTrue(response.streaming)
+            lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line)['subject'] for line in lines],
+                         ['Message 1', 'Message 2', 'Message 4', 'Message 5'])
+
+        response = self.client.get(reverse('export_emails'), {'format': 'csv', 'fields': 'subject,lane'},
+                                   **self.headers)
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode())))
+        self.assertEqual(rows[0], ['subject', 'lane'])
+        self.assertEqual(rows[1], ['Message 0', 'transactional'])
+        self.assertEqual(len(rows), 8)
+
+    def test_tenant_header_is_required(self):
+        for url in (reverse('emails'), reverse('email_detail', args=[self.emails[0].id]), reverse('export_emails')):
+            self.assertEqual(self.client.get(url).status_code, status.HTTP_400_BAD_REQUEST, url)
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        caches[settings.MAIL_SERVICE_METRICS_CACHE].delete(QUEUE_DEPTHS_KEY)
+
+    def sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_per_process_cache_is_reported(self):
+        self.assertEqual([message.id for message in check_metrics_cache(None)], ['mail_service.W002'])
+        with mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': '/tmp'}):
+            self.assertEqual([message.id for message in check_metrics_cache(None)], ['mail_service.E003'])
+
+    @mock.patch('mail_service.delivery.send_email_message', side_effect=[None, provider_error(503)])
+    def test_sends_requests_and_errors_are_recorded(self, send_email_message):
+        send_labels = {'channel': 'email', 'provider': 'SendGrid'}
+        sent = self.sample('mail_service_send_seconds_count', outcome='ok', **send_labels)
+        failed = self.sample('mail_service_send_errors_total', error='AnymailRequestsAPIError', **send_labels)
+        requests_seen = self.sample('mail_service_request_seconds_count', view='send_email', method='POST',
+                                    status='202')
+        queries = self.sample('mail_service_db_query_seconds_count', alias='default')
+        headers = {'HTTP_X_EMAIL_SERVICE': 'SendGrid', 'HTTP_X_EMAIL_SERVICE_API_KEY': 'test_api_key'}
+        for _ in range(2):
+            self.client.post(reverse('send_email'), {
+                'subject': 'Hi', 'message': 'Body', 'recipient_list': ['test@example.com'], 'mail_action': True,
+            }, **headers)
+
+        self.assertEqual(self.sample('mail_service_send_seconds_count', outcome='ok', **send_labels), sent + 1)
+        self.assertEqual(self.sample('mail_service_send_errors_total', error='AnymailRequestsAPIError',
+                                     **send_labels), failed + 1)
+        self.assertEqual(self.sample('mail_service_request_seconds_count', view='send_email', method='POST',
+                                     status='202'), requests_seen + 2)
+        self.assertGreater(self.sample('mail_service_db_query_seconds_count', alias='default'), queries)
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_scheduler_lag_and_queue_depth_are_exposed(self, send_email_message):
+        lag_count = self.sample('mail_service_scheduler_lag_seconds_count', job='notifications')
+        lag_sum = self.sample('mail_service_scheduler_lag_seconds_sum', job='notifications')
+        email_record = Email.objects.create(
+            subject='Scheduled', message='Body', recipient_list='test@example.com', token='', mail_action=True,
+            is_schedule=True, delivery_time=timezone.now() - datetime.timedelta(minutes=1),
+            sent_mail_status='scheduled', email_service_name='SendGrid',
+            email_service_credentials={'api_key': 'test_api_key'})
+        Delivery.objects.bulk_create(build_deliveries(email_record))
+
+        measure_queue_depths()
+        # The scrape exports the stored counts without querying the database.
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertIn('mail_service_queue_depth{queue="scheduled_due"} 1.0', response.content.decode())
+
+        dispatch_due_notifications()
+        self.assertEqual(self.sample('mail_service_scheduler_lag_seconds_count', job='notifications'), lag_count + 1)
+        self.assertGreaterEqual(self.sample('mail_service_scheduler_lag_seconds_sum', job='notifications') - lag_sum,
+                                60)
+        # Not counted again until MAIL_SERVICE_QUEUE_DEPTH_INTERVAL has passed.
+        measure_queue_depths()
+        self.assertIn('mail_service_queue_depth{queue="scheduled_due"} 1.0',
+                      self.client.get(reverse('metrics')).content.decode())
+        measure_queue_depths(force=True)
+        content = self.client.get(reverse('metrics')).content.decode()
+        self.assertIn('mail_service_queue_depth{queue="scheduled_due"} 0.0', content)
+        self.assertIn('mail_service_cache_lookups_total{cache="email_backend",result="miss"}', content)
+
+    def test_multiprocess_mode_reads_the_shared_directory(self):
+        measure_queue_depths()
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.dict(os.environ, {'PROMETHEUS_MULTIPROC_DIR': directory}):
+            content = self.client.get(reverse('metrics')).content.decode()
+        # Only the stored queue depths, as no process has written samples there.
+        self.assertIn('mail_service_queue_depth{queue="pending"} 0.0', content)
+        self.assertNotIn('mail_service_send_seconds', content)
+
+class TestTracing(TestCase):
+
+    def setUp(self):
+        self.headers = {'HTTP_X_EMAIL_SERVICE': 'SendGrid', 'HTTP_X_EMAIL_SERVICE_API_KEY': 'test_api_key'}
+        self.data = {'subject': 'Hi', 'message': 'Body', 'recipient_list': ['test@example.com'], 'mail_action': True}
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_request_phases_are_returned_and_logged(self, send_email_message):
+        with self.settings(MAIL_SERVICE_TRACING=True), self.assertLogs('mail_service.middleware') as logs:
+            response = self.client.post(reverse('send_email'), self.data, HTTP_X_TRACE_ID='trace-1', **self.headers)
+
+        self.assertEqual(response['X-Trace-ID'], 'trace-1')
+        phases = [entry.split(';')[0] for entry in response['Server-Timing'].split(', ')]
+        for name in ('validate', 'db_read', 'db_write', 'email_send', 'total'):
+            self.assertIn(name, phases)
+        self.assertEqual(Email.objects.get().trace_id, 'trace-1')
+
+        summary = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((summary['trace_id'], summary['path'], summary['status']),
+                         ('trace-1', '/api/send-email/', 202))
+        self.assertEqual(summary['phases']['email_send']['count'], 1)
+        self.assertEqual(summary['queries'], summary['phases']['db_read']['count'] +
+                         summary['phases']['db_write']['count'])
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_tracing_is_off_by_default(self, send_email_message):
+        response = self.client.post(reverse('send_email'), self.data, HTTP_X_TRACE_ID='trace-1', **self.headers)
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(Email.objects.get().trace_id, '')
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_sampled_requests_are_profiled(self, send_email_message):
+        with tempfile.TemporaryDirectory() as profile_dir, \
+                self.settings(MAIL_SERVICE_TRACING=True, MAIL_SERVICE_PROFILE_SAMPLE_RATE=1.0,
+                              MAIL_SERVICE_PROFILE_DIR=profile_dir), \
+                self.assertLogs('mail_service.middleware') as logs:
+            response = self.client.post(reverse('send_email'), self.data, **self.headers)
+            self.assertEqual(os.listdir(profile_dir), [f"{response['X-Trace-ID']}.prof"])
+        self.assertIn('profile', json.loads(logs.records[-1].getMessage()))
+
+    @mock.patch('mail_service.delivery.send_email_message', return_value=None)
+    def test_scheduled_delivery_runs_under_the_request_trace(self, send_email_message):
+        email_record = Email.objects.create(
+            subject='Scheduled', message='Body', recipient_list='test@example.com', token='', mail_action=True,
+            is_schedule=True, delivery_time=timezone.now() - datetime.timedelta(minutes=1),
+            sent_mail_status='scheduled', email_service_name='SendGrid',
+            email_service_credentials={'api_key': 'test_api_key'}, trace_id='trace-2')
+        Delivery.objects.bulk_create(build_deliveries(email_record))
+
+        with self.settings(MAIL_SERVICE_TRACING=True), self.assertLogs('mail_service.tracing') as logs:
+            dispatch_due_notifications()
+        summary = json.loads(logs.records[-1].getMessage())
+        self.assertEqual((summary['trace_id'], summary['email_id']), ('trace-2', email_record.id))
+        self.assertIn('email_send', summary['phases'])
+
+    def test_trace_id_is_sent_with_queued_tasks(self):
+        headers = {}
+        with tracing.traced('trace-3'):
+            tracing._publish_trace_id(headers=headers)
+        self.assertEqual(headers, {'trace_id': 'trace-3'})
+
+class TestSendBenchmark(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        storage = override_settings(MEDIA_ROOT=media_root.name)
+        storage.enable()
+        self.addCleanup(storage.disable)
+        self.addCleanup(media_root.cleanup)
+
+    def test_results_are_written_as_json(self):
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            call_command('bench_send', scenarios='send_email,send_email_push,send_batch', requests=2, concurrency=1,
+                         batch_size=3, email_latency=0, fcm_latency=0, memory_samples=1, output=output.name,
+                         stdout=io.StringIO())
+            results = json.load(output)
+
+        self.assertEqual(set(results['scenarios']), {'send_email', 'send_email_push', 'send_batch'})
+        for result in results['scenarios'].values():
+            self.assertEqual(result['errors'], 0, result['responses'])
+            self.assertEqual(set(result['latency_ms']), {'p50', 'p95', 'p99', 'mean', 'max'})
+            self.assertGreater(result['queries_per_request']['mean'], 0)
+            self.assertGreater(result['memory_kib_per_request']['peak_max'], 0)
+        self.assertFalse(Email.objects.exists())
+
+
+class TestStartup(TestCase):
+
+    def test_provider_sdks_are_not_loaded_at_startup(self):
+        with tempfile.NamedTemporaryFile(suffix='.json') as output:
+            call_command('bench_startup', runs=1, top=0, output=output.name, stdout=io.StringIO())
+            results = json.load(output)
+
+        for target in ('web', 'worker'):
+            self.assertEqual(results['targets'][target]['lazy_loaded'], [], target)
+            self.assertGreater(results['targets'][target]['ready_ms']['median'], 0)
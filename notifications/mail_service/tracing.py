@@ -0,0 +1,197 @@
+# tracing.py
+
+import contextvars
+import cProfile
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from celery.signals import before_task_publish, task_postrun, task_prerun
+from django.conf import settings
+from django.db.backends.signals import connection_created
+
+logger = logging.getLogger(__name__)
+
+TRACE_HEADER = 'X-Trace-ID'
+# Incoming trace ids are kept only if they are short and safe to log and store.
+TRACE_ID_PATTERN = re.compile(r'[A-Za-z0-9_-]{1,64}')
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+
+_current = contextvars.ContextVar('mail_service_trace', default=None)
+
+
+class Trace:
+    """Time and call count per phase of one request or job, in seconds."""
+
+    def __init__(self, trace_id=None):
+        self.trace_id = trace_id or uuid.uuid4().hex
+        self.started = time.perf_counter()
+        self.phases = {}  # name -> [seconds, count]
+        self._lock = threading.Lock()
+
+    def add(self, name, seconds):
+        # Mail and push of one record are timed from two threads at once.
+        with self._lock:
+            totals = self.phases.setdefault(name, [0.0, 0])
+            totals[0] += seconds
+            totals[1] += 1
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def queries(self):
+        return sum(self.phases.get(name, (0, 0))[1] for name in ('db_read', 'db_write'))
+
+    def summary(self, **fields):
+        """A JSON log line with the phase timings in milliseconds."""
+        return json.dumps({
+            'trace_id': self.trace_id,
+            **fields,
+            'duration_ms': round(self.elapsed() * 1000, 3),
+            'queries': self.queries(),
+            'phases': {name: {'ms': round(seconds * 1000, 3), 'count': count}
+                       for name, (seconds, count) in sorted(self.phases.items())},
+        })
+
+    def server_timing(self):
+        """The Server-Timing header value: one entry per phase, then the total."""
+        entries = [f'{name};dur={seconds * 1000:.3f};desc="{count}x"'
+                   for name, (seconds, count) in sorted(self.phases.items())]
+        entries.append(f'total;dur={self.elapsed() * 1000:.3f}')
+        return ', '.join(entries)
+
+
+def current_trace_id():
+    """The trace id of the running request or job, or '' outside of one."""
+    trace = _current.get()
+    return trace.trace_id if trace is not None else ''
+
+
+def request_trace_id(request):
+    trace_id = request.headers.get(TRACE_HEADER, '')
+    return trace_id if TRACE_ID_PATTERN.fullmatch(trace_id) else None
+
+
+@contextmanager
+def traced(trace_id=None):
+    """Make a new Trace current for the block and yield it."""
+    trace = Trace(trace_id)
+    token = _current.set(trace)
+    try:
+        yield trace
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def resume(trace_id, **fields):
+    """
+    Run a queued job for a stored trace id, e.g. Email.trace_id, so its logs
+    carry the id of the request that created it. With MAIL_SERVICE_TRACING,
+    the job's phase timings are logged at the end. A job run eagerly inside
+    its own request adds to the request's trace instead.
+    """
+    if not trace_id or trace_id == current_trace_id():
+        yield
+        return
+    with traced(trace_id) as trace:
+        yield
+    if settings.MAIL_SERVICE_TRACING:
+        logger.info("%s", trace.summary(**fields))
+
+
+@contextmanager
+def phase(name):
+    """Add the time spent in the block to the current trace's phase `name`."""
+    trace = _current.get()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add(name, time.perf_counter() - started)
+
+
+@contextmanager
+def sampled_profile(trace):
+    """
+    Profile the block with cProfile for MAIL_SERVICE_PROFILE_SAMPLE_RATE of
+    the calls and write it to MAIL_SERVICE_PROFILE_DIR as <trace id>.prof.
+    Yields the file's path, or None when the call is not sampled.
+    """
+    rate = settings.MAIL_SERVICE_PROFILE_SAMPLE_RATE
+    if rate <= 0 or random.random() >= rate:
+        yield None
+        return
+    profiler = cProfile.Profile()
+    path = os.path.join(settings.MAIL_SERVICE_PROFILE_DIR, f'{trace.trace_id}.prof')
+    profiler.enable()
+    try:
+        yield path
+    finally:
+        profiler.disable()
+        os.makedirs(settings.MAIL_SERVICE_PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(path)
+
+
+class TraceIdFilter(logging.Filter):
+    """Adds the current trace id to log records as `trace_id`, for use in LOGGING formats."""
+
+    def filter(self, record):
+        record.trace_id = current_trace_id()
+        return True
+
+
+def _trace_query(execute, sql, params, many, context):
+    trace = _current.get()
+    if trace is None:
+        return execute(sql, params, many, context)
+    write = sql.lstrip()[:6].upper() in WRITE_STATEMENTS
+    with phase('db_write' if write else 'db_read'):
+        return execute(sql, params, many, context)
+
+
+def _instrument_connection(sender, connection, **kwargs):
+    if _trace_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_trace_query)
+
+
+connection_created.connect(_instrument_connection)
+
+
+# Celery: the trace id travels with each task message as a header. Eager tasks
+# run inside the caller's trace and get neither.
+_task_traces = {}
+
+
+@before_task_publish.connect
+def _publish_trace_id(headers=None, **kwargs):
+    trace_id = current_trace_id()
+    if trace_id and headers is not None:
+        headers['trace_id'] = trace_id
+
+
+@task_prerun.connect
+def _start_task_trace(task_id=None, task=None, **kwargs):
+    trace_id = getattr(task.request, 'trace_id', None)
+    if trace_id and not task.request.is_eager:
+        trace = Trace(trace_id)
+        _task_traces[task_id] = (trace, _current.set(trace))
+
+
+@task_postrun.connect
+def _finish_task_trace(task_id=None, task=None, **kwargs):
+    entry = _task_traces.pop(task_id, None)
+    if entry is None:
+        return
+    trace, token = entry
+    _current.reset(token)
+    if settings.MAIL_SERVICE_TRACING:
+        logger.info("%s", trace.summary(task=task.name))
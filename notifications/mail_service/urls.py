@@ -1,8 +1,25 @@
 from django.urls import path
-from .views import send_email, schedule_notification, cancel_notification
+from .views import (send_email, send_batch, schedule_notification, cancel_notification, cache_stats,
+                    circuit_breakers, email_providers, message_templates, message_template_detail,
+                    suppressions, async_send_email, async_send_batch, recipient_imports, recipient_import_detail,
+                    emails, email_detail, export_emails)
 
 urlpatterns = [
     path('send-email/', send_email, name='send_email'),
+    path('send-batch/', send_batch, name='send_batch'),
+    path('async/send-email/', async_send_email, name='async_send_email'),
+    path('async/send-batch/', async_send_batch, name='async_send_batch'),
+    path('imports/', recipient_imports, name='recipient_imports'),
+    path('imports/<int:import_id>/', recipient_import_detail, name='recipient_import_detail'),
     path('schedule-notification/', schedule_notification, name='schedule_notification'),
     path('cancel-notification/<str:job_id>/', cancel_notification, name='cancel_notification'),
+    path('emails/', emails, name='emails'),
+    path('emails/export/', export_emails, name='export_emails'),
+    path('emails/<int:email_id>/', email_detail, name='email_detail'),
+    path('cache-stats/', cache_stats, name='cache_stats'),
+    path('circuit-breakers/', circuit_breakers, name='circuit_breakers'),
+    path('providers/', email_providers, name='email_providers'),
+    path('templates/', message_templates, name='message_templates'),
+    path('templates/<int:template_id>/', message_template_detail, name='message_template_detail'),
+    path('suppressions/', suppressions, name='suppressions'),
 ]
\ No newline at end of file
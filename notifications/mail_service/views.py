@@ -1,70 +1,49 @@
+import json
+from asgiref.sync import sync_to_async
 from rest_framework import status
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-import firebase_admin
-from firebase_admin import credentials, messaging
-from apscheduler.schedulers.background import BackgroundScheduler
+from .models import Email, Delivery, EmailProvider, MessageTemplate, Suppression  # Import your Email model
+from .models import RecipientImport
+from .serializers import (SendEmailSerializer, SendBatchSerializer, EmailProviderSerializer,  # Import your serializer
+                          MessageTemplateSerializer, SuppressionSerializer, RecipientFileSerializer,
+                          RecipientImportSerializer, EmailFieldsSerializer, EmailQuerySerializer,
+                          EmailExportSerializer)
+from .email_backends import EMAIL_BACKEND_MAPPING
+from .email_service import backend_cache
+from .firebase_service import save_credential_file, firebase_app_cache
+from .task import adeliver_batch, send_email_task, batch_delivery_task, import_recipients_task
+from .delivery import build_deliveries
+from .retry import breaker_states
+from .router import Route, forget_tenant_routes, provider_stats, tenant_routes
+from .suppression import normalize_address, suppress
 from django.conf import settings
-from .models import Email  # Import your Email model
-from .serializers import SendEmailSerializer  # Import your serializer
-import os
-from .email_service import get_dynamic_email_backend
-from anymail.message import AnymailMessage
-import json
-from firebase_admin import credentials, initialize_app, exceptions
-from django.core.files.storage import default_storage
-import uuid
-import datetime
-
-
-def initialize_firebase(credential_path):
-    """Initialize Firebase with the given credential path."""
-    try:
-        cred = credentials.Certificate(credential_path)
-        if not firebase_admin._apps:  # Check if Firebase is already initialized
-            initialize_app(cred)
-        else:
-            raise Exception("Firebase has already been initialized.")
-    except exceptions.FirebaseError as e:
-        # Handle error accordingly, e.g., log it or return an error response
-        print(f"Error initializing Firebase: {e}")
-
-
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-UPLOADS_DIR = os.path.join(BASE_DIR, 'uploads')
-scheduler = BackgroundScheduler()
-
-
-def send_email_message(subject, message, recipient_list, email_backend):
-    # Create the email message
-    email = AnymailMessage(
-        subject=subject,
-        body=message,
-        from_email=settings.DEFAULT_FROM_EMAIL,
-        to=recipient_list,
-        connection=email_backend
-    )
-    # Send the email
-    email.send()
-
-
-def message_firebase(subject, message, token, credential_path):
-    initialize_firebase(credential_path)
-    firebase_message = messaging.Message(
-        notification=messaging.Notification(
-            title=subject,
-            body=message,
-        ),
-        token=token,
-    )
-    messaging.send(firebase_message)
+from django.db import IntegrityError, transaction
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
+from .idempotency import find_key, get_key, record_key, request_hash
+from .imports import save_import_file
+from .lanes import enqueue
+from .metrics import scrape_registry
+from .records import delivery_counts, email_page, export_lines, filter_emails
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+
+
+def get_mail_credentials(request):
+    """
+    Read the email service name and credentials from the request headers.
 
+    Without an X-Email-Service header, a tenant with registered providers
+    gets an empty service name and its mail is routed across them.
 
-# Send Email endpoint
-@api_view(['POST'])
-def send_email(request):
+    Returns (service_name, mail_credentials, error_response); error_response
+    is None when the headers are valid.
+    """
     # get service name and api key and api secret
     service_name = request.email_service_name
+    if not service_name and request.tenant_id and tenant_routes(request.tenant_id):
+        return '', {}, None
     api_key = request.email_service_api_key
     api_secret = request.email_service_api_secret if service_name == 'Mailjet' else None
     mail_credentials = {'api_key': api_key}
@@ -72,100 +51,295 @@ def send_email(request):
         mail_credentials['api_secret'] = api_secret
 
     if not service_name or not api_key or (service_name == 'Mailjet' and not api_secret):
-        return Response({"error": "Service name, API key, and API secret (for Mailjet) must be provided."}, status=400)
+        return service_name, mail_credentials, Response(
+            {"error": "Service name, API key, and API secret (for Mailjet) must be provided."}, status=400)
+
+    if service_name not in EMAIL_BACKEND_MAPPING:
+        return service_name, mail_credentials, Response(
+            {"error": f"Unsupported email service: {service_name}"}, status=400)
+
+    return service_name, mail_credentials, None
+
+
+def template_fields(validated_data):
+    """Email fields for a template send; empty for a literal subject and message."""
+    template = validated_data.get('template')
+    if template is None:
+        return {}
+    return {'template': template, 'template_version': template.version,
+            'template_context': validated_data.get('context', {})}
+
+
+def email_fields(validated_data, service_name, mail_credentials, firebase_credential):
+    """Fields of a new 'pending' Email record for a validated SendEmailSerializer payload."""
+    return {
+        'subject': validated_data['subject'],
+        'message': validated_data['message'],
+        'recipient_list': ','.join(validated_data['recipient_list']),
+        'token': ','.join(validated_data['tokens']),
+        'topics': ','.join(validated_data['topics']),
+        'condition': validated_data['condition'],
+        'firebase_response': '',
+        'sent_mail_status': 'pending',  # Initial status
+        'mail_action': validated_data['mail_action'],
+        'firebase_action': validated_data['firebase_action'],
+        'email_service_name': service_name,
+        'email_service_credentials': mail_credentials,
+        'firebase_credential': firebase_credential,
+        'lane': validated_data['lane'],
+    }
+
+
+def batch_records(request, items, service_name, mail_credentials, firebase_credential, lane):
+    """Unsaved 'pending' Email records in `lane` for the items of a validated SendBatchSerializer payload."""
+    return [
+        Email(
+            subject=item['subject'],
+            message=item['message'],
+            recipient_list=','.join(item['recipient_list']),
+            token=','.join(item['tokens']),
+            topics=','.join(item['topics']),
+            condition=item['condition'],
+            firebase_response='',
+            sent_mail_status='pending',
+            mail_action=item['mail_action'],
+            firebase_action=item['firebase_action'],
+            email_service_name=service_name,
+            email_service_credentials=mail_credentials,
+            tenant=request.tenant_id,
+            firebase_credential=firebase_credential,
+            lane=lane,
+        )
+        for item in items
+    ]
+
 
-    email_backend = get_dynamic_email_backend(service_name, mail_credentials)
+def create_batch(email_records):
+    """
+    Insert a batch's Email records and their deliveries in one transaction,
+    so a failed insert never leaves records behind without deliveries.
+    Returns the saved records.
+    """
+    with transaction.atomic():
+        email_records = Email.objects.bulk_create(email_records, batch_size=500)
+        Delivery.objects.bulk_create(
+            [delivery for email_record in email_records for delivery in build_deliveries(email_record)],
+            batch_size=1000)
+    return email_records
+
+
+def idempotent_replay(request, endpoint, key, data, respond):
+    """
+    Response for a request whose idempotency key was already used, or None
+    for a new request. respond(email_id) builds the endpoint's usual response.
+    """
+    existing = find_key(request.tenant_id, endpoint, key)
+    if existing is None:
+        return None
+    if existing.request_hash != request_hash(data):
+        return Response({"error": "Idempotency-Key was already used for a different request."}, status=422)
+    response = respond(existing.email_id)
+    response['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def key_conflict(request, endpoint, key, data, respond):
+    """
+    Response for a request whose key a concurrent request stored first: the
+    replay of that request, or 409 if its key has expired and been purged
+    since, so the client sends it again and stores its own.
+    """
+    replay = idempotent_replay(request, endpoint, key, data, respond)
+    if replay is None:
+        return Response({"error": "Idempotency-Key conflicted with a request that has since expired; retry."},
+                        status=409)
+    return replay
+
+
+def create_email_record(request, endpoint, key, data, **fields):
+    """
+    Create an Email record and its deliveries, storing the idempotency key in the same transaction.
+
+    Returns None if a concurrent request with the same key got there first; answer with key_conflict().
+    """
+    try:
+        with transaction.atomic():
+            email_record = Email.objects.create(tenant=request.tenant_id, **template_fields(data), **fields)
+            Delivery.objects.bulk_create(build_deliveries(email_record, data.get('recipient_contexts')))
+            if key:
+                record_key(request.tenant_id, endpoint, key, data, email_record)
+    except IntegrityError:
+        if not key:
+            raise
+        return None
+    return email_record
+
+
+# Send Email endpoint
+@api_view(['POST'])
+def send_email(request):
+    """
+    Accept an email/notification and queue it for delivery.
+
+    The Email record is written with status 'pending' and the provider calls
+    happen on a worker; the response returns 202 with the record id right away.
+    """
+    service_name, mail_credentials, error_response = get_mail_credentials(request)
+    if error_response:
+        return error_response
 
     # Use the custom serializer to validate the input data
-    serializer = SendEmailSerializer(data=request.data)
+    serializer = SendEmailSerializer(data=request.data, context={'tenant': request.tenant_id})
 
     if serializer.is_valid():
 
-        subject = serializer.validated_data['subject']
-        message = serializer.validated_data['message']
-        recipient_list = serializer.validated_data['recipient_list']
-        token = serializer.validated_data['token']
         mail_action = serializer.validated_data['mail_action']
         firebase_action = serializer.validated_data['firebase_action']
-        email_record = Email.objects.create(
-            subject=subject,
-            message=message,
-            recipient_list=','.join(recipient_list),
-            token=token,
-            firebase_response='',
-            sent_mail_status='pending',  # Initial status,
-            mail_action=mail_action,
-            firebase_action=firebase_action
 
-        )
         if mail_action is False and firebase_action is False:
-            return Response({"errors": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
-
-        if mail_action:
-            # Create a new Email record with status 'pending'
+            return Response({"error": "You must choose at least one action."}, status=status.HTTP_400_BAD_REQUEST)
 
-            try:
-                # Send the email
-                send_email_message(subject, message, recipient_list, email_backend)
+        def accepted(email_id):
+            return Response({"status": "Accepted", "id": email_id, "record": serializer.data},
+                            status=status.HTTP_202_ACCEPTED)
 
-                # Update status to 'sent'
-                email_record.sent_mail_status = 'sent'
-                email_record.save()
-                if firebase_action is False:
-                    return Response({"status": "Email sent!", "record": serializer.data},
-                                    status=status.HTTP_200_OK)
+        # A retried request returns the record it created the first time.
+        key = get_key(request, serializer.validated_data)
+        if key:
+            replay = idempotent_replay(request, 'send_email', key, serializer.validated_data, accepted)
+            if replay is not None:
+                return replay
 
-            except Exception as e:
-                # Update status to 'failed'
-                email_record.sent_mail_status = 'failed'
-                email_record.save()
-
-                return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+        firebase_credential = ''
         if firebase_action:
             file = request.FILES.get('credential_file')
             if not file:
                 return Response({"error": "No file provided."}, status=status.HTTP_400_BAD_REQUEST)
+            firebase_credential = save_credential_file(file)
 
-            # Create uploads directory if it does not exist
-            os.makedirs(UPLOADS_DIR, exist_ok=True)
+        # Create a new Email record with status 'pending'
+        email_record = create_email_record(
+            request, 'send_email', key, serializer.validated_data,
+            **email_fields(serializer.validated_data, service_name, mail_credentials, firebase_credential))
+        if email_record is None:
+            return key_conflict(request, 'send_email', key, serializer.validated_data, accepted)
 
-            # Generate a random UUID and use it as the filename
-            random_filename = f"{uuid.uuid4()}.json"  # Generates a UUID and appends '.json'
-            credential_path = os.path.join(UPLOADS_DIR, random_filename)
+        # Hand delivery to the worker queue; the outcome updates the record.
+        enqueue(send_email_task, email_record.lane, email_record.id)
 
-            # Save the new credentials file to the uploads directory
-            with default_storage.open(credential_path, 'wb+') as destination:
-                for chunk in file.chunks():
-                    destination.write(chunk)
+        return accepted(email_record.id)
 
-                # Optional: Initialize Firebase or any other processing needed here
-            initialize_firebase(credential_path)
+    return Response({"errors": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
 
-            firebase_message = messaging.Message(
-                notification=messaging.Notification(
-                    title=subject,
-                    body=message,
-                ),
-                token=token,
-            )
+# Batch Send endpoint
+@api_view(['POST'])
+def send_batch(request):
+    """
+    Accept many emails/notifications in one request.
 
-            try:
-                response = messaging.send(firebase_message)
+    Records and deliveries are written with bulk_create in one transaction
+    and, once it commits, delivered by batch_delivery_task() in chunks of
+    MAIL_SERVICE_BATCH_TASK_SIZE, each chunk saving its outcomes with a
+    single bulk_update.
+    """
+    service_name, mail_credentials, error_response = get_mail_credentials(request)
+    if error_response:
+        return error_response
 
-                # Save the notification details to the database
+    serializer = SendBatchSerializer(data=request.data)
+    if not serializer.is_valid():
+        return Response({"errors": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
 
-                email_record.firebase_response = response
-                email_record.save()
+    items = serializer.validated_data['items']
 
-                return Response({"status": "Email and Notification sent!", "record": serializer.data},
-                                status=status.HTTP_200_OK)
+    firebase_credential = ''
+    if any(item['firebase_action'] for item in items):
+        file = request.FILES.get('credential_file')
+        if not file:
+            return Response({"error": "No file provided."}, status=status.HTTP_400_BAD_REQUEST)
+        firebase_credential = save_credential_file(file)
 
-            except Exception as e:
-                email_record.firebase_response = str(e)
-                email_record.save()
-                return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+    lane = serializer.validated_data['lane']
+    with transaction.atomic():
+        email_records = create_batch(
+            batch_records(request, items, service_name, mail_credentials, firebase_credential, lane))
+        email_ids = [email_record.id for email_record in email_records]
+
+        def dispatch():
+            chunk_size = settings.MAIL_SERVICE_BATCH_TASK_SIZE
+            for start in range(0, len(email_ids), chunk_size):
+                enqueue(batch_delivery_task(), lane, email_ids[start:start + chunk_size])
+
+        # Queued once the records are committed, so no worker looks for rows that are not there yet.
+        transaction.on_commit(dispatch)
+
+    return Response({
+        "status": "Accepted",
+        "count": len(email_records),
+        "results": [{"id": email_record.id, "status": email_record.sent_mail_status} for email_record in email_records],
+    }, status=status.HTTP_202_ACCEPTED)
+
+
+# Recipient file import
+@api_view(['POST'])
+def recipient_imports(request):
+    """
+    Start a send to the recipients of an uploaded CSV or NDJSON file.
+
+    The file is streamed to disk and loaded into Delivery rows by
+    import_recipients_task chunk by chunk; the response returns 202 with
+    the import, whose progress is at imports/<id>/. The deliveries are
+    queued once the whole file is in.
+    """
+    service_name, mail_credentials, error_response = get_mail_credentials(request)
+    if error_response:
+        return error_response
+
+    serializer = RecipientFileSerializer(data=request.data, context={'tenant': request.tenant_id})
+    if not serializer.is_valid():
+        return Response({"errors": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+    data = serializer.validated_data
+
+    firebase_credential = ''
+    if data['firebase_action']:
+        file = request.FILES.get('credential_file')
+        if not file:
+            return Response({"error": "No file provided."}, status=status.HTTP_400_BAD_REQUEST)
+        firebase_credential = save_credential_file(file)
+
+    # The recipients live only on the deliveries, not in recipient_list and token.
+    email_record = Email.objects.create(
+        tenant=request.tenant_id,
+        **template_fields(data),
+        subject=data['subject'],
+        message=data['message'],
+        recipient_list='',
+        token='',
+        firebase_response='',
+        sent_mail_status='pending',
+        mail_action=data['mail_action'],
+        firebase_action=data['firebase_action'],
+        email_service_name=service_name,
+        email_service_credentials=mail_credentials,
+        firebase_credential=firebase_credential,
+        lane=data['lane'],
+    )
+    recipient_import = RecipientImport.objects.create(
+        tenant=request.tenant_id, email=email_record, format=data['format'], size=data['file'].size)
+    save_import_file(data['file'], recipient_import)
+    enqueue(import_recipients_task, email_record.lane, recipient_import.id)
+
+    return Response(RecipientImportSerializer(recipient_import).data, status=status.HTTP_202_ACCEPTED)
+
+
+@api_view(['GET'])
+def recipient_import_detail(request, import_id):
+    """Progress of a recipient import: bytes and rows read, rows imported and rejected."""
+    recipient_import = RecipientImport.objects.filter(id=import_id, tenant=request.tenant_id).first()
+    if recipient_import is None:
+        return Response({"error": "Import not found."}, status=404)
+    return Response(RecipientImportSerializer(recipient_import).data, status=200)
 
-    return Response({"errors": serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
 
 # Schedule Email/Notification
 @api_view(['POST'])
@@ -173,6 +347,10 @@ def schedule_notification(request):
     """
     Schedule an email/notification.
 
+    The record is stored with its provider settings and picked up by the
+    scheduler sweep (dispatch_due_notifications) once delivery_time passes,
+    so scheduled sends survive restarts and are shared by all workers.
+
     Args:
         request (Request): Django request object.
 
@@ -183,87 +361,84 @@ def schedule_notification(request):
     service_name = request.data.get('email_service_name')
     api_key = request.data.get('email_service_api_key')
     api_secret = request.data.get('email_service_api_secret')
-
-    # Validate service credentials
-    if not service_name or not api_key or (service_name == 'Mailjet' and not api_secret):
-        return Response({"error": "Service name, API key, and API secret (for Mailjet) must be provided."}, status=400)
-
-    # Get email backend
     mail_credentials = {'api_key': api_key}
     if api_secret:
         mail_credentials['api_secret'] = api_secret
-    email_backend = get_dynamic_email_backend(service_name, mail_credentials)
+
+    if not service_name and request.tenant_id and tenant_routes(request.tenant_id):
+        # Route across the tenant's registered providers at delivery time.
+        service_name, mail_credentials = '', {}
+    # Validate service credentials
+    elif not service_name or not api_key or (service_name == 'Mailjet' and not api_secret):
+        return Response({"error": "Service name, API key, and API secret (for Mailjet) must be provided."}, status=400)
+    elif service_name not in EMAIL_BACKEND_MAPPING:
+        return Response({"error": f"Unsupported email service: {service_name}"}, status=400)
 
     # Validate input data
-    serializer = SendEmailSerializer(data=request.data)
+    serializer = SendEmailSerializer(data=request.data, context={'tenant': request.tenant_id})
     if serializer.is_valid():
         subject = serializer.validated_data['subject']
         message = serializer.validated_data['message']
         recipient_list = serializer.validated_data['recipient_list']
-        token = serializer.validated_data['token']
+        tokens = serializer.validated_data['tokens']
+        topics = serializer.validated_data['topics']
+        condition = serializer.validated_data['condition']
         mail_action = serializer.validated_data['mail_action']
         firebase_action = serializer.validated_data['firebase_action']
-        delivery_time = request.data.get('delivery_time')  # Expecting ISO format
+        delivery_time = serializer.validated_data.get('delivery_time')  # Expecting ISO format
 
         # Validate delivery time
-        try:
-            delivery_time = datetime.strptime(delivery_time, '%Y-%m-%dT%H:%M:%SZ')
-        except ValueError:
+        if delivery_time is None:
             return Response({"error": "Invalid delivery time format."}, status=400)
 
+        # Validate mail and firebase actions
+        if not mail_action and not firebase_action:
+            return Response({"error": "You must choose at least one action."}, status=400)
+
+        def scheduled(email_id):
+            return Response({"status": "Event scheduled!", "schedule id": email_id}, status=200)
+
+        # A retried request returns the record it created the first time.
+        key = get_key(request, serializer.validated_data)
+        if key:
+            replay = idempotent_replay(request, 'schedule_notification', key, serializer.validated_data, scheduled)
+            if replay is not None:
+                return replay
+
+        firebase_credential = ''
+        if firebase_action:
+            file = request.FILES.get('credential_file')
+            if not file:
+                return Response({"error": "No file provided."}, status=400)
+
+            # Save credential file
+            firebase_credential = save_credential_file(file)
+
         # Create email record
-        email_record = Email.objects.create(
+        email_record = create_email_record(
+            request, 'schedule_notification', key, serializer.validated_data,
             subject=subject,
             message=message,
             recipient_list=','.join(recipient_list),
-            token=token,
+            token=','.join(tokens),
+            topics=','.join(topics),
+            condition=condition,
             firebase_response='',
-            sent_mail_status='pending',  # Initial status,
+            sent_mail_status='scheduled',
             mail_action=mail_action,
             firebase_action=firebase_action,
             is_schedule=True,
-            delivery_time=delivery_time
+            delivery_time=delivery_time,
+            schedule_status=Email.SCHEDULED,
+            email_service_name=service_name,
+            email_service_credentials=mail_credentials,
+            firebase_credential=firebase_credential,
+            lane=serializer.validated_data['lane'],
         )
+        if email_record is None:
+            return key_conflict(request, 'schedule_notification', key, serializer.validated_data, scheduled)
 
-        # Validate mail and firebase actions
-        if not mail_action and not firebase_action:
-            return Response({"error": "You must choose at least one action."}, status=400)
-
-        try:
-            # Schedule email
-            if mail_action:
-                scheduler.add_job(send_email_message, 'date', run_date=delivery_time,
-                                  args=[subject, message, recipient_list, email_backend])
-
-            # Schedule firebase notification
-            if firebase_action:
-                file = request.FILES.get('credential_file')
-                if not file:
-                    return Response({"error": "No file provided."}, status=400)
-
-                # Save credential file
-                os.makedirs(UPLOADS_DIR, exist_ok=True)
-                random_filename = f"{uuid.uuid4()}.json"
-                credential_path = os.path.join(UPLOADS_DIR, random_filename)
-                with default_storage.open(credential_path, 'wb+') as destination:
-                    for chunk in file.chunks():
-                        destination.write(chunk)
-
-                # Schedule job
-                scheduler.add_job(message_firebase, 'date', run_date=delivery_time,
-                                  args=[subject, message, token, credential_path])
-
-            # Update email record status
-            email_record.sent_mail_status = 'scheduled'
-            email_record.save()
-
-            return Response({"status": "Event scheduled!", "schedule id": email_record.id}, status=200)
-
-        except Exception as e:
-            # Update email record status
-            email_record.sent_mail_status = 'failed'
-            email_record.save()
-            return Response({"error": str(e)}, status=500)
+        return scheduled(email_record.id)
 
     return Response({"errors": serializer.errors}, status=400)
 
@@ -274,6 +449,10 @@ def cancel_notification(request, job_id):
     """
     Cancel a scheduled email/notification.
 
+    Only records that have not been claimed by the scheduler yet can be
+    canceled; the conditional update makes this safe against a sweep
+    running at the same time.
+
     Args:
         request (Request): Django request object.
         job_id (int): ID of the scheduled job.
@@ -282,24 +461,325 @@ def cancel_notification(request, job_id):
         Response: JSON response with cancel status.
     """
     try:
-        # Get email record
-        email_record = Email.objects.get(id=job_id)
+        canceled = Email.objects.filter(id=job_id, is_schedule=True, schedule_status=Email.SCHEDULED).update(
+            schedule_status=Email.CANCELED)
+        if canceled:
+            return Response({"status": "Scheduled notification canceled!"}, status=200)
 
-        # Update schedule status
-        email_record.schedule_status = 1
-        email_record.save()
+        if not Email.objects.filter(id=job_id, is_schedule=True).exists():
+            return Response({"status": "Job ID not found."}, status=404)
+        return Response({"status": "Notification is already sent or canceled."}, status=409)
 
-        # Remove job from scheduler
-        if scheduler.get_job(job_id):
-            scheduler.remove_job(job_id)
-
-        return Response({"status": "Scheduled notification canceled!"}, status=200)
-
-    except Email.DoesNotExist:
-        return Response({"status": "Job ID not found."}, status=404)
     except Exception as e:
         return Response({"status": "An error occurred: " + str(e)}, status=500)
 
 
-# Start the scheduler
-scheduler.start()
\ No newline at end of file
+# Email records
+@api_view(['GET'])
+def emails(request):
+    """
+    List the X-Tenant-ID tenant's Email records, newest first.
+
+    Takes the EmailFilterSerializer filters, limit and fields query
+    parameters. Pages are keyed on (created_at, id): pass the response's
+    next_cursor as cursor to get the next page.
+    """
+    if not request.tenant_id:
+        return Response({"error": "X-Tenant-ID header must be provided."}, status=400)
+    serializer = EmailQuerySerializer(data=request.query_params)
+    if not serializer.is_valid():
+        return Response({"errors": serializer.errors}, status=400)
+    query = serializer.validated_data
+    rows, next_cursor = email_page(filter_emails(request.tenant_id, query), query['fields'], query['limit'],
+                                   query.get('cursor'))
+    return Response({"results": rows, "next_cursor": next_cursor}, status=200)
+
+
+@api_view(['GET'])
+def email_detail(request, email_id):
+    """
+    Show one of the X-Tenant-ID tenant's Email records, with its fields query
+    parameter, and its delivery counts by channel and status.
+    """
+    if not request.tenant_id:
+        return Response({"error": "X-Tenant-ID header must be provided."}, status=400)
+    serializer = EmailFieldsSerializer(data=request.query_params)
+    if not serializer.is_valid():
+        return Response({"errors": serializer.errors}, status=400)
+    fields = serializer.validated_data['fields']
+    email_record = Email.objects.filter(id=email_id, tenant=request.tenant_id).values(*fields).first()
+    if email_record is None:
+        return Response({"error": "Email not found."}, status=404)
+    email_record['deliveries'] = delivery_counts(email_id)
+    return Response(email_record, status=200)
+
+
+# Plain Django view: DRF reads the format query parameter for content negotiation,
+# and its Response cannot stream.
+@require_GET
+def export_emails(request):
+    """
+    Stream the X-Tenant-ID tenant's Email records, oldest first, as NDJSON
+    or CSV (format query parameter), with the same filters and fields as
+    the list. Memory use stays flat however many rows are exported.
+    """
+    if not request.tenant_id:
+        return JsonResponse({"error": "X-Tenant-ID header must be provided."}, status=400)
+    serializer = EmailExportSerializer(data=request.GET)
+    if not serializer.is_valid():
+        return JsonResponse({"errors": serializer.errors}, status=400)
+    query = serializer.validated_data
+    emails = filter_emails(request.tenant_id, query)
+    content_type = 'text/csv' if query['format'] == 'csv' else 'application/x-ndjson'
+    response = StreamingHttpResponse(export_lines(emails, query['fields'], query['format']),
+                                     content_type=content_type)
+    response['Content-Disposition'] = f'attachment; filename="emails.{query["format"]}"'
+    return response
+
+
+# Cache statistics
+@api_view(['GET'])
+def cache_stats(request):
+    """Return hit/miss/eviction counters for the per-process provider caches."""
+    return Response({"email_backends": backend_cache.stats(), "firebase_apps": firebase_app_cache.stats()},
+                    status=200)
+
+
+# Prometheus metrics
+@require_GET
+def metrics(request):
+    """
+    Prometheus metrics for the send path, summed over every web and worker
+    process when PROMETHEUS_MULTIPROC_DIR is set.
+    """
+    return HttpResponse(generate_latest(scrape_registry()), content_type=CONTENT_TYPE_LATEST)
+
+
+# Circuit breaker state
+@api_view(['GET'])
+def circuit_breakers(request):
+    """Return the state of each provider circuit breaker in this process."""
+    return Response(breaker_states(), status=200)
+
+
+# Email providers registered by a tenant
+@api_view(['GET', 'POST'])
+def email_providers(request):
+    """
+    List or register the X-Tenant-ID tenant's email providers.
+
+    Mail sent without an X-Email-Service header is routed across these by
+    priority and weight, failing over to the next provider on errors.
+    """
+    if not request.tenant_id:
+        return Response({"error": "X-Tenant-ID header must be provided."}, status=400)
+
+    if request.method == 'POST':
+        serializer = EmailProviderSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({"errors": serializer.errors}, status=400)
+        serializer.save(tenant=request.tenant_id)
+        forget_tenant_routes(request.tenant_id)
+        return Response(serializer.data, status=201)
+
+    providers = EmailProvider.objects.filter(tenant=request.tenant_id).order_by('priority', 'id')
+    data = []
+    for provider in providers:
+        item = EmailProviderSerializer(provider).data
+        route = Route(provider.service_name, provider.credentials, provider.priority, provider.weight)
+        item['health'] = provider_stats(route)
+        data.append(item)
+    return Response(data, status=200)
+
+
+# Stored message templates
+@api_view(['GET', 'POST'])
+def message_templates(request):
+    """
+    List or create the X-Tenant-ID tenant's message templates.
+
+    Templates use the Django template language; send-email and
+    schedule-notification render them per recipient on the worker.
+    """
+    if request.method == 'POST':
+        serializer = MessageTemplateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({"errors": serializer.errors}, status=400)
+        with transaction.atomic():
+            serializer.save(tenant=request.tenant_id).save_version()
+        return Response(serializer.data, status=201)
+
+    templates = MessageTemplate.objects.filter(tenant=request.tenant_id).order_by('id')
+    return Response(MessageTemplateSerializer(templates, many=True).data, status=200)
+
+
+@api_view(['GET', 'PUT'])
+def message_template_detail(request, template_id):
+    """Show or update a template. Every update bumps its version and keeps the new content as that version."""
+    template = MessageTemplate.objects.filter(id=template_id, tenant=request.tenant_id).first()
+    if template is None:
+        return Response({"error": "Template not found."}, status=404)
+
+    if request.method == 'PUT':
+        serializer = MessageTemplateSerializer(template, data=request.data)
+        if not serializer.is_valid():
+            return Response({"errors": serializer.errors}, status=400)
+        with transaction.atomic():
+            serializer.save(version=template.version + 1).save_version()
+        return Response(serializer.data, status=200)
+
+    return Response(MessageTemplateSerializer(template).data, status=200)
+
+
+# Suppression list
+@api_view(['GET', 'POST', 'DELETE'])
+def suppressions(request):
+    """
+    Look up, add or remove a suppressed address of the X-Tenant-ID tenant.
+
+    GET and DELETE take channel ('email' or 'push') and address query
+    parameters. Deliveries to suppressed addresses are skipped with status
+    'suppressed'.
+    """
+    if request.method == 'POST':
+        serializer = SuppressionSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response({"errors": serializer.errors}, status=400)
+        data = serializer.validated_data
+        suppress([(request.tenant_id, data['channel'], data['address'], data['reason'])])
+        return Response(serializer.data, status=201)
+
+    channel = request.query_params.get('channel', 'email')
+    address = request.query_params.get('address')
+    if not address:
+        return Response({"error": "An address must be provided."}, status=400)
+    rows = Suppression.objects.filter(tenant=request.tenant_id, channel=channel,
+                                      address=normalize_address(channel, address))
+
+    if request.method == 'DELETE':
+        if not rows.delete()[0]:
+            return Response({"error": "Address is not suppressed."}, status=404)
+        return Response(status=204)
+
+    suppression = rows.first()
+    if suppression is None:
+        return Response({"error": "Address is not suppressed."}, status=404)
+    return Response(SuppressionSerializer(suppression).data, status=200)
+
+
+# Async (ASGI) send endpoints. DRF's api_view only wraps sync views, so these
+# are plain Django async views returning JsonResponse.
+def request_data(request):
+    """The body of a plain Django request: parsed JSON, or the form/multipart fields."""
+    if request.content_type == 'application/json':
+        return json.loads(request.body or b'{}')
+    return request.POST
+
+
+def json_response(response):
+    """A DRF Response from one of the shared helpers above, as a JsonResponse."""
+    if isinstance(response, Response):
+        return JsonResponse(response.data, status=response.status_code)
+    return response
+
+
+@csrf_exempt
+@require_POST
+async def async_send_email(request):
+    """
+    send_email for ASGI servers.
+
+    The record is stored with the async ORM and delivered on the event loop
+    before responding, so one process keeps many provider calls in flight
+    instead of one per thread. Returns 200 with the record's status.
+    """
+    service_name, mail_credentials, error_response = await sync_to_async(get_mail_credentials)(request)
+    if error_response:
+        return json_response(error_response)
+    try:
+        data = request_data(request)
+    except ValueError:
+        return JsonResponse({"error": "Request body is not valid JSON."}, status=400)
+
+    serializer = SendEmailSerializer(data=data, context={'tenant': request.tenant_id})
+    if not await sync_to_async(serializer.is_valid)():
+        return JsonResponse({"errors": serializer.errors}, status=400)
+    validated_data = serializer.validated_data
+    if not validated_data['mail_action'] and not validated_data['firebase_action']:
+        return JsonResponse({"error": "You must choose at least one action."}, status=400)
+
+    def delivered(email_id):
+        email_record = Email.objects.only('sent_mail_status').get(id=email_id)
+        return JsonResponse({"status": email_record.sent_mail_status, "id": email_id, "record": serializer.data})
+
+    key = get_key(request, validated_data)
+    if key:
+        replay = await sync_to_async(idempotent_replay)(request, 'send_email', key, validated_data, delivered)
+        if replay is not None:
+            return json_response(replay)
+
+    firebase_credential = ''
+    if validated_data['firebase_action']:
+        file = request.FILES.get('credential_file')
+        if not file:
+            return JsonResponse({"error": "No file provided."}, status=400)
+        firebase_credential = await sync_to_async(save_credential_file)(file)
+
+    fields = email_fields(validated_data, service_name, mail_credentials, firebase_credential)
+    if key:
+        # The key has to be stored in the record's transaction, which the async ORM cannot open.
+        email_record = await sync_to_async(create_email_record)(request, 'send_email', key, validated_data, **fields)
+        if email_record is None:
+            return json_response(await sync_to_async(key_conflict)(
+                request, 'send_email', key, validated_data, delivered))
+    else:
+        email_record = await Email.objects.acreate(tenant=request.tenant_id, **template_fields(validated_data),
+                                                   **fields)
+        await Delivery.objects.abulk_create(build_deliveries(email_record, validated_data.get('recipient_contexts')))
+
+    await adeliver_batch([email_record.id])
+    return await sync_to_async(delivered)(email_record.id)
+
+
+@csrf_exempt
+@require_POST
+async def async_send_batch(request):
+    """
+    send_batch for ASGI servers: the records are stored with the async ORM
+    and delivered concurrently on the event loop before responding with 200
+    and each record's status.
+    """
+    service_name, mail_credentials, error_response = await sync_to_async(get_mail_credentials)(request)
+    if error_response:
+        return json_response(error_response)
+    try:
+        data = request_data(request)
+    except ValueError:
+        return JsonResponse({"error": "Request body is not valid JSON."}, status=400)
+
+    serializer = SendBatchSerializer(data=data)
+    if not await sync_to_async(serializer.is_valid)():
+        return JsonResponse({"errors": serializer.errors}, status=400)
+    items = serializer.validated_data['items']
+
+    firebase_credential = ''
+    if any(item['firebase_action'] for item in items):
+        file = request.FILES.get('credential_file')
+        if not file:
+            return JsonResponse({"error": "No file provided."}, status=400)
+        firebase_credential = await sync_to_async(save_credential_file)(file)
+
+    # One transaction for both inserts, which the async ORM cannot open.
+    email_records = await sync_to_async(create_batch)(
+        batch_records(request, items, service_name, mail_credentials, firebase_credential,
+                      serializer.validated_data['lane']))
+
+    email_ids = [email_record.id for email_record in email_records]
+    await adeliver_batch(email_ids)
+    statuses = {email_id: sent_mail_status async for email_id, sent_mail_status
+                in Email.objects.filter(id__in=email_ids).values_list('id', 'sent_mail_status')}
+    return JsonResponse({
+        "status": "Processed",
+        "count": len(email_ids),
+        "results": [{"id": email_id, "status": statuses[email_id]} for email_id in email_ids],
+    })
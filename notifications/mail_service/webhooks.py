@@ -0,0 +1,147 @@
+# webhooks.py
+
+import functools
+from collections import defaultdict
+from anymail.signals import tracking
+from django.conf import settings
+from django.db import transaction
+from django.dispatch import receiver
+from django.http import HttpResponseForbidden
+from django.urls import URLPattern
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from .delivery import stored_statuses
+from .models import Delivery, Email, TrackingEvent
+from .suppression import suppress
+
+# Tracking events that mean the message will not be delivered.
+FAILURE_EVENTS = {'bounced', 'rejected', 'failed'}
+# Tracking events that put the address on the suppression list.
+SUPPRESSION_EVENTS = {'bounced', 'rejected', 'complained', 'unsubscribed'}
+
+TRACKING_UPDATE_FIELDS = ['status', 'error', 'tracking_status', 'tracking_updated_at', 'updated_at']
+
+
+def require_webhook_secret(view):
+    """
+    Answer 403 while ANYMAIL['WEBHOOK_SECRET'] is unset: anymail would only
+    warn and then accept events from anyone.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not settings.ANYMAIL.get('WEBHOOK_SECRET'):
+            return HttpResponseForbidden("Webhooks are disabled until ANYMAIL_WEBHOOK_SECRET is set.")
+        return view(request, *args, **kwargs)
+    return wrapper
+
+
+def webhook_urls():
+    """anymail's webhook URL patterns, each behind require_webhook_secret(), for include()."""
+    from anymail.urls import app_name, urlpatterns
+
+    return [URLPattern(pattern.pattern, require_webhook_secret(pattern.callback), pattern.default_args, pattern.name)
+            for pattern in urlpatterns], app_name
+
+
+def _event_data(event, esp_name):
+    """The parts of an AnymailTrackingEvent needed to apply it, as a JSON-serializable dict."""
+    return {
+        'esp_name': esp_name,
+        'event_type': event.event_type,
+        'message_id': event.message_id or '',
+        'recipient': event.recipient or '',
+        'timestamp': (event.timestamp or timezone.now()).isoformat(),
+        # The provider's own explanation where there is one, else anymail's reject category.
+        'reason': event.mta_response or event.description or event.reject_reason or '',
+    }
+
+
+def _apply_event(delivery, event, timestamp):
+    """Apply one event to a delivery in memory. Returns True if the delivery changed."""
+    changed = False
+    if event['event_type'] in FAILURE_EVENTS and delivery.status != 'failed':
+        delivery.status = 'failed'
+        delivery.error = event['event_type'].capitalize() + (f": {event['reason']}" if event['reason'] else '')
+        changed = True
+    # Providers do not deliver events in order; keep the latest one.
+    if delivery.tracking_updated_at is None or timestamp >= delivery.tracking_updated_at:
+        delivery.tracking_status = event['event_type']
+        delivery.tracking_updated_at = timestamp
+        changed = True
+    return changed
+
+
+def apply_tracking_events(events):
+    """
+    Apply a batch of tracking events to their deliveries.
+
+    Deliveries are matched by provider message id, and by recipient when
+    one message went to several addresses. All changes are written with one
+    bulk_update, followed by one update of the affected Email statuses.
+    Returns the number of deliveries changed.
+    """
+    message_ids = {event['message_id'] for event in events if event['message_id']}
+    if not message_ids:
+        return 0
+    by_message_id = defaultdict(list)
+    for delivery in Delivery.objects.filter(provider_message_id__in=message_ids).select_related('email'):
+        by_message_id[delivery.provider_message_id].append(delivery)
+
+    changed = {}
+    suppressions = []
+    for timestamp, event in sorted(((parse_datetime(event['timestamp']), event) for event in events),
+                                   key=lambda item: item[0]):
+        candidates = by_message_id.get(event['message_id'], [])
+        if len(candidates) > 1 and event['recipient']:
+            recipient = event['recipient'].lower()
+            candidates = [delivery for delivery in candidates if delivery.address.lower() == recipient]
+        for delivery in candidates:
+            if _apply_event(delivery, event, timestamp):
+                delivery.updated_at = timezone.now()
+                changed[delivery.id] = delivery
+            if event['event_type'] in SUPPRESSION_EVENTS:
+                suppressions.append((delivery.email.tenant, delivery.channel, delivery.address, event['event_type']))
+
+    if changed:
+        Delivery.objects.bulk_update(list(changed.values()), TRACKING_UPDATE_FIELDS, batch_size=1000)
+        update_email_statuses({delivery.email_id for delivery in changed.values()})
+    suppress(suppressions)
+    return len(changed)
+
+
+def update_email_statuses(email_ids):
+    """Recompute Email.sent_mail_status from the deliveries, in one query and one bulk update."""
+    Email.objects.bulk_update(
+        [Email(id=email_id, sent_mail_status=sent_mail_status)
+         for email_id, sent_mail_status in stored_statuses(email_ids).items()],
+        ['sent_mail_status'], batch_size=1000)
+
+
+def apply_stored_events(batch_size=None):
+    """
+    Apply the saved TrackingEvent rows, MAIL_SERVICE_WEBHOOK_BATCH_SIZE at a
+    time, and return how many were applied.
+
+    Each batch is claimed with SKIP LOCKED, applied with one bulk update and
+    deleted in the same transaction, so several workers can drain the table
+    at once and an event is only gone once it has been applied.
+    """
+    batch_size = batch_size or settings.MAIL_SERVICE_WEBHOOK_BATCH_SIZE
+    applied = 0
+    while True:
+        with transaction.atomic():
+            rows = list(TrackingEvent.objects.select_for_update(skip_locked=True)
+                        .order_by('id').values_list('id', 'data')[:batch_size])
+            if not rows:
+                return applied
+            apply_tracking_events([data for _, data in rows])
+            TrackingEvent.objects.filter(id__in=[event_id for event_id, _ in rows]).delete()
+        applied += len(rows)
+        if len(rows) < batch_size:
+            return applied
+
+
+@receiver(tracking)
+def handle_tracking_event(sender, event, esp_name, **kwargs):
+    # Saved before the webhook responds, so an event the provider saw accepted survives a restart.
+    TrackingEvent.objects.create(data=_event_data(event, esp_name))
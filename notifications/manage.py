@@ -6,7 +6,9 @@ import sys
 
 def main():
     """Run administrative tasks."""
-    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'notifications.settings')
+    # The test suite runs Celery tasks eagerly; see notifications/test_settings.py.
+    default_settings = 'notifications.test_settings' if sys.argv[1:2] == ['test'] else 'notifications.settings'
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', default_settings)
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc:
@@ -0,0 +1,13 @@
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'notifications.settings')
+
+app = Celery('notifications')
+
+# Read CELERY_* settings from Django settings.
+app.config_from_object('django.conf:settings', namespace='CELERY')
+
+# Our tasks live in mail_service/task.py rather than the default tasks.py.
+app.autodiscover_tasks(related_name='task')
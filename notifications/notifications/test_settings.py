@@ -0,0 +1,13 @@
+"""
+Settings for the test suite, which manage.py test uses by default.
+
+Celery tasks run eagerly in-process on an in-memory broker, so each request
+under test includes its delivery without a worker.
+"""
+
+from .settings import *  # noqa: F401,F403
+
+CELERY_BROKER_URL = 'memory://'
+CELERY_TASK_ALWAYS_EAGER = True
+# The suite runs in one process without webhook credentials; the checks are tested directly.
+SILENCED_SYSTEM_CHECKS = ['mail_service.W001', 'mail_service.W002']
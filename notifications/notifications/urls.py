@@ -19,6 +19,8 @@ from django.urls import path, include
 from rest_framework import permissions
 from drf_yasg.views import get_schema_view
 from drf_yasg import openapi
+from mail_service.views import metrics
+from mail_service.webhooks import webhook_urls
 
 schema_view = get_schema_view(
    openapi.Info(
@@ -36,6 +38,10 @@ schema_view = get_schema_view(
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('mail_service.urls')),
+    # Prometheus scrape endpoint.
+    path('metrics', metrics, name='metrics'),
+    # Provider tracking webhooks, e.g. /anymail/sendgrid/tracking/.
+    path('anymail/', include(webhook_urls())),
     path('swagger/', schema_view.with_ui('swagger', cache_timeout=0), name='schema-swagger-ui'),
     path('redoc/', schema_view.with_ui('redoc', cache_timeout=0), name='schema-redoc'),
 ]